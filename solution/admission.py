@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from fastapi import HTTPException, Request
+from auth import cached_company
+from cfg import WEB_CONCURRENCY
+from database import DB_POOL_SIZE, DB_MAX_OVERFLOW
+from metrics import ADMISSION_SHED, ADMISSION_QUEUE_WAIT
+
+# Допуск запросов до того, как они встанут в очередь за соединением пула:
+# - глобальный лимит одновременных запросов по ёмкости пула воркера;
+# - бюджет ожидания в очереди: дольше него запрос не ждёт, а сразу получает 503 с Retry-After;
+# - token bucket на компанию (ключ — id из кэша токенов или хэш токена): сверх него 429.
+# Любой параметр переопределяется для маршрута через ADMISSION_ROUTES, например
+# {"POST /business/promo/batch": {"rate": 1, "burst": 3, "concurrency": 2}}.
+
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.5"))
+ADMISSION_QUEUE_LIMIT = int(os.getenv("ADMISSION_QUEUE_LIMIT", str(ADMISSION_CONCURRENCY * 4)))
+# Запросов в секунду на компанию суммарно по всем воркерам; 0 выключает ограничение.
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "50"))
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "100"))
+ADMISSION_ROUTES = json.loads(os.getenv("ADMISSION_ROUTES", "{}"))
+ADMISSION_BUCKETS_SIZE = 100_000
+
+EXEMPT_PATHS = {"/ping", "/healthz", "/readyz", "/metrics"}
+
+
+class _Gate:
+    def __init__(self, limit: int, queue_timeout: float, queue_limit: int):
+        self.slots = asyncio.Semaphore(limit)
+        self.queue_timeout = queue_timeout
+        self.queue_limit = queue_limit
+        self.waiting = 0
+
+    async def enter(self) -> str:
+        """Пустая строка, если слот получен, иначе причина отказа."""
+        if not self.slots.locked():
+            await self.slots.acquire()
+            return ""
+        if self.waiting >= self.queue_limit or self.queue_timeout <= 0:
+            return "queue_full"
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            return ""
+        except asyncio.TimeoutError:
+            return "queue_timeout"
+        finally:
+            self.waiting -= 1
+
+    def leave(self):
+        self.slots.release()
+
+
+class _Buckets:
+    def __init__(self, rate: float, burst: float):
+        # Воркеры не делят состояние, поэтому каждый получает свою долю общего лимита.
+        self.rate = rate / WEB_CONCURRENCY
+        self.burst = max(1.0, burst / WEB_CONCURRENCY)
+        self.state: dict = {}
+
+    def take(self, key) -> float:
+        """0, если токен есть; иначе через сколько секунд он появится."""
+        now = time.monotonic()
+        tokens, updated = self.state.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+        # pop + вставка держит словарь в порядке последнего обращения: вытесняем самые старые ключи.
+        self.state[key] = (tokens, now)
+        if len(self.state) > ADMISSION_BUCKETS_SIZE:
+            del self.state[next(iter(self.state))]
+        return wait
+
+
+_global_gate = _Gate(ADMISSION_CONCURRENCY, ADMISSION_QUEUE_TIMEOUT, ADMISSION_QUEUE_LIMIT)
+_default_buckets = _Buckets(ADMISSION_RATE, ADMISSION_BURST) if ADMISSION_RATE > 0 else None
+_route_gates: dict = {}
+_route_buckets: dict = {}
+for _route, _limits in ADMISSION_ROUTES.items():
+    if "concurrency" in _limits:
+        _route_gates[_route] = _Gate(
+            _limits["concurrency"],
+            _limits.get("queue_timeout", ADMISSION_QUEUE_TIMEOUT),
+            _limits.get("queue_limit", _limits["concurrency"] * 4),
+        )
+    if "rate" in _limits:
+        _route_buckets[_route] = _Buckets(_limits["rate"], _limits.get("burst", _limits["rate"])) if _limits["rate"] > 0 else None
+
+
+def _client_key(request: Request):
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    company = cached_company(token)
+    if company is not None:
+        return company.id
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _shed(route_key: str, reason: str, status_code: int, retry_after: float):
+    ADMISSION_SHED.labels(route_key, reason).inc()
+    raise HTTPException(
+        status_code=status_code,
+        detail="Слишком много запросов, попробуйте позже" if status_code == 429 else "Сервис перегружен, попробуйте позже",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+async def admit(request: Request):
+    """Зависимость уровня приложения: слот держится до конца обработчика и его зависимостей."""
+    route = request.scope.get("route")
+    if route is None or route.path in EXEMPT_PATHS:
+        yield
+        return
+    route_key = f"{request.method} {route.path}"
+
+    buckets = _route_buckets.get(route_key, _default_buckets)
+    if buckets is not None:
+        client = _client_key(request)
+        if client is not None:
+            wait = buckets.take(client)
+            if wait:
+                _shed(route_key, "rate_limit", 429, wait)
+
+    gates = [gate for gate in (_route_gates.get(route_key), _global_gate) if gate is not None]
+    entered = []
+    started = time.perf_counter()
+    try:
+        for gate in gates:
+            reason = await gate.enter()
+            if reason:
+                _shed(route_key, reason, 503, gate.queue_timeout)
+            entered.append(gate)
+        ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - started)
+        yield
+    finally:
+        for gate in entered:
+            gate.leave()
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import time
+import uuid
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy import select, text
+from database import open_session, Company
+from listen import listener
+from utility import security, decode_token
+from cfg import PRINCIPAL_CACHE_TTL, PRINCIPAL_CACHE_SIZE
+
+logger = logging.getLogger("auth")
+
+# Выдача нового токена (sign-in) в своей транзакции делает NOTIFY principal_cache с id компании:
+# кэш сбрасывается во всех воркерах, а не только в том, что выдал токен. Пока LISTEN (listen.py)
+# не подключён, кэш не используется — пропущенное уведомление оставило бы старый токен в силе.
+PRINCIPAL_CACHE_CHANNEL = "principal_cache"
+
+# sha256(token) -> (компания, момент истечения записи)
+_principals: dict[str, tuple[Company, float]] = {}
+# company_id -> ключи её токенов, чтобы сбрасывать кэш при выдаче нового токена
+_company_keys: dict = {}
+_listening = False
+# Растёт с каждым сбросом: промах, начавшийся до сброса, не кладёт в кэш прочитанный до него токен.
+_generation = 0
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _forget(key: str):
+    entry = _principals.pop(key, None)
+    if entry is not None:
+        keys = _company_keys.get(entry[0].id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                _company_keys.pop(entry[0].id, None)
+
+
+def _lookup(key: str):
+    entry = _principals.pop(key, None) if _listening else None
+    if entry is not None:
+        # pop + вставка держит словарь в порядке последнего обращения: вытесняется давно не читанный токен.
+        _principals[key] = entry
+    return entry
+
+
+def _remember(key: str, company: Company, expires_at: float):
+    if len(_principals) >= PRINCIPAL_CACHE_SIZE:
+        _forget(next(iter(_principals)))
+    _principals[key] = (company, expires_at)
+    _company_keys.setdefault(company.id, set()).add(key)
+
+
+def invalidate_company(company_id):
+    global _generation
+    _generation += 1
+    for key in list(_company_keys.get(company_id, ())):
+        _forget(key)
+
+
+async def publish_invalidation(db, company_id):
+    """В транзакции, меняющей companies.token, до commit."""
+    await db.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": PRINCIPAL_CACHE_CHANNEL, "payload": str(company_id)},
+    )
+
+
+def _on_notify(payloads):
+    for company_id in set(payloads):
+        invalidate_company(uuid.UUID(company_id))
+
+
+def _set_listening(listening: bool):
+    global _listening, _generation
+    _listening = listening
+    _generation += 1
+    _principals.clear()
+    _company_keys.clear()
+
+
+listener.subscribe(PRINCIPAL_CACHE_CHANNEL, _on_notify, _set_listening)
+
+
+def cached_company(token: str):
+    entry = _lookup(_token_key(token))
+    if entry is not None and entry[1] > time.time():
+        return entry[0]
+    return None
+
+
+async def get_current_company(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Company:
+    token = credentials.credentials
+    key = _token_key(token)
+    now = time.time()
+
+    entry = _lookup(key)
+    if entry is not None:
+        if entry[1] > now:
+            return entry[0]
+        _forget(key)
+
+    payload = decode_token(token)
+    company_id = payload.get("cid")
+    logger.debug("Промах кэша токенов, компания %s", company_id or payload.get("sub"))
+    if company_id:
+        try:
+            company_id = uuid.UUID(company_id)
+        except ValueError:
+            raise HTTPException(status_code=401, detail="Неверный токен")
+        query = select(Company).where(Company.id == company_id)
+    elif payload.get("sub"):
+        # Токены, выданные до появления cid в payload
+        query = select(Company).where(Company.email == payload["sub"]).limit(1)
+    else:
+        raise HTTPException(status_code=401, detail="Поле 'sub' отсутствует в токене")
+
+    generation = _generation
+    # Своя короткая сессия на primary (только что выданный токен мог не доехать до реплики),
+    # и только при промахе кэша: GET-эндпоинты на реплике не держат лишнее соединение primary.
+    async with open_session() as db:
+        company = await db.scalar(query)
+        if not company or company.token != token:
+            raise HTTPException(status_code=401, detail="Токен недействителен")
+        # Отвязываем от сессии, чтобы объект пережил close и жил в кэше.
+        db.expunge(company)
+    if _listening and generation == _generation:
+        _remember(key, company, min(now + PRINCIPAL_CACHE_TTL, payload.get("exp", now)))
+    return company
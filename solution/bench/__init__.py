@@ -0,0 +1 @@
+"""Воспроизводимый бенчмарк API: python -m bench --help, подробности в bench/README.md."""
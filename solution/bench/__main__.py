@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+SOLUTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Нагрузочный бенчмарк API промокодов")
+    parser.add_argument("--companies", type=int, default=10, help="Сколько компаний засеять (N)")
+    parser.add_argument("--promos", type=int, default=2000, help="Сколько промокодов засеять всего (M)")
+    parser.add_argument("--requests", type=int, default=200, help="Запросов на эндпоинт в каждом сценарии")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--events", type=int, default=100000, help="Событий активации для сценария stat")
+    parser.add_argument(
+        "--partition-rows", default="100000,1000000",
+        help="Сколько строк promo_codes всего на каждом шаге сценария partitions, через запятую",
+    )
+    parser.add_argument("--search-promos", type=int, default=1_000_000, help="Промокодов компании для сценария search")
+    parser.add_argument(
+        "--export-rss-mb", type=float, default=64,
+        help="Насколько может вырасти RSS процесса за один экспорт в сценарии export, МБ",
+    )
+    parser.add_argument("--redis-url", help="Redis для сценария cache; без него поднимается заглушка в памяти")
+    parser.add_argument(
+        "--scenario", action="append", default=None,
+        help="api, hashing, feed, keyset, activate, stat, batch, export, conditional, compression, serialize, overload, replica, schedule, search, partitions, cache или all; можно несколько раз",
+    )
+    parser.add_argument(
+        "--mode", choices=["asgi", "socket", "gunicorn"], default="asgi",
+        help="Клиент в процессе, через uvicorn на порту или через gunicorn с --workers воркерами",
+    )
+    parser.add_argument("--workers", type=int, default=2, help="Воркеров gunicorn в --mode gunicorn")
+    parser.add_argument("--url", help="Бить во внешний сервер вместо запуска main.app")
+    parser.add_argument("--db-mode", choices=["sync", "async"], help="Переопределить DB_MODE")
+    parser.add_argument("--reset", action="store_true", help="Пересоздать схему public перед прогоном (стирает данные!)")
+    parser.add_argument("--enforce-budgets", action="store_true", help="Падать, если эндпоинт превысил query_budget")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON-отчёт, с которым сравнивать")
+    parser.add_argument("--save-baseline", help="Сохранить отчёт как новый baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое ухудшение, доля (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+async def run(args) -> dict:
+    from bench.harness import Recorder, environment, open_client
+    from bench.scenarios import SCENARIOS, Context, seed
+
+    names = args.scenario or ["api"]
+    if "all" in names:
+        names = list(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    recorder = Recorder()
+    started = time.time()
+    async with open_client(args.mode, args.url, args.workers) as client:
+        ctx = Context(client, recorder, args, random.Random(args.seed))
+        if ctx.in_process:
+            from main import app
+
+            recorder.extra["startup"] = app.state.startup
+        await seed(ctx)
+        for name in names:
+            await SCENARIOS[name](ctx)
+
+    return recorder.report({
+        "started_at": started,
+        "duration_s": round(time.time() - started, 3),
+        "scenarios": names,
+        "mode": "url" if args.url else args.mode,
+        **({"workers": args.workers} if args.mode == "gunicorn" and not args.url else {}),
+        "companies": args.companies,
+        "promos": args.promos,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        **environment(),
+    })
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for option in ("output", "baseline", "save_baseline"):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    if args.db_mode:
+        os.environ["DB_MODE"] = args.db_mode
+    # Несколько компаний бенчмарка легко превышают лимит запросов на компанию; сценарий overload
+    # проверяет прежде всего глобальный лимит, а token bucket включается явным ADMISSION_RATE.
+    os.environ.setdefault("ADMISSION_RATE", "0")
+    if args.enforce_budgets:
+        os.environ["QUERY_BUDGET_ENFORCE"] = "1"
+    # Модули приложения импортируются плоско, как в entrypoint.sh.
+    sys.path.insert(0, SOLUTION_DIR)
+    os.chdir(SOLUTION_DIR)
+
+    if args.reset:
+        if args.url:
+            raise SystemExit("--reset нельзя совмещать с --url")
+        from bench.harness import reset_database
+        reset_database()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as output:
+            output.write(text)
+
+    regressions = []
+    if args.baseline:
+        from bench.harness import compare
+
+        with open(args.baseline) as source:
+            baseline = json.load(source)
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}", file=sys.stderr)
+    for line in report["failures"]:
+        print(f"ПРОВАЛ {line}", file=sys.stderr)
+    if regressions or report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import asyncio
+import math
+import os
+import platform
+import re
+import socket
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+import httpx
+
+SOLUTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# db;dur=<мс>;desc="<N> queries" из querystats.QueryStatsMiddleware
+SERVER_TIMING_DB = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+def rss_mb() -> float:
+    # Текущий, а не пиковый RSS: для проверки «память не растёт» нужен именно он.
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return 0.0
+
+
+class Recorder:
+    """Латентности запросов по именам эндпоинтов плюс произвольные числа сценариев."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.statuses = defaultdict(Counter)
+        self.wall = Counter()
+        self.db_ms = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.extra = {}
+        # Проваленные проверки сценариев: любая роняет прогон независимо от baseline.
+        self.failures: list[str] = []
+
+    def fail(self, scenario: str, message: str):
+        self.failures.append(f"{scenario}: {message}")
+
+    async def request(self, name: str, client: httpx.AsyncClient, method: str, url: str, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.samples[name].append(time.perf_counter() - started)
+        self.statuses[name][response.status_code] += 1
+        if response.status_code not in expect:
+            self.errors[name] += 1
+        timing = SERVER_TIMING_DB.search(response.headers.get("server-timing", ""))
+        if timing:
+            self.db_ms[name].append(float(timing.group(1)))
+            self.queries[name].append(int(timing.group(2)))
+        return response
+
+    async def phase(self, name: str, count: int, concurrency: int, fn):
+        """Вызывает fn(i) для i в range(count) не более чем в concurrency корутинах."""
+        position = iter(range(count))
+
+        async def worker():
+            for i in position:
+                await fn(i)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, count)))))
+        self.wall[name] += time.perf_counter() - started
+
+    def report(self, meta: dict) -> dict:
+        endpoints = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            wall = self.wall.get(name) or sum(samples)
+            endpoints[name] = {
+                "count": len(samples),
+                "errors": self.errors[name],
+                "statuses": {str(code): n for code, n in sorted(self.statuses[name].items())},
+                "throughput_rps": round(len(samples) / wall, 2) if wall else 0.0,
+                "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+                "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+            }
+            if self.queries.get(name):
+                endpoints[name]["queries_max"] = max(self.queries[name])
+                endpoints[name]["db_ms_mean"] = round(sum(self.db_ms[name]) / len(self.db_ms[name]), 3)
+        return {"meta": meta, "endpoints": endpoints, "extra": self.extra, "failures": self.failures}
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """Регрессии относительно baseline: рост p95/p99 или падение пропускной способности больше threshold,
+    любой рост числа SQL-запросов на вызов."""
+    regressions = []
+    for name, base in baseline.get("endpoints", {}).items():
+        current = report["endpoints"].get(name)
+        if current is None:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if base[key] and current[key] > base[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {base[key]} -> {current[key]}")
+        if base["throughput_rps"] and current["throughput_rps"] < base["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput_rps {base['throughput_rps']} -> {current['throughput_rps']}")
+        if "queries_max" in base and current.get("queries_max", 0) > base["queries_max"]:
+            regressions.append(f"{name}: queries_max {base['queries_max']} -> {current['queries_max']}")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: errors {base.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "db_mode": os.getenv("DB_MODE", "sync"),
+        "bcrypt_rounds": os.getenv("BCRYPT_ROUNDS"),
+    }
+
+
+def reset_database():
+    """Пересоздаёт схему public и накатывает её так же, как мастер gunicorn (bootstrap.migrate)."""
+    import psycopg2
+    import bootstrap
+    from database import DATABASE_URL
+
+    connection = psycopg2.connect(DATABASE_URL)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE")
+        cursor.execute("CREATE SCHEMA public")
+    connection.close()
+    bootstrap.migrate()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def _gunicorn(workers: int):
+    """gunicorn.conf.py с workers воркерами на свободном порту, как в entrypoint.sh; отдаёт его адрес."""
+    port = _free_port()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app",
+        cwd=SOLUTION_DIR,
+        env={**os.environ, "SERVER_ADDRESS": f"127.0.0.1:{port}", "WEB_CONCURRENCY": str(workers)},
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 120
+        async with httpx.AsyncClient(base_url=url) as probe:
+            while True:
+                if process.returncode is not None:
+                    raise RuntimeError(f"gunicorn завершился с кодом {process.returncode}")
+                try:
+                    if (await probe.get("/readyz")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn не поднялся за 120 с")
+                await asyncio.sleep(0.2)
+        yield url
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+
+
+@asynccontextmanager
+async def open_client(mode: str, url: str = None, workers: int = 2):
+    """asgi — приложение в том же процессе без сети; socket — uvicorn на локальном порту;
+    gunicorn — отдельный gunicorn с workers воркерами; url — внешний сервер."""
+    timeout = httpx.Timeout(120.0)
+    if mode == "gunicorn" and not url:
+        async with _gunicorn(workers) as url:
+            async with open_client(mode, url) as client:
+                yield client
+        return
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+            yield client
+        return
+
+    from main import app
+
+    if mode == "asgi":
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=timeout) as client:
+                yield client
+        return
+
+    async with _uvicorn(app) as client:
+        yield client
+
+
+@asynccontextmanager
+async def _uvicorn(app, lifespan: str = "auto"):
+    import uvicorn
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan=lifespan))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", timeout=httpx.Timeout(120.0), limits=limits
+        ) as client:
+            yield client
+    finally:
+        server.should_exit = True
+        await task
+
+
+@asynccontextmanager
+async def socket_client():
+    """Клиент через uvicorn на локальном порту к main.app, чей lifespan уже запущен в этом процессе.
+
+    ASGITransport собирает тело ответа целиком до возврата из запроса, поэтому потоковые ответы
+    в режиме asgi проверяются через сокет.
+    """
+    from main import app
+
+    async with _uvicorn(app, lifespan="off") as client:
+        yield client
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+
+def _bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class RedisStandIn:
+    """Redis-совместимый сервер в памяти для сценария cache: ровно те команды, что шлёт cache.py
+    (MGET, SET EX, INCR/INCRBY, EXPIRE) и служебные команды клиента redis-py. Настоящий сервер — --redis-url."""
+
+    def __init__(self):
+        self.data: dict[bytes, bytes] = {}
+        self.expires: dict[bytes, float] = {}
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        self.server = await asyncio.start_server(self._serve, host, 0)
+        return f"redis://{host}:{self.server.sockets[0].getsockname()[1]}/0"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _get(self, key: bytes):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self._execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _execute(self, args: list[bytes]) -> bytes:
+        name = args[0].upper()
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name in (b"CLIENT", b"SELECT"):
+            return b"+OK\r\n"
+        if name == b"GET":
+            return _bulk(self._get(args[1]))
+        if name == b"MGET":
+            return b"*%d\r\n" % (len(args) - 1) + b"".join(_bulk(self._get(key)) for key in args[1:])
+        if name == b"SET":
+            self.data[args[1]] = args[2]
+            self.expires.pop(args[1], None)
+            options = [option.upper() for option in args[3:]]
+            if b"EX" in options:
+                self.expires[args[1]] = time.monotonic() + int(args[4 + options.index(b"EX")])
+            return b"+OK\r\n"
+        if name in (b"INCR", b"INCRBY"):
+            value = int(self._get(args[1]) or 0) + (int(args[2]) if name == b"INCRBY" else 1)
+            self.data[args[1]] = str(value).encode()
+            return b":%d\r\n" % value
+        if name == b"EXPIRE":
+            if self._get(args[1]) is None:
+                return b":0\r\n"
+            self.expires[args[1]] = time.monotonic() + int(args[2])
+            return b":1\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name
@@ -0,0 +1,1165 @@
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import AsyncExitStack
+from bench.harness import Recorder, percentile, rss_mb, socket_client
+
+COUNTRIES = ["ru", "us", "de", "fr", "kz", "by", "am", "ge"]
+CATEGORIES = ["food", "travel", "tech", "sport", "books", "music"]
+PASSWORD = "Bench-Passw0rd!"
+# Сколько секунд сценарии повторяют ответы 503 с Retry-After, прежде чем сдаться.
+RETRY_TIMEOUT = 30.0
+
+
+class Context:
+    def __init__(self, client, recorder: Recorder, args, rng: random.Random):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.rng = rng
+        # Сценарии, которые лезут в базу или модули приложения, работают только с main.app в этом процессе.
+        self.in_process = not args.url and args.mode != "gunicorn"
+        # company email -> Authorization-заголовок и id её промокодов
+        self.headers: dict[str, dict] = {}
+        self.promos: dict[str, list[str]] = {}
+        self.run_id = uuid.uuid4().hex[:8]
+
+    async def request(self, name, method, url, expect=(200,), **kwargs):
+        return await self.recorder.request(name, self.client, method, url, expect=expect, **kwargs)
+
+    def random_company(self) -> str:
+        return self.rng.choice(list(self.headers))
+
+    def random_promo(self) -> tuple[str, str]:
+        company = self.rng.choice([email for email, ids in self.promos.items() if ids])
+        return company, self.rng.choice(self.promos[company])
+
+
+def promo_payload(rng: random.Random, unique_codes: int = 0, max_count: int = 100) -> dict:
+    target = {}
+    if rng.random() < 0.7:
+        target["country"] = rng.choice(COUNTRIES)
+    if rng.random() < 0.5:
+        target["categories"] = rng.sample(CATEGORIES, rng.randint(1, 3))
+    if rng.random() < 0.5:
+        age_from = rng.randint(0, 40)
+        target["age_from"] = age_from
+        target["age_until"] = age_from + rng.randint(5, 40)
+    payload = {
+        "description": f"Benchmark promo {rng.random():.8f}",
+        "target": target,
+        "max_count": max_count,
+        "active_from": "2020-01-01",
+        "active_until": "2099-01-01",
+    }
+    if unique_codes:
+        payload["mode"] = "UNIQUE"
+        payload["promo_unique"] = [f"u{uuid.uuid4().hex[:20]}" for _ in range(unique_codes)]
+        payload["max_count"] = unique_codes
+    else:
+        payload["mode"] = "COMMON"
+        payload["promo_common"] = "BENCH"
+    return payload
+
+
+def retry_after(response) -> float:
+    return float(response.headers.get("retry-after", 1))
+
+
+async def drain_quota(ctx: Context, name: str, url: str, headers: dict, on_granted) -> bool:
+    """Повторяет активацию по одной, соблюдая Retry-After, пока сервер не ответит 403: квота выбрана."""
+    deadline = time.monotonic() + RETRY_TIMEOUT
+    while time.monotonic() < deadline:
+        response = await ctx.request(name, "POST", url, expect=(200, 403, 503), headers=headers)
+        if response.status_code == 403:
+            return True
+        if response.status_code == 200:
+            on_granted(response)
+        else:
+            await asyncio.sleep(retry_after(response))
+    return False
+
+
+async def request_until_served(ctx: Context, name: str, method: str, url: str, **kwargs):
+    """Запрос, без которого прогону не продолжить: 503 (очередь bcrypt в hashing.py, допуск в admission.py)
+    повторяется по Retry-After, любой другой ответ, кроме 200, останавливает прогон."""
+    deadline = time.monotonic() + RETRY_TIMEOUT
+    while True:
+        response = await ctx.request(name, method, url, expect=(200, 503), **kwargs)
+        if response.status_code != 503 or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(retry_after(response))
+    if response.status_code != 200:
+        raise SystemExit(f"{method} {url}: ответ {response.status_code}: {response.text[:200]}")
+    return response
+
+
+async def sign_up_company(ctx: Context, name: str, email: str, recorded: str = "sign-up"):
+    await ctx.request(recorded, "POST", "/business/auth/sign-up", json={"name": name, "email": email, "password": PASSWORD})
+
+
+async def seed(ctx: Context):
+    """N компаний через sign-up/sign-in и M промокодов через batch-эндпоинт."""
+    args = ctx.args
+    emails = [f"bench-{ctx.run_id}-{i}@example.com" for i in range(args.companies)]
+
+    async def sign_up(i):
+        await request_until_served(
+            ctx, "sign-up", "POST", "/business/auth/sign-up",
+            json={"name": f"Bench company {i}", "email": emails[i], "password": PASSWORD},
+        )
+
+    async def sign_in(i):
+        response = await request_until_served(
+            ctx, "sign-in", "POST", "/business/auth/sign-in", json={"email": emails[i], "password": PASSWORD}
+        )
+        ctx.headers[emails[i]] = {"Authorization": f"Bearer {response.json()['token']}"}
+        ctx.promos[emails[i]] = []
+
+    await ctx.recorder.phase("sign-up", len(emails), args.concurrency, sign_up)
+    await ctx.recorder.phase("sign-in", len(emails), args.concurrency, sign_in)
+
+    per_company = max(1, args.promos // len(emails))
+    started = time.perf_counter()
+    for email in emails:
+        for offset in range(0, per_company, 1000):
+            batch = [
+                promo_payload(ctx.rng, unique_codes=5 if ctx.rng.random() < 0.2 else 0)
+                for _ in range(min(1000, per_company - offset))
+            ]
+            response = await ctx.client.post("/business/promo/batch", headers=ctx.headers[email], json=batch)
+            response.raise_for_status()
+            ctx.promos[email].extend(item["id"] for item in response.json()["items"] if item.get("id"))
+    ctx.recorder.extra["seed"] = {
+        "companies": len(emails),
+        "promos": sum(map(len, ctx.promos.values())),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+async def api(ctx: Context):
+    """Основные эндпоинты кабинета: create, list, get, patch, stat."""
+    n, concurrency = ctx.args.requests, ctx.args.concurrency
+
+    async def create(i):
+        email = ctx.random_company()
+        response = await ctx.request(
+            "create", "POST", "/business/promo", expect=(201,),
+            headers=ctx.headers[email], json=promo_payload(ctx.rng),
+        )
+        if response.status_code == 201:
+            ctx.promos[email].append(response.json()["id"])
+
+    async def list_page(i):
+        email = ctx.random_company()
+        params = {"limit": 10, "sort_by": ctx.rng.choice(["created_at", "active_from", "active_until"])}
+        response = await ctx.request("list", "GET", "/business/promo", headers=ctx.headers[email], params=params)
+        next_cursor = response.headers.get("x-next-cursor")
+        if next_cursor:
+            await ctx.request(
+                "list-next", "GET", "/business/promo", headers=ctx.headers[email], params={**params, "cursor": next_cursor}
+            )
+
+    async def get(i):
+        email, promo_id = ctx.random_promo()
+        await ctx.request("get", "GET", f"/business/promo/{promo_id}", headers=ctx.headers[email])
+
+    async def patch(i):
+        email, promo_id = ctx.random_promo()
+        await ctx.request(
+            "patch", "PATCH", f"/business/promo/{promo_id}", headers=ctx.headers[email],
+            json={"description": f"Patched benchmark promo {i}"},
+        )
+
+    async def stat(i):
+        email, promo_id = ctx.random_promo()
+        await ctx.request("stat", "GET", f"/business/promo/{promo_id}/stat", headers=ctx.headers[email])
+
+    for name, fn in (("create", create), ("list", list_page), ("get", get), ("patch", patch), ("stat", stat)):
+        await ctx.recorder.phase(name, n, concurrency, fn)
+
+
+async def hashing(ctx: Context):
+    """Латентность /ping во время шторма регистраций и пропускная способность sign-in (bcrypt вне event loop)."""
+    storm = ctx.args.requests
+    emails = [f"storm-{ctx.run_id}-{i}@example.com" for i in range(storm)]
+    done = asyncio.Event()
+
+    async def sign_up(i):
+        await sign_up_company(ctx, f"Storm {i}", emails[i], recorded="sign-up-storm")
+
+    async def ping_loop():
+        while not done.is_set():
+            await ctx.request("ping-during-storm", "GET", "/ping")
+            await asyncio.sleep(0.01)
+
+    pinger = asyncio.create_task(ping_loop())
+    try:
+        await ctx.recorder.phase("sign-up-storm", storm, ctx.args.concurrency, sign_up)
+    finally:
+        done.set()
+        await pinger
+
+    async def sign_in(i):
+        await ctx.request(
+            "sign-in-storm", "POST", "/business/auth/sign-in", expect=(200, 503),
+            json={"email": emails[i], "password": PASSWORD},
+        )
+
+    await ctx.recorder.phase("sign-in-storm", storm, ctx.args.concurrency, sign_in)
+
+
+async def feed(ctx: Context):
+    """Лента по профилю пользователя поверх засеянных промокодов."""
+    async def fetch(i):
+        params = {"limit": 10}
+        if ctx.rng.random() < 0.8:
+            params["country"] = ctx.rng.choice(COUNTRIES)
+        if ctx.rng.random() < 0.5:
+            params["age"] = ctx.rng.randint(0, 80)
+        if ctx.rng.random() < 0.5:
+            params["category"] = ctx.rng.choice(CATEGORIES)
+        await ctx.request("feed", "GET", "/promo/feed", params=params)
+
+    await ctx.recorder.phase("feed", ctx.args.requests, ctx.args.concurrency, fetch)
+
+
+async def keyset(ctx: Context):
+    """Глубокие страницы списка: offset против курсора, плюс план запроса страницы."""
+    email = max(ctx.promos, key=lambda key: len(ctx.promos[key]))
+    headers = ctx.headers[email]
+    pages = min(ctx.args.requests, max(1, len(ctx.promos[email]) // 10))
+    cursor = None
+    for page in range(pages):
+        params = {"limit": 10}
+        if cursor:
+            params["cursor"] = cursor
+        response = await ctx.request("list-cursor", "GET", "/business/promo", headers=headers, params=params)
+        await ctx.request("list-offset", "GET", "/business/promo", headers=headers, params={"limit": 10, "offset": page * 10})
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+
+    if ctx.in_process:
+        from sqlalchemy import select, text
+        from database import Company, PromoCode, open_session
+
+        async with open_session() as db:
+            company_id = await db.scalar(select(Company.id).where(Company.email == email))
+            query = (
+                select(PromoCode.id, PromoCode.created_at)
+                .where(PromoCode.company_id == company_id)
+                .order_by(PromoCode.created_at.desc(), PromoCode.id.desc())
+                .limit(10)
+            )
+            compiled = query.compile(compile_kwargs={"literal_binds": True})
+            plan = (await db.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}"))).scalar()
+        nodes = []
+        stack = [plan[0]["Plan"]]
+        while stack:
+            node = stack.pop()
+            nodes.append(f"{node['Node Type']}:{node.get('Index Name', '')}".rstrip(":"))
+            stack.extend(node.get("Plans", ()))
+        ctx.recorder.extra["list_page_plan"] = nodes
+
+
+async def activate(ctx: Context):
+    """Конкурентные активации: ни один UNIQUE-код не выдан дважды, выдано ровно max_count, рост с числом воркеров.
+
+    Аренды квоты (counters.py) делятся между процессами только в --mode gunicorn или с --url на gunicorn
+    с 2+ воркерами; в одном процессе проверяется лишь конкуренция корутин. 503 — остаток квоты в арендах
+    других воркеров, это не ошибка, а повод повторить запрос: после фазы такие активации повторяются
+    (drain_quota), пока сервер не ответит 403, и только потом выданное сверяется с max_count.
+    """
+    email = ctx.random_company()
+    headers = ctx.headers[email]
+    results = {}
+    for workers in (1, 4, 16, 64):
+        codes = ctx.args.requests
+        max_count = min(codes, 5000)
+        response = await ctx.client.post(
+            "/business/promo", headers=headers, json=promo_payload(ctx.rng, unique_codes=max_count)
+        )
+        unique_url = f"/business/promo/{response.json()['id']}/activate"
+        handed_out = []
+        rejected = 0
+
+        async def claim(i):
+            nonlocal rejected
+            response = await ctx.request(
+                f"activate-unique-x{workers}", "POST", unique_url, expect=(200, 403, 503), headers=headers,
+            )
+            if response.status_code == 200:
+                handed_out.append(response.json()["promo"])
+            rejected += response.status_code == 503
+
+        started = time.perf_counter()
+        await ctx.recorder.phase(f"activate-unique-x{workers}", codes + codes // 10, workers, claim)
+        elapsed = time.perf_counter() - started
+        phase_handed_out = len(handed_out)
+        drained = True
+        if rejected and len(handed_out) < max_count:
+            drained = await drain_quota(
+                ctx, f"activate-unique-x{workers}-retry", unique_url, headers,
+                lambda response: handed_out.append(response.json()["promo"]),
+            )
+        duplicates = len(handed_out) - len(set(handed_out))
+        results[f"x{workers}"] = {
+            "handed_out": len(handed_out),
+            "rejected_503": rejected,
+            "duplicates": duplicates,
+            "activations_per_sec": round(phase_handed_out / elapsed, 1),
+        }
+        if duplicates:
+            ctx.recorder.fail("activate", f"x{workers}: {duplicates} UNIQUE-кодов выдано повторно")
+        if not drained:
+            ctx.recorder.fail("activate", f"x{workers}: квота не выбрана за {RETRY_TIMEOUT:g} с повторов после 503")
+        elif len(handed_out) != max_count:
+            ctx.recorder.fail("activate", f"x{workers}: выдано {len(handed_out)} кодов при max_count {max_count}")
+
+    common = await ctx.client.post(
+        "/business/promo", headers=headers, json={**promo_payload(ctx.rng), "max_count": ctx.args.requests}
+    )
+    common_url = f"/business/promo/{common.json()['id']}/activate"
+    granted = rejected = 0
+
+    async def activate_common(i):
+        nonlocal granted, rejected
+        response = await ctx.request(
+            "activate-common", "POST", common_url, expect=(200, 403, 503), headers=headers,
+        )
+        granted += response.status_code == 200
+        rejected += response.status_code == 503
+
+    def granted_common(response):
+        nonlocal granted
+        granted += 1
+
+    await ctx.recorder.phase("activate-common", ctx.args.requests * 2, ctx.args.concurrency, activate_common)
+    drained = True
+    if rejected and granted < ctx.args.requests:
+        drained = await drain_quota(ctx, "activate-common-retry", common_url, headers, granted_common)
+    ctx.recorder.extra["activate"] = {
+        "unique": results,
+        "common_max_count": ctx.args.requests,
+        "common_granted": granted,
+        "common_rejected_503": rejected,
+    }
+    if not drained:
+        ctx.recorder.fail("activate", f"COMMON: квота не выбрана за {RETRY_TIMEOUT:g} с повторов после 503")
+    elif granted != ctx.args.requests:
+        ctx.recorder.fail("activate", f"COMMON: выдано {granted} активаций при max_count {ctx.args.requests}")
+
+
+async def stat_rollups(ctx: Context):
+    """/stat по роллапам против прямого GROUP BY по журналу активаций."""
+    if not ctx.in_process:
+        return
+    from sqlalchemy import create_engine, func, select, text
+    from sqlalchemy.pool import NullPool
+    from database import DATABASE_URL, PromoActivation, open_session
+    import counters
+    import stats
+
+    email, promo_id = ctx.random_promo()
+    events = ctx.args.events
+    async with open_session() as db:
+        await db.execute(
+            text(
+                "INSERT INTO promo_activations (promo_id, country, activated_at) "
+                "SELECT :promo_id, (ARRAY['ru','us','de','fr','kz'])[1 + n % 5], "
+                "now() AT TIME ZONE 'utc' - make_interval(secs => n % 2592000) "
+                "FROM generate_series(1, :events) AS n"
+            ),
+            {"promo_id": promo_id, "events": events},
+        )
+        await db.commit()
+    await counters.flush()
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    with engine.begin() as connection:
+        stats.rebuild_rollups(connection, promo_id)
+    engine.dispose()
+
+    async def via_rollups(i):
+        await ctx.request("stat-rollups", "GET", f"/business/promo/{promo_id}/stat", headers=ctx.headers[email])
+
+    raw_query = (
+        select(PromoActivation.country, func.count())
+        .where(PromoActivation.promo_id == promo_id)
+        .group_by(PromoActivation.country)
+    )
+    raw_samples = []
+
+    async def raw_scan(i):
+        started = time.perf_counter()
+        async with open_session() as db:
+            (await db.execute(raw_query)).all()
+        raw_samples.append(time.perf_counter() - started)
+
+    repeats = max(5, ctx.args.requests // 10)
+    await ctx.recorder.phase("stat-rollups", repeats, 1, via_rollups)
+    await ctx.recorder.phase("stat-raw-scan", repeats, 1, raw_scan)
+    ctx.recorder.samples["stat-raw-scan"].extend(raw_samples)
+    ctx.recorder.statuses["stat-raw-scan"]["200"] = len(raw_samples)
+    ctx.recorder.extra["stat_events"] = events
+
+
+async def batch(ctx: Context):
+    """Строк в секунду: POST /business/promo/batch против поштучного POST /business/promo."""
+    email = ctx.random_company()
+    headers = ctx.headers[email]
+    rows = ctx.args.requests
+    single_rows = max(1, rows // 10)
+
+    started = time.perf_counter()
+    await ctx.request(
+        "create-batch", "POST", "/business/promo/batch", expect=(201,),
+        headers=headers, json=[promo_payload(ctx.rng) for _ in range(rows)],
+    )
+    batch_rate = rows / (time.perf_counter() - started)
+
+    async def create(i):
+        await ctx.request("create-single", "POST", "/business/promo", expect=(201,), headers=headers, json=promo_payload(ctx.rng))
+
+    started = time.perf_counter()
+    await ctx.recorder.phase("create-single", single_rows, ctx.args.concurrency, create)
+    single_rate = single_rows / (time.perf_counter() - started)
+    ctx.recorder.extra["batch"] = {
+        "batch_rows_per_sec": round(batch_rate, 1),
+        "single_rows_per_sec": round(single_rate, 1),
+    }
+
+
+async def export(ctx: Context):
+    """Потоковый экспорт: строк в секунду и RSS до, во время и после.
+
+    В режиме asgi запросы идут через сокет (harness.socket_client): ASGITransport буферизовал бы
+    ответ целиком. RSS меряется только у приложения в этом процессе; рост больше --export-rss-mb
+    за один экспорт значит, что ответ копится в памяти, и роняет прогон.
+    """
+    email = max(ctx.promos, key=lambda key: len(ctx.promos[key]))
+    result = {}
+    async with AsyncExitStack() as stack:
+        client = ctx.client
+        if ctx.in_process and ctx.args.mode == "asgi":
+            client = await stack.enter_async_context(socket_client())
+        for export_format in ("ndjson", "csv"):
+            rows = 0
+            rss_before = rss_peak = rss_mb()
+            started = time.perf_counter()
+            async with client.stream(
+                "GET", "/business/promo/export", headers=ctx.headers[email], params={"format": export_format}
+            ) as response:
+                async for _ in response.aiter_lines():
+                    rows += 1
+                    if rows % 1000 == 0:
+                        rss_peak = max(rss_peak, rss_mb())
+            elapsed = time.perf_counter() - started
+            rss_peak = max(rss_peak, rss_mb())
+            ctx.recorder.samples[f"export-{export_format}"].append(elapsed)
+            ctx.recorder.statuses[f"export-{export_format}"][response.status_code] += 1
+            result[export_format] = {
+                "rows": rows,
+                "rows_per_sec": round(rows / elapsed, 1),
+            }
+            if not ctx.in_process:
+                continue
+            result[export_format].update({
+                "rss_before_mb": round(rss_before, 1),
+                "rss_peak_mb": round(rss_peak, 1),
+            })
+            if rss_peak - rss_before > ctx.args.export_rss_mb:
+                ctx.recorder.fail(
+                    "export",
+                    f"{export_format}: RSS вырос на {rss_peak - rss_before:.1f} МБ за {rows} строк "
+                    f"(допустимо {ctx.args.export_rss_mb} МБ)",
+                )
+    ctx.recorder.extra["export"] = result
+
+
+async def conditional(ctx: Context):
+    """Опрос дашборда: полные ответы против If-None-Match/304, в байтах и латентности."""
+    email, promo_id = ctx.random_promo()
+    headers = ctx.headers[email]
+    sent = {"get-full": 0, "get-conditional": 0, "list-full": 0, "list-conditional": 0}
+    etag = (await ctx.client.get(f"/business/promo/{promo_id}", headers=headers)).headers.get("etag")
+    list_etag = (await ctx.client.get("/business/promo", headers=headers)).headers.get("etag")
+
+    async def poll(i):
+        response = await ctx.request("get-full", "GET", f"/business/promo/{promo_id}", headers=headers)
+        sent["get-full"] += len(response.content)
+        response = await ctx.request(
+            "get-conditional", "GET", f"/business/promo/{promo_id}", expect=(304,),
+            headers={**headers, "If-None-Match": etag},
+        )
+        sent["get-conditional"] += len(response.content)
+        response = await ctx.request("list-full", "GET", "/business/promo", headers=headers)
+        sent["list-full"] += len(response.content)
+        response = await ctx.request(
+            "list-conditional", "GET", "/business/promo", expect=(304,),
+            headers={**headers, "If-None-Match": list_etag},
+        )
+        sent["list-conditional"] += len(response.content)
+
+    await ctx.recorder.phase("conditional", ctx.args.requests, ctx.args.concurrency, poll)
+    ctx.recorder.extra["conditional_body_bytes"] = sent
+
+
+async def compression(ctx: Context):
+    """Опрос страницы списка из 100 промокодов: байты на проводе и процессорное время на запрос
+    без сжатия и с каждой кодировкой, со сжатием на каждый запрос и из кэша по ETag."""
+    if not ctx.in_process:
+        return
+    from prometheus_client import REGISTRY
+    import compression as compression_module
+
+    email = max(ctx.promos, key=lambda key: len(ctx.promos[key]))
+    params = {"limit": 100}
+    variants = [("identity", "identity", True)]
+    for encoding in compression_module.PREFERENCE:
+        variants += [(f"{encoding}-nocache", encoding, False), (f"{encoding}-cached", encoding, True)]
+
+    def compressing_seconds(encoding):
+        # Только время самого сжатия, по счётчику middleware.
+        return REGISTRY.get_sample_value("http_compression_cpu_seconds_total", {"encoding": encoding}) or 0.0
+
+    cache = compression_module._cache
+    limit = cache.limit
+    results = {}
+    for name, encoding, cached in variants:
+        cache.entries.clear()
+        cache.size = 0
+        cache.limit = limit if cached else 0
+        headers = {**ctx.headers[email], "Accept-Encoding": encoding}
+        wire = 0
+        compressing = compressing_seconds(encoding)
+        started = time.process_time()
+        for _ in range(ctx.args.requests):
+            response = await ctx.request(f"poll-{name}", "GET", "/business/promo", headers=headers, params=params)
+            wire += response.num_bytes_downloaded
+        results[name] = {
+            "wire_bytes_per_request": wire // ctx.args.requests,
+            "body_bytes": len(response.content),
+            "cpu_ms_per_request": round((time.process_time() - started) / ctx.args.requests * 1000, 3),
+            "compress_cpu_ms_per_request": round(
+                (compressing_seconds(encoding) - compressing) / ctx.args.requests * 1000, 3
+            ),
+        }
+    cache.limit = limit
+    ctx.recorder.extra["compression"] = results
+
+
+async def serialize(ctx: Context):
+    """Сериализация страницы из 100 строк: Pydantic + JSONResponse против строк напрямую в orjson."""
+    if not ctx.in_process:
+        return
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from sqlalchemy import select
+    from database import PromoCode, open_session
+    from main import PROMO_LIST_COLUMNS
+    from models import PromoListItem
+    from utility import FastJSONResponse
+
+    async with open_session() as db:
+        rows = (await db.execute(select(*PROMO_LIST_COLUMNS).limit(100))).all()
+    repeats = max(10, ctx.args.requests)
+    timings = {}
+    for name, render in (
+        ("pydantic_json", lambda: JSONResponse(jsonable_encoder([PromoListItem(**row._asdict()) for row in rows]))),
+        ("rows_orjson", lambda: FastJSONResponse([row._asdict() for row in rows])),
+    ):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            render()
+        timings[name] = round((time.perf_counter() - started) / repeats * 1000, 3)
+    ctx.recorder.extra["serialize_ms_per_page"] = {"rows": len(rows), **timings}
+
+
+async def schedule(ctx: Context):
+    """Флаг active под планировщиком: переходы по управляемым часам и стоимость запроса ленты,
+    когда 90% промокодов истекли (частичный индекс по active против фильтра только по окну)."""
+    if not ctx.in_process:
+        return
+    from datetime import datetime, timedelta
+    import psycopg2
+    from sqlalchemy import and_, delete, insert, select
+    from database import DATABASE_URL, Company, PromoCode, open_session
+    from scheduler import SCHEDULER_RETRY, Scheduler, is_live
+    from targeting import feed_filter, target_columns
+    from utility import utcnow
+
+    email = ctx.random_company()
+    now = utcnow()
+    total = ctx.args.promos * 10
+    async with open_session() as db:
+        company_id = await db.scalar(select(Company.id).where(Company.email == email))
+
+        def row(i):
+            expired = i % 10 != 0
+            target = {"country": ctx.rng.choice(COUNTRIES), "categories": ctx.rng.sample(CATEGORIES, 2)}
+            active_from = now - timedelta(days=60)
+            active_until = now - timedelta(days=ctx.rng.randint(1, 30)) if expired else datetime(2099, 1, 1)
+            return {
+                "company_id": company_id, "mode": "COMMON", "promo_common": "BENCH",
+                "description": f"Schedule benchmark promo {i}", "target": target, **target_columns(target),
+                "max_count": 100, "active_from": active_from, "active_until": active_until,
+                "created_at": now - timedelta(seconds=ctx.rng.randint(0, 86400 * 60)),
+                "active": is_live(active_from, active_until, 0, 100, now),
+            }
+
+        for start in range(0, total, 5000):
+            await db.execute(insert(PromoCode.__table__), [row(i) for i in range(start, min(total, start + 5000))])
+        await db.commit()
+
+    connection = psycopg2.connect(DATABASE_URL)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE promo_codes")
+    connection.close()
+
+    window_only = and_(
+        PromoCode.active_from <= now,
+        PromoCode.active_until >= now,
+        PromoCode.target_countries.overlap(["kz", "*"]),
+        PromoCode.target_categories.overlap(["books", "*"]),
+    )
+    def explain(session, query):
+        # Параметры через драйвер, а не literal_binds: литерал ARRAY[...] теряет тип varchar[].
+        connection = session.connection()
+        compiled = query.compile(dialect=connection.dialect)
+        params = compiled.params
+        if compiled.positiontup is not None:
+            params = tuple(params[name] for name in compiled.positiontup)
+        return connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {compiled}", params).scalar()
+
+    plans = {}
+    async with open_session() as db:
+        for name, condition in (("window_only", window_only), ("live_index", feed_filter(now, country="kz", category="books"))):
+            query = (
+                select(PromoCode.id)
+                .where(condition)
+                .order_by(PromoCode.created_at.desc(), PromoCode.id.desc())
+                .limit(10)
+            )
+            plan = await db.run_sync(explain, query)
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            plan = plan[0]
+            plans[name] = {
+                "execution_ms": plan["Execution Time"],
+                "buffers": plan["Plan"].get("Shared Hit Blocks", 0) + plan["Plan"].get("Shared Read Blocks", 0),
+            }
+
+    # Управляемые часы в 2090 году: проверочный планировщик ограничен одним промокодом (scope),
+    # иначе он закрыл бы все живые промокоды в базе. Фоновый планировщик приложения на реальных
+    # часах окно 2090 года не откроет.
+    start = datetime(2090, 1, 1)
+    clock = [start]
+    async with open_session() as db:
+        promo_id = (await db.scalars(insert(PromoCode.__table__).returning(PromoCode.id), [{
+            **row(1), "active_from": start + timedelta(seconds=10), "active_until": start + timedelta(seconds=20),
+            "active": False,
+        }])).one()
+        await db.commit()
+    scheduler = Scheduler(clock=lambda: clock[0], horizon=60, scope=PromoCode.id == promo_id)
+
+    async def active():
+        async with open_session() as db:
+            return await db.scalar(select(PromoCode.active).where(PromoCode.id == promo_id))
+
+    async def run_due():
+        # Advisory-блокировку переходов может держать фоновый планировщик приложения.
+        while await scheduler.run_due() is None:
+            await asyncio.sleep(SCHEDULER_RETRY)
+
+    checks = {}
+    await run_due()
+    checks["closed_before_window"] = not await active()
+    checks["wakes_at_opening"] = abs(scheduler._next_delay() - 10.001) < 1e-6
+    clock[0] = start + timedelta(seconds=10, milliseconds=1)
+    await run_due()
+    checks["opened_at_active_from"] = await active()
+    checks["wakes_at_closing"] = abs(scheduler._next_delay() - 10.0) < 1e-6
+    clock[0] = start + timedelta(seconds=20)
+    await run_due()
+    checks["open_through_active_until"] = await active()
+    clock[0] = start + timedelta(seconds=20, milliseconds=1)
+    await run_due()
+    checks["closed_after_active_until"] = not await active()
+    async with open_session() as db:
+        await db.execute(delete(PromoCode).where(PromoCode.id == promo_id))
+        await db.commit()
+
+    failed = [name for name, passed in checks.items() if not passed]
+    if failed:
+        ctx.recorder.fail("schedule", f"не прошли проверки планировщика: {', '.join(failed)}")
+    ctx.recorder.extra["schedule"] = {"promos": total, "expired_share": 0.9, "feed_plan": plans, "clock_checks": checks}
+
+
+async def search(ctx: Context):
+    """Поиск по промокодам компании (--search-promos строк): ?search= по GIN-индексам против
+    наивного ILIKE '%q%' по описанию и коду."""
+    if not ctx.in_process:
+        return
+    import psycopg2
+    from sqlalchemy import and_, or_, select, text
+    from database import DATABASE_URL, Company, PromoCode, open_session
+    from search import search_filter
+
+    email = ctx.random_company()
+    headers = ctx.headers[email]
+    total = ctx.args.search_promos
+    words = ["summer", "winter", "sale", "discount", "coffee", "pizza", "books", "travel", "tickets",
+             "cashback", "gift", "delivery", "premium", "weekend", "student", "family", "night", "bonus"]
+    async with open_session() as db:
+        company_id = await db.scalar(select(Company.id).where(Company.email == email))
+        # Строки собирает сам Postgres: через API миллион промокодов засевался бы часами.
+        for start in range(0, total, 100_000):
+            await db.execute(text("""
+                INSERT INTO promo_codes (id, company_id, mode, promo_common, description, target, max_count,
+                                         active_from, active_until, created_at, active, like_count, used_count)
+                SELECT gen_random_uuid(), CAST(:company_id AS uuid), 'COMMON',
+                       'PROMO' || upper(substr(md5(g::text), 1, 6)),
+                       words[1 + g % 18] || ' ' || words[1 + (g / 18) % 18] || ' ' || words[1 + (g / 324) % 18] || ' offer ' || g,
+                       '{}'::jsonb, 100, now() - interval '1 day', now() + interval '1 year',
+                       now() - g * interval '1 second', true, 0, 0
+                FROM generate_series(CAST(:start AS integer), CAST(:stop AS integer)) AS g,
+                     (SELECT CAST(:words AS text[]) AS words) AS vocabulary
+            """), {"company_id": company_id, "words": words, "start": start, "stop": min(total, start + 100_000) - 1})
+        await db.commit()
+
+    connection = psycopg2.connect(DATABASE_URL)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE promo_codes")
+    connection.close()
+
+    # Наивный скан по created_at останавливается на первых 20 совпадениях частого слова, но без ранга;
+    # на редких, отсутствующих и подстроках кода он читает все строки компании.
+    queries = {
+        "frequent": "coffee", "prefix": "cashb", "rare": "pizza weekend 7", "code": "PROMO1A2", "none": "qwerty",
+    }
+    for kind, query in queries.items():
+        for _ in range(max(1, ctx.args.requests // len(queries))):
+            await ctx.request(f"search-{kind}", "GET", "/business/promo", headers=headers, params={"search": query, "limit": 20})
+
+    def explain(session, statement):
+        connection = session.connection()
+        compiled = statement.compile(dialect=connection.dialect)
+        params = compiled.params
+        if compiled.positiontup is not None:
+            params = tuple(params[name] for name in compiled.positiontup)
+        plan = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {compiled}", params).scalar()
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    plans = {}
+    async with open_session() as db:
+        for kind, query in queries.items():
+            match, rank = search_filter(query)
+            pattern = f"%{query}%"
+            statements = {
+                "naive_ilike": select(PromoCode.id).where(
+                    PromoCode.company_id == company_id,
+                    or_(PromoCode.description.ilike(pattern), PromoCode.promo_common.ilike(pattern)),
+                ).order_by(PromoCode.created_at.desc(), PromoCode.id.desc()).limit(20),
+                "indexed": select(PromoCode.id).where(and_(PromoCode.company_id == company_id, match))
+                .order_by(rank.desc(), PromoCode.id.desc()).limit(20),
+            }
+            plans[kind] = {"query": query}
+            for name, statement in statements.items():
+                plan = (await db.run_sync(explain, statement))[0]
+                plans[kind][name] = {
+                    "execution_ms": plan["Execution Time"],
+                    "buffers": plan["Plan"].get("Shared Hit Blocks", 0) + plan["Plan"].get("Shared Read Blocks", 0),
+                }
+    ctx.recorder.extra["search"] = {"promos": total, "plans": plans}
+
+
+async def partitions(ctx: Context):
+    """Хэш-секции promo_codes: каждый SQL-запрос эндпоинтов кабинета и фоновых писателей counters.py к
+    promo_codes читает не больше одной секции (EXPLAIN перехваченных запросов), и латентность запросов
+    одной компании по мере роста общего числа строк за счёт других компаний (--partition-rows)."""
+    if not ctx.in_process:
+        return
+    import re
+    from contextvars import ContextVar
+    from datetime import timedelta
+    import psycopg2
+    from sqlalchemy import event, insert, select, text, update
+    import counters
+    import database
+    import querystats
+    from cache import promo_cache
+    from database import DATABASE_URL, Company, PromoCode, PromoLease, open_session
+    from utility import utcnow
+
+    email = max(ctx.promos, key=lambda key: len(ctx.promos[key]))
+    headers = ctx.headers[email]
+    promo_id = ctx.promos[email][0]
+    touches_promos = re.compile(r"\bpromo_codes\b")
+    partition = re.compile(r"^promo_codes_p\d+$")
+
+    captured = []
+    # Фоновые задачи приложения (планировщик переключает окна по всем компаниям) не перехватываются:
+    # только запросы обработчиков (QueryStats) и писателей counters.py, вызванных здесь же.
+    background = ContextVar("partitions_background", default=False)
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if (querystats.current() is not None or background.get()) and touches_promos.search(statement):
+            captured.append((statement, parameters[0] if executemany and isinstance(parameters, list) else parameters))
+
+    async def capture_background(name, writer):
+        captured.clear()
+        token = background.set(True)
+        try:
+            await writer()
+        finally:
+            background.reset(token)
+        pruning[name] = list(captured)
+
+    def explain(session, statement, parameters):
+        # INSERT ничего не сканирует: строки раскладываются по секциям при вставке.
+        if statement.lstrip().upper().startswith("INSERT"):
+            return 0
+        plan = session.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        scanned = set()
+        stack = [plan[0]["Plan"]]
+        while stack:
+            node = stack.pop()
+            if partition.match(node.get("Relation Name", "")):
+                scanned.add(node["Relation Name"])
+            stack.extend(node.get("Plans", ()))
+        return len(scanned)
+
+    calls = [
+        ("create", "POST", "/business/promo", {"json": promo_payload(ctx.rng)}, (201,)),
+        ("batch", "POST", "/business/promo/batch", {"json": [promo_payload(ctx.rng) for _ in range(3)]}, (201,)),
+        ("list", "GET", "/business/promo", {"params": {"limit": 5}}, (200,)),
+        ("list-search", "GET", "/business/promo", {"params": {"search": "bench", "limit": 5}}, (200,)),
+        ("get", "GET", f"/business/promo/{promo_id}", {}, (200,)),
+        ("get-conditional", "GET", f"/business/promo/{promo_id}", {"headers": {"If-None-Match": '"0.0.0"'}}, (200,)),
+        ("patch", "PATCH", f"/business/promo/{promo_id}", {"json": {"description": "Partition pruning check"}}, (200,)),
+        ("stat", "GET", f"/business/promo/{promo_id}/stat", {}, (200,)),
+        ("activate", "POST", f"/business/promo/{promo_id}/activate", {}, (200, 403, 503)),
+        ("export", "GET", "/business/promo/export", {}, (200,)),
+    ]
+    pruning = {}
+    # Без кэша чтений (cache.py): иначе попадания в него не доходят до SQL и проверять нечего.
+    cache_ttl, cache_remote = promo_cache.ttl, promo_cache.remote
+    promo_cache.ttl, promo_cache.remote = 0, None
+    for engine in database.engines.values():
+        event.listen(engine, "before_cursor_execute", capture)
+    try:
+        for name, method, url, kwargs, expect in calls:
+            captured.clear()
+            response = await ctx.request(
+                f"pruning-{name}", method, url, expect=expect, headers={**headers, **kwargs.pop("headers", {})}, **kwargs
+            )
+            statements = list(captured)
+            if name == "list" and response.headers.get("x-next-cursor"):
+                captured.clear()
+                await ctx.request("pruning-list-cursor", "GET", url, headers=headers,
+                                  params={"limit": 5, "cursor": response.headers["x-next-cursor"]})
+                pruning["list-cursor"] = list(captured)
+            pruning[name] = statements
+
+        # Пакетный UPDATE сброса счётчиков и close_exhausted в его транзакции. Под _flush_lock, чтобы
+        # дельту активации не забрал фоновый сброс.
+        async with counters._flush_lock:
+            await ctx.request(
+                "pruning-activate", "POST", f"/business/promo/{promo_id}/activate", expect=(200, 403, 503), headers=headers
+            )
+            await capture_background("flush", counters._flush)
+        # Возврат аренды «умершего» воркера: leased_count сперва растёт на её размер.
+        async with open_session() as db:
+            company_id = await db.scalar(select(Company.id).where(Company.email == email))
+            await db.execute(insert(PromoLease).values(
+                promo_id=uuid.UUID(promo_id), worker=uuid.uuid4(), company_id=company_id, held=1,
+                expires_at=utcnow() - timedelta(days=1),
+            ))
+            await db.execute(
+                update(PromoCode)
+                .where(PromoCode.id == promo_id, PromoCode.company_id == company_id)
+                .values(leased_count=PromoCode.leased_count + 1)
+            )
+            await db.commit()
+        await capture_background("reclaim", counters._reclaim)
+    finally:
+        for engine in database.engines.values():
+            event.remove(engine, "before_cursor_execute", capture)
+        promo_cache.ttl, promo_cache.remote = cache_ttl, cache_remote
+
+    checks = {}
+    async with open_session() as db:
+        for name, statements in pruning.items():
+            scanned = [await db.run_sync(explain, statement, parameters) for statement, parameters in statements]
+            checks[name] = {"statements": len(scanned), "max_partitions_scanned": max(scanned, default=0)}
+            if not scanned:
+                ctx.recorder.fail("partitions", f"{name}: нет запросов к promo_codes, проверять нечего")
+            elif max(scanned) > 1:
+                ctx.recorder.fail("partitions", f"{name}: запрос читает {max(scanned)} секций promo_codes")
+
+    # Чужие строки: компании и промокоды генерирует сам Postgres, id компаний детерминированы.
+    prefix = f"bench-filler-{ctx.run_id}-"
+    fillers = 1000
+    async with open_session() as db:
+        await db.execute(text("""
+            INSERT INTO companies (id, name, email, password)
+            SELECT md5(CAST(:prefix AS text) || i)::uuid, 'Filler ' || i, CAST(:prefix AS text) || i || '@bench.example.com', '-'
+            FROM generate_series(0, CAST(:fillers AS integer) - 1) AS i
+        """), {"prefix": prefix, "fillers": fillers})
+        total = await db.scalar(text("SELECT count(*) FROM promo_codes"))
+        count = await db.scalar(text("SELECT count(*) FROM pg_inherits WHERE inhparent = 'promo_codes'::regclass"))
+        await db.commit()
+
+    steps = {}
+    for target in sorted(int(value) for value in ctx.args.partition_rows.split(",")):
+        async with open_session() as db:
+            for start in range(total, target, 100_000):
+                await db.execute(text("""
+                    INSERT INTO promo_codes (id, company_id, mode, promo_common, description, target, max_count,
+                                             active_from, active_until, created_at, active, like_count, used_count)
+                    SELECT gen_random_uuid(), md5(CAST(:prefix AS text) || (g % CAST(:fillers AS integer)))::uuid, 'COMMON', 'FILL' || g,
+                           'Filler promo number ' || g, '{}'::jsonb, 100, now() - interval '1 day',
+                           now() + interval '1 year', now() - g * interval '1 second', true, 0, 0
+                    FROM generate_series(CAST(:start AS integer), CAST(:stop AS integer)) AS g
+                """), {"prefix": prefix, "fillers": fillers, "start": start, "stop": min(target, start + 100_000) - 1})
+            await db.commit()
+        total = max(total, target)
+        connection = psycopg2.connect(DATABASE_URL)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE promo_codes")
+        connection.close()
+
+        for _ in range(ctx.args.requests):
+            await ctx.request(f"tenant-list@{total}", "GET", "/business/promo", headers=headers, params={"limit": 20})
+            await ctx.request(f"tenant-get@{total}", "GET", f"/business/promo/{promo_id}", headers=headers)
+            await ctx.request(f"tenant-stat@{total}", "GET", f"/business/promo/{promo_id}/stat", headers=headers)
+        steps[total] = {
+            name: round(percentile(sorted(ctx.recorder.samples[f"tenant-{name}@{total}"]), 50) * 1000, 3)
+            for name in ("list", "get", "stat")
+        }
+
+    ctx.recorder.extra["partitions"] = {
+        "partitions": count,
+        "company_id": str(company_id),
+        "pruning": checks,
+        "tenant_p50_ms_by_total_rows": steps,
+    }
+
+
+async def cache(ctx: Context):
+    """Чтения get/stat по горячему набору промокодов с кэшем cache.py: выключен, только LRU воркера,
+    только Redis, оба уровня. Каждая 20-я операция — PATCH и чтение сразу после него (должно видеть
+    запись), отдельно — задержка доставки NOTIFY до сброса записи LRU."""
+    if not ctx.in_process:
+        return
+    from prometheus_client import REGISTRY
+    from cache import notify_statement, promo_cache
+    from database import open_session
+
+    try:
+        import redis.asyncio as redis
+    except ImportError:
+        redis = None
+    standin = None
+    redis_url = ctx.args.redis_url
+    if redis is not None and not redis_url:
+        from bench.redis_standin import RedisStandIn
+
+        standin = RedisStandIn()
+        redis_url = await standin.start()
+
+    hot = [(email, promo_id) for email, ids in ctx.promos.items() for promo_id in ids][:100]
+    n, concurrency = ctx.args.requests * 4, ctx.args.concurrency
+    ttl, remote = promo_cache.ttl, promo_cache.remote
+    variants = [("off", 0, False), ("local", ttl, False)]
+    if redis is not None:
+        variants += [("redis", 0, True), ("local+redis", ttl, True)]
+
+    def cache_reads():
+        return {
+            result: sum(
+                REGISTRY.get_sample_value("promo_cache_requests_total", {"kind": kind, "result": result}) or 0.0
+                for kind in ("promo", "stat")
+            )
+            for result in ("local", "remote", "coalesced", "miss")
+        }
+
+    results = {}
+    for name, variant_ttl, with_redis in variants:
+        promo_cache.ttl = variant_ttl
+        # RESP2: заглушка не умеет HELLO 3.
+        promo_cache.remote = redis.from_url(redis_url, protocol=2) if with_redis else None
+        promo_cache.clear()
+        if standin is not None:
+            standin.data.clear()
+        stale = 0
+
+        async def operate(i):
+            nonlocal stale
+            email, promo_id = hot[ctx.rng.randrange(len(hot))]
+            headers = ctx.headers[email]
+            if i % 20 == 0:
+                response = await ctx.request(
+                    f"{name}-patch", "PATCH", f"/business/promo/{promo_id}", headers=headers,
+                    json={"description": f"Cache benchmark promo {ctx.run_id} {name} {i}"},
+                )
+                written = int(response.headers["etag"].strip('"').split(".")[0])
+                response = await ctx.request(f"{name}-get", "GET", f"/business/promo/{promo_id}", headers=headers)
+                # Соседний PATCH того же промокода мог успеть раньше: сверяем версию, а не описание.
+                if int(response.headers["etag"].strip('W/"').split(".")[0]) < written:
+                    stale += 1
+            elif i % 2:
+                await ctx.request(f"{name}-get", "GET", f"/business/promo/{promo_id}", headers=headers)
+            else:
+                await ctx.request(f"{name}-stat", "GET", f"/business/promo/{promo_id}/stat", headers=headers)
+
+        before = cache_reads()
+        started = time.perf_counter()
+        await ctx.recorder.phase(f"cache-{name}", n, concurrency, operate)
+        elapsed = time.perf_counter() - started
+        reads = {result: count - before[result] for result, count in cache_reads().items()}
+        total = sum(reads.values())
+        results[name] = {
+            "requests_per_s": round((n + n // 20) / elapsed, 2),
+            "hit_ratio": round((total - reads["miss"]) / total, 3) if total else None,
+            **{result: int(count) for result, count in reads.items()},
+            # Чтение сразу после своего PATCH вернуло старое описание: должно быть 0.
+            "read_your_writes_violations": stale,
+        }
+        if promo_cache.remote is not None:
+            await promo_cache.remote.aclose()
+
+    # NOTIFY от «другого воркера»: отдельная транзакция, кэш этого процесса узнаёт о ней только из LISTEN.
+    promo_cache.ttl, promo_cache.remote = ttl, None
+    email, promo_id = hot[0]
+    delays = []
+    for _ in range(20):
+        await ctx.client.get(f"/business/promo/{promo_id}", headers=ctx.headers[email])
+        key = ("promo", uuid.UUID(promo_id))
+        async with open_session() as db:
+            await db.execute(notify_statement([promo_id]))
+            started = time.perf_counter()
+            await db.commit()
+        while key in promo_cache.entries and time.perf_counter() - started < 1:
+            await asyncio.sleep(0.0002)
+        delays.append(time.perf_counter() - started)
+    promo_cache.remote = remote
+    if standin is not None:
+        await standin.stop()
+    ctx.recorder.extra["cache"] = {
+        "hot_promos": len(hot),
+        "redis": "stand-in" if standin is not None else (redis_url or None),
+        "variants": results,
+        # От commit до сброса записи LRU.
+        "notify_p50_ms": round(percentile(sorted(delays), 50) * 1000, 3),
+    }
+
+
+async def replica(ctx: Context):
+    """Чтения кабинета на фоне записей: пропускная способность list/get/stat и read-your-writes.
+    Сравнивается прогон с POSTGRES_REPLICA_HOST и без него (см. README)."""
+    n, concurrency = ctx.args.requests, ctx.args.concurrency
+    stale = 0
+
+    async def write_then_read(i):
+        nonlocal stale
+        email, promo_id = ctx.random_promo()
+        description = f"Replica benchmark promo {ctx.run_id} {i}"
+        response = await ctx.request(
+            "rw-patch", "PATCH", f"/business/promo/{promo_id}", headers=ctx.headers[email],
+            json={"description": description},
+        )
+        token = response.headers.get("x-consistency-token")
+        headers = {**ctx.headers[email], **({"X-Consistency-Token": token} if token else {})}
+        response = await ctx.request("rw-get", "GET", f"/business/promo/{promo_id}", headers=headers)
+        if response.status_code == 200 and response.json()["description"] != description:
+            stale += 1
+
+    async def read(i):
+        email, promo_id = ctx.random_promo()
+        kind = i % 3
+        if kind == 0:
+            await ctx.request("ro-list", "GET", "/business/promo", headers=ctx.headers[email], params={"limit": 20})
+        elif kind == 1:
+            await ctx.request("ro-get", "GET", f"/business/promo/{promo_id}", headers=ctx.headers[email])
+        else:
+            await ctx.request("ro-stat", "GET", f"/business/promo/{promo_id}/stat", headers=ctx.headers[email])
+
+    writers = max(1, concurrency // 4)
+    started = time.perf_counter()
+    await asyncio.gather(
+        ctx.recorder.phase("rw-patch", n // 4, writers, write_then_read),
+        ctx.recorder.phase("ro-reads", n * 2, concurrency - writers or 1, read),
+    )
+    elapsed = time.perf_counter() - started
+    ctx.recorder.extra["replica"] = {
+        "replica": bool(os.getenv("POSTGRES_REPLICA_HOST")),
+        "reads_per_s": round(n * 2 / elapsed, 2),
+        # Чтение сразу после своей записи вернуло старое значение: должно быть 0.
+        "read_your_writes_violations": stale,
+    }
+
+
+async def overload(ctx: Context):
+    """Список промокодов при конкурентности в 8 раз выше --concurrency: p99 обслуженных и отклонённых
+    (429/503 от admission.py) должен оставаться ограниченным, а не расти вместе с очередью к пулу."""
+    by_status = {}
+
+    async def hit(i):
+        email = ctx.random_company()
+        started = time.perf_counter()
+        response = await ctx.client.get("/business/promo", headers=ctx.headers[email], params={"limit": 50})
+        elapsed = time.perf_counter() - started
+        by_status.setdefault(response.status_code, []).append(elapsed)
+        ctx.recorder.statuses["overload"][response.status_code] += 1
+        if response.status_code not in (200, 429, 503):
+            ctx.recorder.errors["overload"] += 1
+        elif response.status_code != 200 and "retry-after" not in response.headers:
+            ctx.recorder.errors["overload"] += 1
+        ctx.recorder.samples["overload"].append(elapsed)
+        if "retry-after" in response.headers:
+            # Клиент, соблюдающий Retry-After; без паузы отклонённые запросы сами занимают event loop.
+            await asyncio.sleep(float(response.headers["retry-after"]))
+
+    concurrency = ctx.args.concurrency * 8
+    await ctx.recorder.phase("overload", ctx.args.requests * 8, concurrency, hit)
+    ctx.recorder.extra["overload"] = {
+        "concurrency": concurrency,
+        **{
+            str(code): {
+                "count": len(samples),
+                "p50_ms": round(percentile(sorted(samples), 50) * 1000, 3),
+                "p99_ms": round(percentile(sorted(samples), 99) * 1000, 3),
+            }
+            for code, samples in sorted(by_status.items())
+        },
+    }
+
+
+SCENARIOS = {
+    "api": api,
+    "hashing": hashing,
+    "feed": feed,
+    "keyset": keyset,
+    "activate": activate,
+    "stat": stat_rollups,
+    "batch": batch,
+    "export": export,
+    "conditional": conditional,
+    "compression": compression,
+    "serialize": serialize,
+    "overload": overload,
+    "replica": replica,
+    "schedule": schedule,
+    "search": search,
+    "partitions": partitions,
+    "cache": cache,
+}
@@ -0,0 +1,69 @@
+import logging
+import os
+import time
+import psycopg2
+from alembic import command
+from alembic.config import Config
+from database import DATABASE_URL, init_db
+
+# Подготовка базы в одном процессе: ожидание Postgres, create_all и alembic upgrade head.
+# Запускается мастером gunicorn до форка воркеров (gunicorn.conf.py) или как `python bootstrap.py`.
+
+DB_WAIT_TIMEOUT = float(os.getenv("DB_WAIT_TIMEOUT", "60"))
+# Ключ pg_advisory_lock: несколько контейнеров не накатывают миграции одновременно.
+MIGRATION_LOCK_ID = 7241700117
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("bootstrap")
+
+
+def wait_for_db(timeout: float = DB_WAIT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            psycopg2.connect(DATABASE_URL, connect_timeout=3).close()
+            return
+        except psycopg2.OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise SystemExit(f"Postgres недоступен: {e}")
+            logger.info("Ожидание Postgres, попытка %s: %s", attempt, str(e).strip())
+            time.sleep(0.5)
+
+
+def _alembic_config() -> Config:
+    # Без alembic.ini: его fileConfig переконфигурировал бы логирование процесса.
+    config = Config()
+    config.set_main_option("script_location", os.path.join(BASE_DIR, "migrations"))
+    return config
+
+
+def migrate():
+    connection = psycopg2.connect(DATABASE_URL)
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        init_db()
+        command.upgrade(_alembic_config(), "head")
+    finally:
+        connection.close()
+
+
+def run() -> dict:
+    timings = {}
+    started = time.perf_counter()
+    wait_for_db()
+    timings["wait_db"] = time.perf_counter() - started
+    mark = time.perf_counter()
+    migrate()
+    timings["migrate"] = time.perf_counter() - mark
+    logger.info("База готова: ожидание %.3f с, миграции %.3f с", timings["wait_db"], timings["migrate"])
+    return timings
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from uuid import UUID
+import orjson
+from sqlalchemy import text
+from listen import listener
+from metrics import PROMO_CACHE_INVALIDATIONS, PROMO_CACHE_REQUESTS
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+# Read-through кэш чтений кабинета (GET /business/promo/{id} и /stat) в два уровня:
+# - LRU воркера с TTL и ограничением по числу записей;
+# - общий Redis-совместимый сервер (PROMO_CACHE_REDIS_URL), если задан.
+# Записи в promo_codes (PATCH, сброс счётчиков, переходы планировщика) в своей транзакции делают
+# NOTIFY promo_cache с id промокодов. Postgres доставляет его всем воркерам только после commit;
+# каждый воркер слушает канал (listen.py) и сбрасывает свои записи LRU. Пока LISTEN
+# не подключён, LRU не используется: пропущенные уведомления не должны оставлять старые записи.
+# В Redis записи не удаляются, а теряют поколение: после commit пишущий воркер делает INCR
+# promo:<id>:gen, запись хранит поколение, при котором её прочитали из базы, и со сменой поколения
+# перестаёт совпадать. Опоздавшая запись с прежним поколением поэтому не может вернуть старые данные.
+# Одновременные промахи одного ключа ждут одну загрузку.
+
+PROMO_CACHE_TTL = float(os.getenv("PROMO_CACHE_TTL", "30"))
+PROMO_CACHE_SIZE = int(os.getenv("PROMO_CACHE_SIZE", "10000"))
+PROMO_CACHE_REDIS_URL = os.getenv("PROMO_CACHE_REDIS_URL")
+PROMO_CACHE_REDIS_TTL = int(os.getenv("PROMO_CACHE_REDIS_TTL", "300"))
+# Медленный Redis не должен тормозить чтения: по таймауту это обычный промах.
+PROMO_CACHE_REDIS_TIMEOUT = float(os.getenv("PROMO_CACHE_REDIS_TIMEOUT", "0.2"))
+
+PROMO_CACHE_CHANNEL = "promo_cache"
+# payload NOTIFY ограничен 8000 байт: id уходят пачками.
+_NOTIFY_CHUNK = 200
+# Поля, которые после JSON в Redis нужно вернуть к типам строки promo_codes.
+_UUID_FIELDS = ("id", "company_id")
+_DATETIME_FIELDS = ("active_from", "active_until", "created_at")
+
+logger = logging.getLogger("cache")
+
+_REMOTE_ERRORS = (OSError, asyncio.TimeoutError) + ((redis.RedisError,) if redis is not None else ())
+
+
+def notify_statement(promo_ids):
+    ids = [str(promo_id) for promo_id in promo_ids]
+    payloads = [",".join(ids[i:i + _NOTIFY_CHUNK]) for i in range(0, len(ids), _NOTIFY_CHUNK)]
+    return text(
+        "SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"
+    ).bindparams(channel=PROMO_CACHE_CHANNEL, payloads=payloads)
+
+
+def _revive(value: dict) -> dict:
+    for field in _UUID_FIELDS:
+        if isinstance(value.get(field), str):
+            value[field] = UUID(value[field])
+    for field in _DATETIME_FIELDS:
+        if isinstance(value.get(field), str):
+            value[field] = datetime.fromisoformat(value[field])
+    return value
+
+
+class PromoCache:
+    """Значение кэша — (данные, позиция WAL primary до их чтения): чтение с X-Consistency-Token
+    новее позиции записи идёт мимо кэша (consistency.token_position)."""
+
+    def __init__(self, ttl: float = PROMO_CACHE_TTL, size: int = PROMO_CACHE_SIZE, remote_ttl: int = PROMO_CACHE_REDIS_TTL):
+        self.ttl = ttl
+        self.size = size
+        self.remote = None
+        self.remote_ttl = remote_ttl
+        self._remote_ok = True
+        # (вид, id) -> (данные, позиция, момент истечения); порядок — последнее обращение.
+        self.entries: dict = {}
+        self.listening = False
+        self._loading: dict = {}
+        # Ключи, сброшенные во время загрузки: её результат не кладётся ни в один уровень.
+        self._dropped: set = set()
+        # id, записанные этим воркером, чьё поколение в Redis ещё не выросло: Redis для них не читается.
+        self._writing = Counter()
+
+    @property
+    def local_enabled(self) -> bool:
+        return self.ttl > 0 and self.size > 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.local_enabled or self.remote is not None
+
+    async def fetch(self, kind: str, promo_id, load, position: int = 0):
+        """Данные из кэша или из load(); load возвращает (данные, позиция) или None, если строки нет.
+        None не кэшируется."""
+        key = (kind, promo_id)
+        entry = self._get_local(key)
+        if entry is not None and entry[1] >= position:
+            PROMO_CACHE_REQUESTS.labels(kind, "local").inc()
+            return entry[0]
+
+        loading = self._loading.get(key)
+        while loading is not None:
+            try:
+                result = await asyncio.shield(loading)
+            except asyncio.CancelledError:
+                if not loading.cancelled():
+                    raise
+                # Отменили запрос, который загружал ключ, а не этот: загружаем сами.
+                loading = self._loading.get(key)
+                continue
+            # None — промокода нет для компании загружавшего запроса, у этого она может быть другой.
+            if result is not None and result[1] >= position:
+                PROMO_CACHE_REQUESTS.labels(kind, "coalesced").inc()
+                return result[0]
+            return await self._load(key, load, position, register=False)
+        return await self._load(key, load, position, register=True)
+
+    async def _load(self, key, load, position: int, register: bool):
+        kind, promo_id = key
+        future = asyncio.get_running_loop().create_future()
+        if register:
+            self._loading[key] = future
+        try:
+            if self._writing[promo_id]:
+                result, generation = None, None
+            else:
+                result, generation = await self._get_remote(kind, promo_id)
+            if result is not None and result[1] >= position:
+                source = "remote"
+            else:
+                source = "miss"
+                result = await load()
+                if result is not None and key not in self._dropped:
+                    await self._put_remote(kind, promo_id, result, generation)
+            if result is not None and key not in self._dropped:
+                self._put_local(key, result)
+            PROMO_CACHE_REQUESTS.labels(kind, source).inc()
+            future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Ждущих может не быть: помечаем исключение полученным, чтобы asyncio не ругался в лог.
+            future.exception()
+            raise
+        finally:
+            if register:
+                del self._loading[key]
+                self._dropped.discard(key)
+        return None if result is None else result[0]
+
+    def _get_local(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or not self.listening or entry[2] <= time.monotonic():
+            return None
+        # pop + вставка держит словарь в порядке последнего обращения.
+        self.entries[key] = entry
+        return entry
+
+    def _put_local(self, key, result):
+        if not self.local_enabled or not self.listening:
+            return
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.size:
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = (result[0], result[1], time.monotonic() + self.ttl)
+
+    @staticmethod
+    def _generation_key(promo_id) -> str:
+        return f"promo:{promo_id}:gen"
+
+    @staticmethod
+    def _value_key(kind: str, promo_id) -> str:
+        return f"promo:{promo_id}:{kind}"
+
+    async def _get_remote(self, kind: str, promo_id):
+        """((данные, позиция) или None, поколение); поколение None — Redis недоступен, не писать."""
+        if self.remote is None:
+            return None, None
+        try:
+            generation, data = await self.remote.mget(self._generation_key(promo_id), self._value_key(kind, promo_id))
+        except _REMOTE_ERRORS as exc:
+            self._remote_failed(exc)
+            return None, None
+        self._remote_recovered()
+        generation = int(generation or 0)
+        if data is not None:
+            entry = orjson.loads(data)
+            if entry["generation"] == generation:
+                return (_revive(entry["value"]), entry["position"]), generation
+        return None, generation
+
+    async def _put_remote(self, kind: str, promo_id, result, generation):
+        if self.remote is None or generation is None:
+            return
+        # default=str: UUID asyncpg — не uuid.UUID, orjson его сам не пишет.
+        data = orjson.dumps({"generation": generation, "position": result[1], "value": result[0]}, default=str)
+        try:
+            await self.remote.set(self._value_key(kind, promo_id), data, ex=self.remote_ttl)
+        except _REMOTE_ERRORS as exc:
+            self._remote_failed(exc)
+
+    def _remote_failed(self, exc):
+        # В лог — только смена состояния, а не каждое чтение, пока Redis лежит.
+        if self._remote_ok:
+            logger.warning("Redis кэша промокодов недоступен, чтения идут в базу: %s", exc)
+            self._remote_ok = False
+
+    def _remote_recovered(self):
+        if not self._remote_ok:
+            logger.info("Redis кэша промокодов снова доступен")
+            self._remote_ok = True
+
+    async def publish(self, db, promo_ids):
+        """В транзакции записи, до commit."""
+        if promo_ids and self.local_enabled:
+            await db.execute(notify_statement(promo_ids))
+
+    async def invalidate(self, promo_ids):
+        """После commit записи: свой LRU сбрасывается сразу, не дожидаясь NOTIFY; в Redis растёт поколение.
+        Всё до первого await выполняется синхронно в момент вызова, так что сразу после commit у этого
+        воркера не остаётся окна, где видна старая запись: ни в LRU, ни в Redis до INCR."""
+        if not promo_ids:
+            return
+        self.drop(promo_ids)
+        PROMO_CACHE_INVALIDATIONS.labels("write").inc(len(promo_ids))
+        if self.remote is None:
+            return
+        self._writing.update(promo_ids)
+        try:
+            async with self.remote.pipeline(transaction=False) as pipe:
+                for promo_id in promo_ids:
+                    key = self._generation_key(promo_id)
+                    pipe.incr(key)
+                    # Поколение живёт дольше записей: иначе после его истечения старая запись совпала бы снова.
+                    pipe.expire(key, self.remote_ttl * 2)
+                await pipe.execute()
+        except _REMOTE_ERRORS as exc:
+            logger.error("Не удалось сменить поколение в Redis, записи устареют по TTL: %s", exc)
+        finally:
+            self._writing.subtract(promo_ids)
+            for promo_id in promo_ids:
+                if self._writing.get(promo_id, 0) <= 0:
+                    self._writing.pop(promo_id, None)
+
+    def drop(self, promo_ids):
+        for promo_id in promo_ids:
+            for key in (("promo", promo_id), ("stat", promo_id)):
+                self.entries.pop(key, None)
+                if key in self._loading:
+                    self._dropped.add(key)
+
+    def clear(self):
+        self.entries.clear()
+        self._dropped.update(self._loading)
+
+    def _on_notify(self, payloads):
+        promo_ids = {UUID(promo_id) for payload in payloads for promo_id in payload.split(",")}
+        self.drop(promo_ids)
+        PROMO_CACHE_INVALIDATIONS.labels("notify").inc(len(promo_ids))
+
+    def _set_listening(self, listening: bool):
+        # И при подключении, и при обрыве: уведомления между ними потеряны.
+        self.listening = listening
+        self.clear()
+
+    def start(self):
+        if PROMO_CACHE_REDIS_URL and self.remote is None:
+            if redis is None:
+                logger.warning("PROMO_CACHE_REDIS_URL задан, но пакет redis не установлен: общий уровень выключен")
+            else:
+                self.remote = redis.from_url(
+                    PROMO_CACHE_REDIS_URL,
+                    socket_timeout=PROMO_CACHE_REDIS_TIMEOUT,
+                    socket_connect_timeout=PROMO_CACHE_REDIS_TIMEOUT,
+                )
+        # До listener.start(): канал слушается с подключения.
+        if self.local_enabled:
+            listener.subscribe(PROMO_CACHE_CHANNEL, self._on_notify, self._set_listening)
+
+    async def stop(self):
+        self._set_listening(False)
+        if self.remote is not None:
+            await self.remote.aclose()
+            self.remote = None
+
+
+promo_cache = PromoCache()
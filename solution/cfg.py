@@ -1,11 +1,35 @@
+import os
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt",], deprecated="auto")
+# Стоимость bcrypt настраивается из окружения; старые хэши с другой стоимостью продолжают проверяться.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt",], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Число воркеров gunicorn (см. gunicorn.conf.py); при запуске одним uvicorn — 1.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Пул процессов для bcrypt: ядра делятся между воркерами, очередь ограничена, лишние запросы получают 503.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", str(HASH_WORKERS * 4)))
+
+# Максимум промокодов в одном POST /business/promo/batch.
+PROMO_BATCH_LIMIT = int(os.getenv("PROMO_BATCH_LIMIT", "5000"))
+# Максимум уникальных кодов (promo_unique) во всех промокодах одного batch: по 5000 кодов на промокод
+# PROMO_BATCH_LIMIT промокодов дали бы миллионы строк в одной транзакции.
+PROMO_BATCH_CODES_LIMIT = int(os.getenv("PROMO_BATCH_CODES_LIMIT", "50000"))
+
+# Сколько /readyz ждёт ответа базы, секунды.
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
 
 
 secret_key = ("2a4dbcdf4014f940f11fe4848b765906eb764f24f53598a0adc2bfe8bc400467")
 alg = "HS256"
 
+# Кэш проверенных токенов: запись живёт не дольше TTL и не дольше exp самого токена.
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
 
 
 
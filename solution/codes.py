@@ -0,0 +1,46 @@
+from collections import defaultdict
+from sqlalchemy import select, update, insert
+from database import PromoUniqueCode
+from utility import utcnow
+
+
+async def insert_unique_codes(db, promo_id, codes: list[str]):
+    await insert_code_pools(db, {promo_id: codes})
+
+
+async def insert_code_pools(db, pools: dict):
+    # Один executemany: SQLAlchemy склеивает его в многострочные INSERT ... VALUES пачками.
+    rows = [{"promo_id": promo_id, "code": code} for promo_id, codes in pools.items() for code in codes or ()]
+    if rows:
+        await db.execute(insert(PromoUniqueCode), rows)
+
+
+async def load_unique_codes(db, promo_ids) -> dict:
+    codes = defaultdict(list)
+    if promo_ids:
+        rows = await db.execute(
+            select(PromoUniqueCode.promo_id, PromoUniqueCode.code)
+            .where(PromoUniqueCode.promo_id.in_(promo_ids))
+            .order_by(PromoUniqueCode.id)
+        )
+        for promo_id, code in rows:
+            codes[promo_id].append(code)
+    return codes
+
+
+async def claim_unique_code(db, promo_id):
+    # SKIP LOCKED: конкурентные активации разбирают разные свободные строки и не ждут друг друга.
+    free_code = (
+        select(PromoUniqueCode.id)
+        .where(PromoUniqueCode.promo_id == promo_id, PromoUniqueCode.claimed_at.is_(None))
+        .order_by(PromoUniqueCode.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    return await db.scalar(
+        update(PromoUniqueCode)
+        .where(PromoUniqueCode.id == free_code)
+        .values(claimed_at=utcnow())
+        .returning(PromoUniqueCode.code)
+    )
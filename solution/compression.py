@@ -0,0 +1,171 @@
+import gzip
+import os
+import time
+from metrics import COMPRESSION_BYTES, COMPRESSION_CACHE, COMPRESSION_SECONDS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Сжатие ответов: gzip всегда, br и zstd — если установлены пакеты brotli и zstandard.
+# Ответы с ETag сжимаются один раз: дашборд, опрашивающий список без If-None-Match,
+# получает готовые байты из кэша. ETag сам по себе уникален только для своего URL и клиента
+# (например, promo_etag — это version.used.like), поэтому он входит в ключ вместе с ними.
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+# Объём сжатых тел в кэше воркера; 0 выключает кэш.
+COMPRESSION_CACHE_BYTES = int(float(os.getenv("COMPRESSION_CACHE_MB", "32")) * 1024 * 1024)
+
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/x-ndjson")
+
+
+def _compressors() -> dict:
+    compressors = {"gzip": lambda body: gzip.compress(body, COMPRESSION_GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        compressors["br"] = lambda body: brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL)
+        compressors["zstd"] = compressor.compress
+    return compressors
+
+
+COMPRESSORS = _compressors()
+# Порядок предпочтения сервера среди того, что принимает клиент.
+PREFERENCE = [encoding for encoding in ("zstd", "br", "gzip") if encoding in COMPRESSORS]
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    for encoding in PREFERENCE:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class _Cache:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.size = 0
+        self.entries: dict = {}
+
+    def get(self, key):
+        body = self.entries.pop(key, None)
+        if body is not None:
+            # pop + вставка держит словарь в порядке последнего обращения.
+            self.entries[key] = body
+        return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.limit:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.limit:
+            self.size -= len(self.entries.pop(next(iter(self.entries))))
+
+
+_cache = _Cache(COMPRESSION_CACHE_BYTES)
+
+
+def _header(headers, name: bytes):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """Чистый ASGI-middleware. Потоковые ответы (экспорт) проходят без сжатия."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = _header(scope["headers"], b"accept-encoding")
+        encoding = choose_encoding(accept_encoding.decode("latin-1")) if accept_encoding else None
+        start = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                content_type = _header(headers, b"content-type") or b""
+                if content_type.startswith(COMPRESSIBLE_TYPES) and not _header(headers, b"content-encoding"):
+                    start = message
+                else:
+                    passthrough = True
+                    await send(message)
+            elif message.get("more_body", False):
+                passthrough = True
+                await send(start)
+                await send(message)
+            else:
+                start, body = self._compress(scope, start, message.get("body", b""), encoding)
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _compress(self, scope, start, body: bytes, encoding):
+        headers = [(key, value) for key, value in start.get("headers", []) if key.lower() != b"vary"]
+        vary = _header(start.get("headers", []), b"vary")
+        headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+        if encoding is None or start["status"] != 200 or len(body) < COMPRESSION_MIN_SIZE:
+            return {**start, "headers": headers}, body
+
+        etag = _header(headers, b"etag")
+        key = None
+        compressed = None
+        if etag is not None and _cache.limit > 0:
+            key = (_header(scope["headers"], b"authorization"), scope["path"], scope["query_string"], etag, encoding)
+            compressed = _cache.get(key)
+            COMPRESSION_CACHE.labels("hit" if compressed is not None else "miss").inc()
+        if compressed is None:
+            started = time.thread_time()
+            compressed = COMPRESSORS[encoding](body)
+            COMPRESSION_SECONDS.labels(encoding).inc(time.thread_time() - started)
+            if key is not None:
+                _cache.put(key, compressed)
+        COMPRESSION_BYTES.labels(encoding, "in").inc(len(body))
+        COMPRESSION_BYTES.labels(encoding, "out").inc(len(compressed))
+
+        rewritten = []
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == b"content-length":
+                continue
+            if lowered == b"etag" and not value.startswith(b"W/"):
+                # Сжатое тело — другое представление: ETag становится слабым, If-None-Match
+                # сравнивается слабо (etags.etag_matches), поэтому 304 продолжают работать.
+                value = b"W/" + value
+            rewritten.append((name, value))
+        rewritten.append((b"content-encoding", encoding.encode()))
+        rewritten.append((b"content-length", str(len(compressed)).encode()))
+        return {**start, "headers": rewritten}, compressed
@@ -0,0 +1,91 @@
+import re
+from typing import Optional
+from fastapi import Header, HTTPException, Response
+from sqlalchemy import text
+from database import open_session, replica_engine
+from metrics import DB_READ_SESSIONS
+
+# Read-your-writes поверх реплики: ответ на запись несёт позицию WAL primary после commit,
+# клиент возвращает её в том же заголовке на чтении. Пока реплика не проиграла WAL до этой
+# позиции, чтение идёт в primary.
+CONSISTENCY_HEADER = "X-Consistency-Token"
+_LSN = re.compile(r"^([0-9A-Fa-f]{1,8})/([0-9A-Fa-f]{1,8})$")
+
+# Самая свежая позиция реплея реплики, которую видел воркер: токены не новее неё
+# не требуют лишнего запроса.
+_replica_position = 0
+
+
+def _parse_lsn(value: str) -> Optional[int]:
+    match = _LSN.match(value.strip())
+    if match is None:
+        return None
+    return int(match.group(1), 16) << 32 | int(match.group(2), 16)
+
+
+async def issue_token(db, response: Response):
+    """Вызывать после commit записи. Без реплики токен не нужен и запрос не делается."""
+    if replica_engine is None:
+        return
+    response.headers[CONSISTENCY_HEADER] = await db.scalar(text("SELECT pg_current_wal_lsn()::text"))
+
+
+def token_position(token: Optional[str]) -> int:
+    """Позиция из токена клиента для сверки с кэшем (cache.py); формат уже проверил get_read_db."""
+    if replica_engine is None or not token:
+        return 0
+    return _parse_lsn(token) or 0
+
+
+async def primary_position(db) -> int:
+    """Позиция WAL primary перед чтением, которое попадёт в кэш. Без реплики токенов нет, запрос не нужен."""
+    if replica_engine is None:
+        return 0
+    return _parse_lsn(await db.scalar(text("SELECT pg_current_wal_lsn()::text")))
+
+
+async def _replayed_position(db) -> int:
+    # Локальная «реплика» без standby (например, тот же сервер) отвечает своей позицией WAL.
+    position = await db.scalar(text(
+        "SELECT (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+        "ELSE pg_current_wal_lsn() END)::text"
+    ))
+    return _parse_lsn(position) if position else 0
+
+
+async def get_replica_db():
+    """Чтения, которым допустимо отставание: лента, экспорт."""
+    async with open_session(replica=True) as db:
+        yield db
+
+
+async def get_read_db(x_consistency_token: Optional[str] = Header(None)):
+    """GET-эндпоинты кабинета: реплика, кроме случая, когда она отстаёт от токена клиента."""
+    global _replica_position
+    if replica_engine is None:
+        async with open_session() as db:
+            yield db
+        return
+
+    required = None
+    if x_consistency_token:
+        required = _parse_lsn(x_consistency_token)
+        if required is None:
+            raise HTTPException(status_code=400, detail=f"Неверный {CONSISTENCY_HEADER}")
+
+    if required is None or required <= _replica_position:
+        DB_READ_SESSIONS.labels("replica", "no_token" if required is None else "caught_up").inc()
+        async with open_session(replica=True) as db:
+            yield db
+        return
+
+    async with open_session(replica=True) as db:
+        _replica_position = max(_replica_position, await _replayed_position(db))
+        if required <= _replica_position:
+            DB_READ_SESSIONS.labels("replica", "caught_up").inc()
+            yield db
+            return
+
+    DB_READ_SESSIONS.labels("primary", "replica_behind").inc()
+    async with open_session() as db:
+        yield db
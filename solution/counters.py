@@ -0,0 +1,477 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from typing import Optional
+from uuid import UUID
+from fastapi import HTTPException
+from sqlalchemy import Integer, bindparam, case, exists, func, literal, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from database import PromoCode, PromoLease, open_session
+from scheduler import close_exhausted
+from cache import promo_cache
+from cfg import WEB_CONCURRENCY
+from listen import listener
+from querystats import extend_budget
+from utility import utcnow
+import stats
+
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "1.0"))
+COUNTER_LEASE_SIZE = int(os.getenv("COUNTER_LEASE_SIZE", "32"))
+# Воркер, не сбрасывавший счётчики дольше TTL, считается умершим: его аренды возвращает любой другой.
+COUNTER_LEASE_TTL = float(os.getenv("COUNTER_LEASE_TTL", "30"))
+# Сколько активация ждёт, пока держатели аренд вернут остаток по NOTIFY, прежде чем ответить 503.
+COUNTER_RECALL_WAIT = float(os.getenv("COUNTER_RECALL_WAIT", "0.2"))
+
+LEASE_RECALL_CHANNEL = "promo_lease_recall"
+
+logger = logging.getLogger("counters")
+
+# Активации и лайки копятся в памяти и раз в COUNTER_FLUSH_INTERVAL уходят в promo_codes
+# одним пакетным UPDATE. max_count соблюдается через аренду квоты: воркер забирает из
+# leased_count блок активаций и раздаёт его без обращения к БД, неизрасходованный остаток
+# возвращается при сбросе. Блок не больше COUNTER_LEASE_SIZE и не больше доли остатка квоты на
+# один воркер, так что хвост квоты делится между воркерами. Каждая аренда записана в promo_leases
+# на воркер: аренды умершего воркера возвращает _reclaim, а если квота кончилась, пока её держат
+# другие, активация просит их вернуть остаток (NOTIFY на LEASE_RECALL_CHANNEL) и пробует ещё раз.
+# В той же транзакции сброса пишутся события активаций и их часовые роллапы по странам
+# (stats.write_events), а промокоды, выбравшие max_count, перестают быть active
+# (scheduler.close_exhausted), и кэш чтений кабинета получает NOTIFY (cache.py).
+
+
+class _PromoCounters:
+    __slots__ = ("company_id", "used", "likes", "lease", "leasing", "events")
+
+    def __init__(self, company_id):
+        # Ключ секций promo_codes: пакетный UPDATE сброса ищет строку только в её секции.
+        self.company_id = company_id
+        self.used = 0
+        self.likes = 0
+        self.lease = 0
+        self.leasing = 0
+        self.events = []
+
+
+_counters: dict = {}
+# Дельты, которые уже сняты с _counters, но ещё не закоммичены сбросом: читатели их тоже видят.
+_in_flight: dict = {}
+_in_flight_events: dict = {}
+# Закоммиченные сбросы. Строка promo_codes и pending() читаются не атомарно: читатель сверяет счётчик
+# до и после чтения строки и при расхождении читает заново (сброс мог перенести дельту в used_count).
+flushes = 0
+# Commit сброса ушёл в базу, но дельты ещё не сняты с _in_flight: они могут быть и в строке, и в pending().
+_committing = False
+_task = None
+_flush_lock = asyncio.Lock()
+# Будит фоновый сброс раньше срока, когда другой воркер отзывает аренды.
+_wake = asyncio.Event()
+# Новый в каждом процессе: gunicorn с preload_app форкает воркеры после импорта, id задаёт start().
+_worker = uuid.uuid4()
+
+_lease_table = PromoCode.__table__.alias("leased")
+_flush_table = PromoCode.__table__
+
+
+def _get(promo_id, company_id) -> _PromoCounters:
+    counters = _counters.get(promo_id)
+    if counters is None:
+        counters = _counters[promo_id] = _PromoCounters(company_id)
+    return counters
+
+
+def _lease_expiry():
+    return utcnow() + timedelta(seconds=COUNTER_LEASE_TTL)
+
+
+async def _take_lease(db, promo_id, company_id) -> int:
+    # company_id — ключ секций promo_codes: без него UPDATE читает все секции.
+    old = (
+        select(_flush_table.c.id, _flush_table.c.leased_count)
+        .where(_flush_table.c.id == promo_id, _flush_table.c.company_id == company_id)
+        .with_for_update()
+        .subquery("old")
+    )
+    remaining = _lease_table.c.max_count - _lease_table.c.leased_count
+    statement = (
+        update(_lease_table)
+        .where(
+            _lease_table.c.id == old.c.id,
+            _lease_table.c.company_id == company_id,
+            _lease_table.c.active.is_(True),
+            _lease_table.c.leased_count < _lease_table.c.max_count,
+        )
+        .values(leased_count=_lease_table.c.leased_count + func.least(
+            COUNTER_LEASE_SIZE, (remaining + WEB_CONCURRENCY - 1) // WEB_CONCURRENCY
+        ))
+        .returning(_lease_table.c.leased_count - old.c.leased_count)
+    )
+    # Коммитим сразу: последующий откат активации не должен откатывать полученную квоту.
+    # Сессия запроса, а не отдельная, чтобы не держать два соединения на один запрос.
+    granted = await db.scalar(statement)
+    if granted:
+        upsert = pg_insert(PromoLease).values(
+            promo_id=promo_id, worker=_worker, company_id=company_id, held=granted, expires_at=_lease_expiry()
+        )
+        await db.execute(upsert.on_conflict_do_update(
+            index_elements=[PromoLease.promo_id, PromoLease.worker],
+            set_={"held": PromoLease.held + upsert.excluded.held, "expires_at": upsert.excluded.expires_at},
+        ))
+    await db.commit()
+    return granted or 0
+
+
+async def recall(db, promo_id):
+    """Просит воркеры, держащие аренды промокода, вернуть остаток сейчас, а не к очередному сбросу.
+
+    Остаток держателей вернёт внеочередной сброс счётчиков, а заодно он допишет их активации в
+    used_count: после него квота, которой нет ни в used_count, ни в арендах, видна в строке промокода.
+    """
+    await db.execute(select(func.pg_notify(LEASE_RECALL_CHANNEL, str(promo_id))))
+    await db.commit()
+
+
+async def _quota_left(db, promo_id, company_id) -> Optional[bool]:
+    """Аренда не досталась: None — квота выбрана или промокод неактивен, True — в leased_count
+    снова есть свободная квота (её вернули после попытки аренды), False — остаток в арендах."""
+    flushed, committing = flushes, _committing
+    row = (await db.execute(
+        select(PromoCode.active, PromoCode.max_count, PromoCode.leased_count, func.coalesce(PromoCode.used_count, 0))
+        .where(PromoCode.id == promo_id, PromoCode.company_id == company_id)
+    )).first()
+    await db.commit()
+    if row is None or not row[0]:
+        return None
+    _, max_count, leased, used = row
+    counters = _counters.get(promo_id)
+    used += counters.used if counters is not None else 0
+    # Дельта сброса, закоммиченного во время чтения, может быть и в used_count, и в _in_flight.
+    # Недосчёт безопасен — повтор аренды и в худшем случае 503, двойной счёт дал бы ложный 403.
+    if flushes == flushed and not committing and not _committing:
+        used += _in_flight.get(promo_id, (0, 0))[0]
+    if used >= max_count:
+        return None
+    return leased < max_count
+
+
+async def reserve_activation(db, promo_id, company_id) -> bool:
+    counters = _get(promo_id, company_id)
+    if counters.lease == 0:
+        # Пока счётчик leasing не ноль, сброс не удалит запись, в которую ляжет аренда.
+        counters.leasing += 1
+        recalled = False
+        try:
+            while True:
+                # Сначала await, потом +=: иначе прибавка затрёт аренды соседних корутин.
+                granted = await _take_lease(db, promo_id, company_id)
+                counters.lease += granted
+                if counters.lease:
+                    break
+                # Чтение квоты и следующая попытка аренды сверх бюджета быстрого пути.
+                extend_budget(3)
+                left = await _quota_left(db, promo_id, company_id)
+                if left is None:
+                    return False
+                if left:
+                    continue
+                if recalled:
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Остаток активаций зарезервирован, повторите запрос позже",
+                        headers={"Retry-After": str(max(1, math.ceil(COUNTER_FLUSH_INTERVAL)))},
+                    )
+                extend_budget(1)
+                await recall(db, promo_id)
+                recalled = True
+                await asyncio.sleep(COUNTER_RECALL_WAIT)
+        finally:
+            counters.leasing -= 1
+    counters.lease -= 1
+    return True
+
+
+def drop_lease(promo_id) -> int:
+    """Снимает неизрасходованную аренду воркера: PATCH max_count возвращает её в leased_count своим UPDATE."""
+    counters = _counters.get(promo_id)
+    if counters is None:
+        return 0
+    lease, counters.lease = counters.lease, 0
+    return lease
+
+
+def _held_here(promo_id):
+    """Аренда этого воркера ещё числится в promo_leases, её не вернул _reclaim."""
+    return exists().where(PromoLease.promo_id == promo_id, PromoLease.worker == _worker)
+
+
+def returned_lease(lease: int):
+    """Выражение для UPDATE promo_codes в PATCH: сколько из снятой drop_lease аренды вернуть в leased_count.
+
+    Ноль, если аренду уже вернул _reclaim. Сначала UPDATE строки промокода, потом return_lease: строки
+    promo_codes везде блокируются раньше строк promo_leases, иначе аренда и сброс ловят deadlock.
+    """
+    return case((_held_here(PromoCode.id), lease), else_=0) if lease else literal(0)
+
+
+async def return_lease(db, promo_id, lease: int):
+    """Списывает из promo_leases аренду, возвращённую UPDATE c returned_lease, в той же транзакции."""
+    if lease:
+        await _settle_leases(db, [(promo_id, lease)])
+
+
+def restore_lease(promo_id, company_id, lease: int):
+    if lease:
+        _get(promo_id, company_id).lease += lease
+
+
+def release_activation(promo_id, company_id):
+    _get(promo_id, company_id).lease += 1
+
+
+def confirm_activation(promo_id, company_id, country: str = ""):
+    counters = _get(promo_id, company_id)
+    counters.used += 1
+    counters.events.append((country, utcnow()))
+
+
+# Публичного эндпоинта лайков нет: лайк без пользователя ничем не ограничен. like_count идёт через
+# этот же сброс, когда появится эндпоинт с аутентификацией пользователя и одним лайком на него.
+def add_like(promo_id, company_id):
+    _get(promo_id, company_id).likes += 1
+
+
+def pending(promo_id) -> tuple[int, int]:
+    used = likes = 0
+    counters = _counters.get(promo_id)
+    if counters is not None:
+        used, likes = counters.used, counters.likes
+    flushing = _in_flight.get(promo_id)
+    if flushing is not None:
+        used += flushing[0]
+        likes += flushing[1]
+    return used, likes
+
+
+def pending_countries(promo_id) -> Counter:
+    result = Counter()
+    counters = _counters.get(promo_id)
+    for country, _ in (counters.events if counters is not None else ()):
+        result[country] += 1
+    for country, _ in _in_flight_events.get(promo_id, ()):
+        result[country] += 1
+    return result
+
+
+_settle_leases_statement = text(
+    "UPDATE promo_leases AS lease SET held = lease.held - settled.units, expires_at = :expires_at "
+    "FROM unnest(CAST(:promo_ids AS uuid[]), CAST(:units AS integer[])) AS settled (promo_id, units) "
+    "WHERE lease.promo_id = settled.promo_id AND lease.worker = :worker"
+)
+
+# Аренды воркеров, не продлевавших их дольше COUNTER_LEASE_TTL, возвращаются в leased_count.
+_reclaim_statement = text(
+    "WITH expired AS ("
+    " DELETE FROM promo_leases WHERE promo_id = ANY(CAST(:promo_ids AS uuid[]))"
+    " AND expires_at < :now AND worker <> :worker RETURNING promo_id, held"
+    "), reclaimed AS (SELECT promo_id, sum(held) AS held FROM expired GROUP BY promo_id) "
+    "UPDATE promo_codes SET leased_count = promo_codes.leased_count - reclaimed.held "
+    "FROM reclaimed WHERE promo_codes.id = reclaimed.promo_id AND reclaimed.held <> 0 "
+    "AND promo_codes.company_id = ANY(CAST(:company_ids AS uuid[])) "
+    "RETURNING reclaimed.held"
+)
+
+
+async def _settle_leases(db, settled: list[tuple]):
+    """Списывает (promo_id, единицы) с аренд воркера и продлевает их."""
+    await db.execute(_settle_leases_statement, {
+        "promo_ids": [str(promo_id) for promo_id, _ in settled],
+        "units": [units for _, units in settled],
+        "worker": str(_worker),
+        "expires_at": _lease_expiry(),
+    })
+
+
+async def _reclaim():
+    now = utcnow()
+    async with open_session() as db:
+        expired = (await db.execute(
+            select(PromoLease.promo_id, PromoLease.company_id)
+            .where(PromoLease.expires_at < now, PromoLease.worker != _worker)
+            .distinct()
+        )).all()
+        held = []
+        if expired:
+            company_ids = {company_id for _, company_id in expired}
+            # Строки promo_codes блокируются первыми и по порядку id, как при аренде и сбросе;
+            # company_id оставляет в плане только секции этих компаний.
+            promo_ids = (await db.scalars(
+                select(PromoCode.id)
+                .where(PromoCode.company_id.in_(company_ids), PromoCode.id.in_([promo_id for promo_id, _ in expired]))
+                .order_by(PromoCode.id)
+                .with_for_update()
+            )).all()
+            if promo_ids:
+                held = (await db.execute(_reclaim_statement, {
+                    "promo_ids": [str(promo_id) for promo_id in promo_ids],
+                    "company_ids": [str(company_id) for company_id in company_ids],
+                    "now": now, "worker": str(_worker),
+                })).scalars().all()
+        await db.commit()
+    if held:
+        logger.warning("Возвращены аренды умерших воркеров: %s активаций в %s промокодах", sum(held), len(held))
+
+
+def _on_recall(payloads):
+    for payload in payloads:
+        counters = _counters.get(UUID(payload))
+        if counters is not None and (counters.lease or counters.used):
+            _wake.set()
+            return
+
+
+listener.subscribe(LEASE_RECALL_CHANNEL, _on_recall)
+
+
+async def flush():
+    async with _flush_lock:
+        await _flush()
+
+
+async def _flush():
+    global _committing
+    batch = []
+    events = []
+    for promo_id, counters in list(_counters.items()):
+        if counters.used or counters.likes or counters.lease:
+            batch.append({
+                "b_id": promo_id,
+                "b_company": counters.company_id,
+                "b_used": counters.used,
+                "b_likes": counters.likes,
+                "b_unused": counters.lease,
+            })
+            events.extend((promo_id, country, at) for country, at in counters.events)
+            _in_flight_events.setdefault(promo_id, []).extend(counters.events)
+            counters.used = counters.likes = counters.lease = 0
+            counters.events = []
+        elif not counters.leasing:
+            del _counters[promo_id]
+    if not batch:
+        return
+    # Один порядок строк у всех воркеров: встречные сбросы не блокируют друг друга крест-накрест.
+    batch.sort(key=lambda row: str(row["b_id"]))
+
+    statement = (
+        update(_flush_table)
+        .where(_flush_table.c.id == bindparam("b_id"), _flush_table.c.company_id == bindparam("b_company"))
+        .values(
+            used_count=func.coalesce(_flush_table.c.used_count, 0) + bindparam("b_used"),
+            like_count=func.coalesce(_flush_table.c.like_count, 0) + bindparam("b_likes"),
+            # Аренду, которую уже вернул _reclaim, второй раз не возвращаем, а израсходованное из неё
+            # снова числится в leased_count.
+            leased_count=_flush_table.c.leased_count + case(
+                (_held_here(_flush_table.c.id), -bindparam("b_unused", type_=Integer)),
+                else_=bindparam("b_used", type_=Integer),
+            ),
+        )
+    )
+    settled = [(row["b_id"], row["b_used"] + row["b_unused"]) for row in batch if row["b_used"] or row["b_unused"]]
+    for row in batch:
+        flushing = _in_flight.setdefault(row["b_id"], [0, 0])
+        flushing[0] += row["b_used"]
+        flushing[1] += row["b_likes"]
+    committed = False
+    try:
+        async with open_session() as db:
+            await db.execute(statement, batch)
+            if settled:
+                await _settle_leases(db, settled)
+            await stats.write_events(db, events)
+            await close_exhausted(db, [(row["b_id"], row["b_company"]) for row in batch if row["b_used"]])
+            await promo_cache.publish(db, [row["b_id"] for row in batch])
+            _committing = True
+            await db.commit()
+            # Без await между commit и снятием _in_flight: иначе читатель увидит дельту и в used_count,
+            # и в pending(). Синхронная часть invalidate (до первого await) так же сразу сбрасывает LRU.
+            committed = True
+            _settle(batch)
+            await promo_cache.invalidate([row["b_id"] for row in batch])
+    except Exception:
+        if committed:
+            logger.exception("Счётчики сброшены, но после commit произошла ошибка")
+        else:
+            logger.exception("Не удалось сбросить счётчики, дельты вернутся в следующий сброс")
+            for row in batch:
+                counters = _get(row["b_id"], row["b_company"])
+                counters.used += row["b_used"]
+                counters.likes += row["b_likes"]
+                counters.lease += row["b_unused"]
+            companies = {row["b_id"]: row["b_company"] for row in batch}
+            for promo_id, country, at in events:
+                _get(promo_id, companies[promo_id]).events.append((country, at))
+    finally:
+        if not committed:
+            _settle(batch, committed=False)
+
+
+def _settle(batch, committed: bool = True):
+    global flushes, _committing
+    if committed:
+        flushes += 1
+    _committing = False
+    for row in batch:
+        flushing = _in_flight[row["b_id"]]
+        flushing[0] -= row["b_used"]
+        flushing[1] -= row["b_likes"]
+        if flushing == [0, 0]:
+            del _in_flight[row["b_id"]]
+        _in_flight_events.pop(row["b_id"], None)
+
+
+async def _flush_forever():
+    month = utcnow().month
+    reclaimed = time.monotonic()
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), COUNTER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        if time.monotonic() - reclaimed >= COUNTER_LEASE_TTL / 2:
+            reclaimed = time.monotonic()
+            try:
+                await _reclaim()
+            except Exception:
+                logger.exception("Не удалось вернуть аренды умерших воркеров")
+        if utcnow().month != month:
+            month = utcnow().month
+            try:
+                await stats.prepare()
+            except Exception:
+                logger.exception("Не удалось создать секции promo_activations")
+        await flush()
+
+
+def start():
+    global _task, _worker
+    if _task is None:
+        _worker = uuid.uuid4()
+        _task = asyncio.create_task(_flush_forever())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        # Отмена посреди commit в потоке sync-режима теряется: закрытие сессии падает и подменяет
+        # CancelledError. Поэтому отменяем только между сбросами.
+        async with _flush_lock:
+            _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    await flush()
@@ -1,14 +1,23 @@
+import asyncio
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, Boolean, ForeignKey
+from sqlalchemy import create_engine, Column, Computed, String, DateTime, Integer, BigInteger, Boolean, ForeignKey, Index, UniqueConstraint, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import deferred, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.dialects.postgresql import UUID, JSONB, ARRAY, TSVECTOR
 import uuid
-from datetime import datetime, timezone
+from utility import utcnow
 
 load_dotenv()
 
+logger = logging.getLogger("database")
+
 DB_HOST = os.getenv("POSTGRES_HOST", "postgres")
 DB_PORT = os.getenv("POSTGRES_PORT", "5432")
 DB_NAME = os.getenv("POSTGRES_DATABASE", "prod")
@@ -16,11 +25,82 @@ DB_USER = os.getenv("POSTGRES_USERNAME", "prod")
 DB_PASS = os.getenv("POSTGRES_PASSWORD", "prod")
 
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Реплика для чтения (GET-эндпоинты кабинета и ленты, см. consistency.py); без хоста все чтения идут в primary.
+REPLICA_HOST = os.getenv("POSTGRES_REPLICA_HOST")
+REPLICA_PORT = os.getenv("POSTGRES_REPLICA_PORT", DB_PORT)
+REPLICA_URL = f"postgresql://{DB_USER}:{DB_PASS}@{REPLICA_HOST}:{REPLICA_PORT}/{DB_NAME}" if REPLICA_HOST else None
+ASYNC_REPLICA_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{REPLICA_HOST}:{REPLICA_PORT}/{DB_NAME}" if REPLICA_HOST else None
+
+# sync — psycopg2 + threadpool Starlette, async — asyncpg + AsyncSession; переключатель для A/B под нагрузкой.
+DB_MODE = os.getenv("DB_MODE", "sync")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))
+DB_REPLICA_MAX_OVERFLOW = int(os.getenv("DB_REPLICA_MAX_OVERFLOW", str(DB_MAX_OVERFLOW)))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "500"))
+# Сколько соединений каждый воркер открывает при старте, до первого запроса.
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(DB_POOL_SIZE)))
+# Число хэш-секций promo_codes по company_id. Берётся при создании таблицы (init_db или миграция
+# 0b2d4f6a8c1e); поменять его у существующей таблицы можно только пересекционированием.
+PROMO_PARTITIONS = int(os.getenv("PROMO_PARTITIONS", "16"))
+
+
+class _TimedQueuePool(QueuePool):
+    # Время ожидания свободного соединения кладём в info записи: его забирает
+    # обработчик события checkout (metrics.py).
+    def _do_get(self):
+        started = time.perf_counter()
+        record = super()._do_get()
+        record.info["checkout_wait"] = time.perf_counter() - started
+        return record
+
+
+class _TimedAsyncQueuePool(AsyncAdaptedQueuePool, _TimedQueuePool):
+    pass
+
+
+def _create_engines(url: str, async_url: str, pool_size: int, max_overflow: int):
+    """(синхронный engine, async engine или None, фабрика сессий) для текущего DB_MODE."""
+    options = dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+    )
+    if DB_MODE == "async":
+        async_engine = create_async_engine(
+            async_url,
+            poolclass=_TimedAsyncQueuePool,
+            connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+            **options,
+        )
+        # Синхронный фасад того же пула: на нём висят события пула и курсора.
+        return async_engine.sync_engine, async_engine, async_sessionmaker(
+            async_engine, autoflush=False, expire_on_commit=False
+        )
+    engine = create_engine(url, poolclass=_TimedQueuePool, **options)
+    return engine, None, sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 
-engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20)
+engine, async_engine, _session_factory = _create_engines(DATABASE_URL, ASYNC_DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW)
+AsyncSessionLocal = _session_factory if DB_MODE == "async" else None
+SessionLocal = None if DB_MODE == "async" else _session_factory
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if REPLICA_URL:
+    replica_engine, replica_async_engine, _replica_session_factory = _create_engines(
+        REPLICA_URL, ASYNC_REPLICA_URL, DB_REPLICA_POOL_SIZE, DB_REPLICA_MAX_OVERFLOW
+    )
+else:
+    replica_engine = replica_async_engine = _replica_session_factory = None
+
+# Имя пула -> синхронный engine: для событий метрик и querystats.
+engines = {"primary": engine}
+if replica_engine is not None:
+    engines["replica"] = replica_engine
 
 Base = declarative_base()
 
@@ -33,6 +113,8 @@ class Company(Base):
     password = Column(String, nullable=False)
     last_login = Column(DateTime, nullable=True)
     token = Column(String, nullable=True)
+    # Счётчик изменений промокодов компании, из него строится ETag списка (см. etags.py).
+    promo_changes = Column(BigInteger, default=0, server_default="0", nullable=False)
 
     def __repr__(self):
         return f"<Company(id={self.id}, name={self.name}, email={self.email})>"
@@ -40,32 +122,297 @@ class Company(Base):
 
 class PromoCode(Base):
     __tablename__ = "promo_codes"
+    # Хэш-секции по company_id (ensure_promo_partitions): запросы кабинета, где company_id в WHERE,
+    # читают одну секцию. Поэтому company_id входит в первичный ключ, а внешних ключей на
+    # promo_codes нет — как и у promo_activations и роллапов.
+    # Под keyset-пагинацию GET /business/promo: (company_id, сортировка, id), читаются обратным сканом.
+    __table_args__ = (
+        Index("ix_promo_codes_company_created_at", "company_id", "created_at", "id"),
+        Index("ix_promo_codes_company_active_from", "company_id", "active_from", "id"),
+        Index("ix_promo_codes_company_active_until", "company_id", "active_until", "id"),
+        Index("ix_promo_codes_target_countries", "target_countries", postgresql_using="gin"),
+        Index("ix_promo_codes_target_categories", "target_categories", postgresql_using="gin"),
+        Index("ix_promo_codes_target_age", "target_age_from", "target_age_until"),
+        # Частичные индексы по флагу active (см. scheduler.py): лента сканирует только живые
+        # промокоды, планировщик — только живые и ещё не истёкшие неживые.
+        Index("ix_promo_codes_live_created_at", "created_at", "id", postgresql_where=text("active")),
+        Index("ix_promo_codes_live_active_until", "active_until", postgresql_where=text("active")),
+        Index("ix_promo_codes_idle_active_until", "active_until", postgresql_where=text("NOT active")),
+        # Поиск (search.py): полнотекстовый по словам и триграммный по подстроке кода.
+        Index("ix_promo_codes_search_vector", "search_vector", postgresql_using="gin"),
+        Index(
+            "ix_promo_codes_promo_common_trgm", "promo_common",
+            postgresql_using="gin", postgresql_ops={"promo_common": "gin_trgm_ops"},
+        ),
+        {"postgresql_partition_by": "HASH (company_id)"},
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    company_id = Column(UUID(as_uuid=True), ForeignKey("companies.id"), nullable=False)
+    company_id = Column(UUID(as_uuid=True), ForeignKey("companies.id"), primary_key=True)
     mode = Column(String, nullable=False)
     promo_common = Column(String, nullable=True)
-    promo_unique = Column(UUID(as_uuid=True), nullable=True)  # Пример использования UUID для уникальных промокодов
     description = Column(String, nullable=False)
     image_url = Column(String, nullable=True)
-    target = Column(String, nullable=False)  # Можно использовать JSON или String для хранения целей
+    target = Column(JSONB, nullable=False)
+    # Горячие поля target продублированы в индексируемые колонки (см. targeting.target_columns)
+    target_countries = Column(ARRAY(String), nullable=True)
+    target_categories = Column(ARRAY(String), nullable=True)
+    target_age_from = Column(Integer, nullable=True)
+    target_age_until = Column(Integer, nullable=True)
     max_count = Column(Integer, nullable=False)
     active_from = Column(DateTime, nullable=False)
     active_until = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     active = Column(Boolean, default=True)
     like_count = Column(Integer, default=0, nullable=True)
     used_count = Column(Integer, default=0, nullable=True)
+    # Сколько активаций уже выдано воркерам в аренду (см. counters.py); не больше max_count.
+    leased_count = Column(Integer, default=0, server_default="0", nullable=False)
+    # Растёт на каждом PATCH; If-Match сверяется с ним в самом UPDATE.
+    version = Column(Integer, default=1, server_default="1", nullable=False)
+    # Считается самим Postgres; deferred — ORM-выборки промокода его не тянут.
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "to_tsvector('simple'::regconfig, coalesce(description, '') || ' ' || coalesce(promo_common, ''))",
+        persisted=True,
+    )))
 
     def __repr__(self):
         return f"<PromoCode(id={self.id}, company_id={self.company_id}, description={self.description})>"
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+class PromoActivation(Base):
+    """Журнал активаций: только INSERT, секционирован по месяцам (см. stats.ensure_partitions)."""
+    __tablename__ = "promo_activations"
+    __table_args__ = (
+        Index("ix_promo_activations_promo_at", "promo_id", "activated_at"),
+        {"postgresql_partition_by": "RANGE (activated_at)"},
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    activated_at = Column(DateTime, primary_key=True, default=utcnow)
+    promo_id = Column(UUID(as_uuid=True), nullable=False)
+    country = Column(String, nullable=False, default="")
+
+
+class PromoActivationRollup(Base):
+    """Активации промокода по стране за час; поддерживается инкрементально при сбросе счётчиков."""
+    __tablename__ = "promo_activation_rollups"
+
+    promo_id = Column(UUID(as_uuid=True), primary_key=True)
+    country = Column(String, primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    activations = Column(BigInteger, nullable=False, default=0)
+
+
+class PromoLease(Base):
+    """Квота активаций, которую воркер держит в аренде (см. counters.py): по истечении expires_at
+    без сброса счётчиков воркер считается умершим, и held возвращается в leased_count."""
+    __tablename__ = "promo_leases"
+    __table_args__ = (
+        Index("ix_promo_leases_expires_at", "expires_at"),
+    )
+
+    promo_id = Column(UUID(as_uuid=True), primary_key=True)
+    worker = Column(UUID(as_uuid=True), primary_key=True)
+    # Ключ секций promo_codes: возврат аренд умерших воркеров обновляет только секции их компаний.
+    company_id = Column(UUID(as_uuid=True), nullable=False)
+    held = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class PromoUniqueCode(Base):
+    __tablename__ = "promo_unique_codes"
+    __table_args__ = (
+        UniqueConstraint("promo_id", "code", name="uq_promo_unique_codes_promo_code"),
+        # Только свободные коды: выдача берёт первую строку из этого индекса.
+        Index("ix_promo_unique_codes_free", "promo_id", "id", postgresql_where=text("claimed_at IS NULL")),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    promo_id = Column(UUID(as_uuid=True), nullable=False)
+    code = Column(String, nullable=False)
+    claimed_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<PromoUniqueCode(id={self.id}, promo_id={self.promo_id}, code={self.code})>"
+
+class SyncSessionAdapter:
+    """Синхронная Session с интерфейсом AsyncSession: каждый вызов уходит в threadpool.
+
+    Как и AsyncSession, соединение занимается при первом обращении к базе, а не при открытии
+    сессии: слот пула (slots) берётся в event loop перед первым вызовом и отдаётся в close().
+    """
+
+    def __init__(self, session, slots: asyncio.Semaphore = None):
+        self.sync_session = session
+        self.slots = slots
+        self.holds_slot = False
+
+    async def _call(self, fn, *args, **kwargs):
+        if self.slots is not None and not self.holds_slot:
+            await self.slots.acquire()
+            self.holds_slot = True
+        return await run_in_threadpool(fn, *args, **kwargs)
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    def expunge(self, instance):
+        self.sync_session.expunge(instance)
+
+    async def execute(self, statement, params=None, **kwargs):
+        return await self._call(self.sync_session.execute, statement, params, **kwargs)
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return await self._call(self.sync_session.scalar, statement, params, **kwargs)
+
+    async def scalars(self, statement, params=None, **kwargs):
+        return await self._call(self.sync_session.scalars, statement, params, **kwargs)
+
+    async def get(self, entity, ident, **kwargs):
+        return await self._call(self.sync_session.get, entity, ident, **kwargs)
+
+    async def flush(self):
+        await self._call(self.sync_session.flush)
+
+    async def commit(self):
+        await self._call(self.sync_session.commit)
+
+    async def rollback(self):
+        await self._call(self.sync_session.rollback)
+
+    async def refresh(self, instance, attribute_names=None):
+        await self._call(self.sync_session.refresh, instance, attribute_names)
+
+    async def stream(self, statement, params=None, **kwargs):
+        # stream_results: psycopg2 читает через именованный (серверный) курсор.
+        statement = statement.execution_options(stream_results=True)
+        result = await self._call(self.sync_session.execute, statement, params, **kwargs)
+        return _StreamedResult(result)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await self._call(fn, self.sync_session, *args, **kwargs)
+
+    async def close(self):
+        try:
+            await run_in_threadpool(self.sync_session.close)
+        finally:
+            if self.holds_slot:
+                self.holds_slot = False
+                self.slots.release()
+
+
+class _StreamedResult:
+    """Обёртка над синхронным Result с тем же partitions(), что у AsyncResult."""
+
+    def __init__(self, result):
+        self.result = result
+
+    async def partitions(self, size=None):
+        parts = self.result.partitions(size)
+        while True:
+            part = await run_in_threadpool(next, parts, None)
+            if part is None:
+                return
+            yield part
+
+
+_session_slots = {
+    "primary": asyncio.Semaphore(DB_POOL_SIZE + DB_MAX_OVERFLOW),
+    "replica": asyncio.Semaphore(DB_REPLICA_POOL_SIZE + DB_REPLICA_MAX_OVERFLOW),
+}
+
+
+@asynccontextmanager
+async def open_session(replica: bool = False):
+    """replica=True — сессия на реплике, если она настроена, иначе на primary."""
+    replica = replica and _replica_session_factory is not None
+    factory = _replica_session_factory if replica else _session_factory
+    if DB_MODE == "async":
+        async with factory() as session:
+            yield session
+    else:
+        # Сессия держит соединение между прыжками в threadpool. Если ждать соединение
+        # внутри потока, ожидающие могут занять все потоки, нужные держателям соединений,
+        # поэтому очередь за пулом стоит в event loop (SyncSessionAdapter). У каждого пула своя очередь.
+        session = SyncSessionAdapter(factory(), _session_slots["replica" if replica else "primary"])
+        try:
+            yield session
+        finally:
+            await session.close()
+
+
+async def _warm(sync_engine, async_engine, size: int):
+    if DB_MODE == "async":
+        connections = await asyncio.gather(*(async_engine.connect().start() for _ in range(size)))
+        for connection in connections:
+            await connection.close()
+    else:
+        def open_and_return():
+            connections = [sync_engine.connect() for _ in range(size)]
+            for connection in connections:
+                connection.close()
+        await run_in_threadpool(open_and_return)
+
+
+async def warm_pool(size: int = DB_POOL_WARM):
+    warming = []
+    if min(size, DB_POOL_SIZE) > 0:
+        warming.append(_warm(engine, async_engine, min(size, DB_POOL_SIZE)))
+    if replica_engine is not None and min(size, DB_REPLICA_POOL_SIZE) > 0:
+        warming.append(_warm(replica_engine, replica_async_engine, min(size, DB_REPLICA_POOL_SIZE)))
+    await asyncio.gather(*warming)
+
+
+async def ping_db():
+    async with open_session() as db:
+        await db.execute(text("SELECT 1"))
+
+
+async def get_db():
+    async with open_session() as db:
         yield db
-    finally:
-        db.close()
+
+
+def is_partitioned(connection, table: str) -> bool:
+    return bool(connection.execute(
+        text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar())
+
+
+def ensure_promo_partitions(connection, partitions: int = PROMO_PARTITIONS):
+    """Создаёт хэш-секции promo_codes_pNN, если у таблицы их ещё нет."""
+    existing = connection.execute(
+        text("SELECT count(*) FROM pg_inherits WHERE inhparent = 'promo_codes'::regclass")
+    ).scalar()
+    if existing:
+        if existing != partitions:
+            logger.warning(
+                "У promo_codes %s секций, PROMO_PARTITIONS=%s не применён: нужна пересекционирующая миграция",
+                existing, partitions,
+            )
+        return
+    for remainder in range(partitions):
+        connection.execute(text(
+            f"CREATE TABLE promo_codes_p{remainder:02d} PARTITION OF promo_codes "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        ))
+
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # create_all всегда идёт через psycopg2, даже в async-режиме.
+    sync_engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        # gin_trgm_ops нужен индексу ix_promo_codes_promo_common_trgm до create_all.
+        with sync_engine.begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        Base.metadata.create_all(bind=sync_engine)
+        # Таблица, созданная до секционирования, остаётся обычной до миграции 0b2d4f6a8c1e.
+        with sync_engine.begin() as connection:
+            if is_partitioned(connection, "promo_codes"):
+                ensure_promo_partitions(connection)
+    finally:
+        sync_engine.dispose()
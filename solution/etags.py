@@ -0,0 +1,71 @@
+import hashlib
+from typing import Optional
+from fastapi import HTTPException, Response, status
+from sqlalchemy import update
+from database import Company
+
+# Дашборды опрашивают промокоды каждые несколько секунд; ответ всё равно сверяется с сервером.
+CACHE_CONTROL = "private, max-age=0, must-revalidate"
+
+
+# ETag промокода: "<version>.<used_count>.<like_count>". version меняет только PATCH,
+# счётчики растут от активаций и лайков. If-Match сверяет только version.
+def promo_etag(version: int, used_count: int = 0, like_count: int = 0) -> str:
+    return f'"{version}.{used_count}.{like_count}"'
+
+
+# ETag списка: счётчик изменений промокодов компании плюс параметры страницы.
+def list_etag(promo_changes: int, query: str) -> str:
+    digest = hashlib.sha1(query.encode()).hexdigest()[:16]
+    return f'"c{promo_changes}.{digest}"'
+
+
+def parse_if_match(header: Optional[str]) -> Optional[int]:
+    if header is None or header.strip() == "*":
+        return None
+    value = header.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"').split(".", 1)[0])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный заголовок If-Match")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match сравнивается слабо: W/"x" совпадает с "x".
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": CACHE_CONTROL},
+    )
+
+
+async def touch_company(db, company_id):
+    # В транзакции записи: ETag списка сменится ровно в момент коммита.
+    await db.execute(
+        update(Company)
+        .where(Company.id == company_id)
+        .values(promo_changes=Company.promo_changes + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def touch_companies(db, company_ids):
+    if not company_ids:
+        return
+    await db.execute(
+        update(Company)
+        .where(Company.id.in_(company_ids))
+        .values(promo_changes=Company.promo_changes + 1)
+        .execution_options(synchronize_session=False)
+    )
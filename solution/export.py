@@ -0,0 +1,82 @@
+import csv
+import io
+import os
+import orjson
+from sqlalchemy import select
+from database import PromoCode, open_session
+from codes import load_unique_codes
+from models import promo_detail
+import counters
+
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+EXPORT_COLUMNS = (
+    PromoCode.id,
+    PromoCode.company_id,
+    PromoCode.mode,
+    PromoCode.promo_common,
+    PromoCode.description,
+    PromoCode.image_url,
+    PromoCode.target,
+    PromoCode.max_count,
+    PromoCode.active_from,
+    PromoCode.active_until,
+    PromoCode.active,
+    PromoCode.like_count,
+    PromoCode.used_count,
+)
+
+CSV_FIELDS = (
+    "promo_id", "company_id", "company_name", "mode", "promo_common", "promo_unique", "description",
+    "image_url", "target", "max_count", "active_from", "active_until", "active", "like_count", "used_count",
+)
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+
+def _dumps(value) -> bytes:
+    return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+async def _promo_batches(company_id, company_name):
+    # Своя сессия: зависимость get_db закрывается до того, как начнётся отправка тела.
+    # Следующая пачка читается из серверного курсора только после того, как
+    # StreamingResponse отправил предыдущую, так что медленный клиент тормозит и чтение.
+    # Экспорт допускает отставание и читает с реплики, если она настроена.
+    async with open_session(replica=True) as db:
+        result = await db.stream(
+            select(*EXPORT_COLUMNS)
+            .where(PromoCode.company_id == company_id)
+            .order_by(PromoCode.created_at, PromoCode.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            unique_codes = await load_unique_codes(db, [row.id for row in rows if row.mode == "UNIQUE"])
+            yield [
+                promo_detail(row, company_name, unique_codes.get(row.id), *counters.pending(row.id))
+                for row in rows
+            ]
+
+
+async def ndjson_chunks(company_id, company_name):
+    async for batch in _promo_batches(company_id, company_name):
+        yield b"".join(_dumps(item) + b"\n" for item in batch)
+
+
+async def csv_chunks(company_id, company_name):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    async for batch in _promo_batches(company_id, company_name):
+        for item in batch:
+            item["target"] = _dumps(item["target"]).decode()
+            if item["promo_unique"] is not None:
+                item["promo_unique"] = _dumps(item["promo_unique"]).decode()
+            writer.writerow([item[field] for field in CSV_FIELDS])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Пустой экспорт: только заголовок.
+    if buffer.tell():
+        yield buffer.getvalue().encode()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import time
+
+# Продовый режим: мастер один раз ждёт базу и накатывает миграции, затем форкает
+# воркеры uvicorn с уже импортированным приложением (preload_app).
+
+_boot_started = time.time()
+os.environ.setdefault("APP_BOOT_STARTED", str(_boot_started))
+
+bind = os.getenv("SERVER_ADDRESS", "0.0.0.0:8080")
+workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# cfg.py делит ядра под bcrypt между воркерами по этому значению.
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Метрики всех воркеров собираются через файлы; каталог должен быть задан и очищен
+# до импорта prometheus_client, то есть до preload приложения.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+else:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+
+
+def on_starting(server):
+    # Мастер, до форка воркеров: их lifespan стартует уже на готовой схеме.
+    import bootstrap
+
+    timings = bootstrap.run()
+    server.log.info(
+        "Подготовка базы: ожидание %.3f с, миграции %.3f с", timings["wait_db"], timings["migrate"]
+    )
+
+
+def when_ready(server):
+    server.log.info("Мастер готов за %.3f с, воркеров: %s", time.time() - _boot_started, workers)
+
+
+def post_fork(server, worker):
+    # Соединения, открытые мастером, не должны переходить в воркеры.
+    import database
+
+    for engine in database.engines.values():
+        engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
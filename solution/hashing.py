@@ -0,0 +1,65 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from cfg import pwd_context, HASH_WORKERS, HASH_QUEUE_LIMIT
+
+# bcrypt держит CPU сотни миллисекунд, поэтому считаем его в отдельных процессах,
+# а не в event loop и не в общем threadpool Starlette.
+_executor = None
+_pending = 0
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _warm() -> None:
+    return None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+async def start():
+    # Поднимаем все процессы заранее, чтобы первый sign-up не платил за spawn.
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _warm) for _ in range(HASH_WORKERS)))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def pending() -> int:
+    return _pending
+
+
+async def run(fn, *args):
+    global _pending
+    if _pending >= HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервис перегружен, попробуйте позже",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+    finally:
+        _pending -= 1
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import select
+import threading
+import psycopg2
+from database import DATABASE_URL
+
+# Один поток LISTEN на воркер для всех каналов NOTIFY: кэш чтений промокодов (cache.py), кэш
+# токенов (auth.py) и отзыв аренд квоты активаций (counters.py). Подписчики регистрируются до start(); уведомления и смена состояния
+# подключения приходят им в event loop. Уведомления между обрывом и переподключением потеряны,
+# поэтому подписчик-кэш на оба события сбрасывает всё, что держит в памяти.
+
+_LISTEN_POLL = 1.0
+_LISTEN_RETRY = 1.0
+
+logger = logging.getLogger("listen")
+
+
+class Listener:
+    def __init__(self):
+        # канал -> (on_notify(payloads), on_state(listening) или None)
+        self.channels: dict = {}
+        self.listening = False
+        self._loop = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def subscribe(self, channel: str, on_notify, on_state=None):
+        self.channels[channel] = (on_notify, on_state)
+
+    def _set_listening(self, listening: bool):
+        self.listening = listening
+        for _, on_state in self.channels.values():
+            if on_state is not None:
+                on_state(listening)
+
+    def _dispatch(self, notifies):
+        payloads = {}
+        for channel, payload in notifies:
+            payloads.setdefault(channel, []).append(payload)
+        for channel, batch in payloads.items():
+            self.channels[channel][0](batch)
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            connection = None
+            try:
+                connection = psycopg2.connect(DATABASE_URL)
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    for channel in self.channels:
+                        cursor.execute(f"LISTEN {channel}")
+                self._loop.call_soon_threadsafe(self._set_listening, True)
+                while not self._stopping.is_set():
+                    if select.select([connection], [], [], _LISTEN_POLL)[0]:
+                        connection.poll()
+                        notifies = [(notify.channel, notify.payload) for notify in connection.notifies]
+                        connection.notifies.clear()
+                        if notifies:
+                            self._loop.call_soon_threadsafe(self._dispatch, notifies)
+            except Exception:
+                logger.exception("LISTEN прерван, кэши воркера выключены до переподключения")
+                self._stopping.wait(_LISTEN_RETRY)
+            finally:
+                self._loop.call_soon_threadsafe(self._set_listening, False)
+                if connection is not None:
+                    connection.close()
+
+    def start(self):
+        if self.channels and self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._listen, name="listen", daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        self._set_listening(False)
+
+
+listener = Listener()
@@ -1,26 +1,130 @@
+import math
+import time
+_import_started = time.perf_counter()
+_boot_wall = time.time()
+
+import asyncio
 import logging
-from datetime import datetime, timezone
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Body, Path, Request
+from contextlib import asynccontextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Literal, Optional
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Body, Path, Request, Response, Header
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from database import  get_db, Company, PromoCode, init_db
-from utility import hash_password, create_access_token, verify_password, verify_token
-from models import CompanyCreate, AuthRequest, PromoCodeCreate
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import REAL, select, insert, update, func, tuple_, and_, cast, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import  get_db, open_session, Company, PromoCode, init_db, warm_pool, ping_db
+from utility import hash_password, create_access_token, verify_password, utcnow, FastJSONResponse
+from auth import get_current_company, invalidate_company, publish_invalidation
+from pagination import encode_cursor, decode_cursor
+from etags import CACHE_CONTROL, promo_etag, list_etag, parse_if_match, etag_matches, not_modified, touch_company
+from targeting import target_columns, feed_filter
+from codes import insert_unique_codes, insert_code_pools, load_unique_codes, claim_unique_code
+from cfg import PROMO_BATCH_LIMIT, PROMO_BATCH_CODES_LIMIT, READINESS_TIMEOUT
+from models import (
+    CompanyCreate, AuthRequest, PromoCodeCreate, PromoListItem, PromoDetail, PromoStat, FeedItem,
+    PromoBatchResult, PromoPatch, promo_detail
+)
+import hashing
+import counters
+import stats
+import export
+from logs import setup_logging, stop_logging
+from metrics import MetricsMiddleware, metrics_response, STARTUP_SECONDS
+from querystats import QueryStatsMiddleware, query_budget, extend_budget, insert_pages
+from compression import CompressionMiddleware
+from admission import admit
+from consistency import get_read_db, get_replica_db, issue_token, primary_position, token_position
+from scheduler import scheduler, is_live, live_expression
+from search import search_filter
+from cache import promo_cache
+from listen import listener
 import uvicorn
 import os
-app = FastAPI(root_path="/api")
+from uuid import UUID
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+# Мастер gunicorn записывает момент своего старта (gunicorn.conf.py); без него считаем от импорта main.
+BOOT_STARTED = float(os.getenv("APP_BOOT_STARTED") or _boot_wall)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    started = time.perf_counter()
+    await asyncio.gather(hashing.start(), warm_pool())
+    await stats.prepare()
+    counters.start()
+    scheduler.start()
+    promo_cache.start()
+    listener.start()
+    app.state.ready = True
+    startup = time.perf_counter() - started
+    cold_start = time.time() - BOOT_STARTED
+    app.state.startup = {"import": IMPORT_SECONDS, "lifespan": startup, "cold_start": cold_start}
+    for phase, seconds in app.state.startup.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    logger.info(
+        "Воркер %s готов: импорт %.3f с, старт %.3f с, холодный старт %.3f с",
+        os.getpid(), IMPORT_SECONDS, startup, cold_start,
+    )
+    yield
+    app.state.ready = False
+    await listener.stop()
+    await promo_cache.stop()
+    await scheduler.stop()
+    await counters.stop()
+    hashing.shutdown()
+    stop_logging()
+
+
+app = FastAPI(
+    root_path="/api", lifespan=lifespan, default_response_class=FastJSONResponse, dependencies=[Depends(admit)]
+)
+app.state.ready = False
+# Самый внутренний: время сжатия попадает и в Server-Timing, и в латентность метрик.
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
 
 
 @app.get("/ping")
-def send():
+@query_budget(0)
+async def send():
     return {"status": "PROOOOOOOOOOOOOOOOOD"}
 
 
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exc: RequestValidationError):
+@app.get("/healthz")
+@query_budget(0)
+async def healthz():
+    # Liveness: процесс жив и event loop отвечает, база не трогается.
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+@query_budget(1)
+async def readyz():
+    # Readiness: старт завершён и база отвечает; иначе балансировщику не стоит слать сюда трафик.
+    if not app.state.ready:
+        return FastJSONResponse(status_code=503, content={"status": "starting"})
+    try:
+        await asyncio.wait_for(ping_db(), timeout=READINESS_TIMEOUT)
+    except Exception as e:
+        logger.warning("readyz: база недоступна: %s", e)
+        return FastJSONResponse(status_code=503, content={"status": "database unavailable"})
+    return {"status": "ready", "startup": app.state.startup}
+
+
+def format_validation_errors(raw_errors) -> list:
     errors = []
-    for error in exc.errors():
+    for error in raw_errors:
         ctx = error.get("ctx", {})
         errors.append({
             "type": error["type"],
@@ -29,26 +133,30 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
             "input": error.get("input", None),
             "ctx": {key: str(value) for key, value in ctx.items()}
         })
+    return errors
+
 
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
     return JSONResponse(
         status_code=400,
-        content={"detail": errors}
+        content={"detail": format_validation_errors(exc.errors())}
     )
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("main")
 
 @app.post("/business/auth/sign-up")
-async def sign_up(data: CompanyCreate, db: Session = Depends(get_db)):
+@query_budget(3)
+async def sign_up(data: CompanyCreate, db: AsyncSession = Depends(get_db)):
     try:
         logger.info("Получен запрос на регистрацию: %s", data.email)
 
-        existing_user = db.query(Company).filter(Company.email == data.email).first()
+        existing_user = await db.scalar(select(Company).where(Company.email == data.email).limit(1))
         if existing_user:
             logger.warning("Email уже зарегистрирован: %s", data.email)
             raise HTTPException(status_code=409, detail="Такой email уже зарегистрирован")
 
-        hashed_password = hash_password(data.password)
+        hashed_password = await hash_password(data.password)
         logger.info("Пароль успешно хэширован для: %s", data.email)
 
         new_company = Company(
@@ -57,8 +165,8 @@ async def sign_up(data: CompanyCreate, db: Session = Depends(get_db)):
             password=hashed_password
         )
         db.add(new_company)
-        db.commit()
-        db.refresh(new_company)
+        await db.commit()
+        await db.refresh(new_company)
         logger.info("Компания успешно зарегистрирована: %s", new_company.id)
 
         return {"message": "Successfully signed up"}
@@ -71,19 +179,22 @@ async def sign_up(data: CompanyCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail="Произошла ошибка на сервере")
 
 @app.post("/business/auth/sign-in", response_model=dict)
-def auth_company(auth_request: AuthRequest, db: Session = Depends(get_db)):
-    company = db.query(Company).filter(Company.email == auth_request.email).first()
-    if not company or not verify_password(auth_request.password, company.password):
+@query_budget(3)
+async def auth_company(auth_request: AuthRequest, db: AsyncSession = Depends(get_db)):
+    company = await db.scalar(select(Company).where(Company.email == auth_request.email).limit(1))
+    if not company or not await verify_password(auth_request.password, company.password):
         raise HTTPException(
             status_code=401,
             detail="Неверный email или пароль"
         )
 
-    access_token = create_access_token({"sub": auth_request.email})
+    access_token = create_access_token({"sub": auth_request.email, "cid": str(company.id)})
 
-    company.last_login = datetime.now(timezone.utc)
+    company.last_login = utcnow()
     company.token = access_token
-    db.commit()
+    await publish_invalidation(db, company.id)
+    await db.commit()
+    invalidate_company(company.id)
 
     return {
         "token": access_token,
@@ -91,209 +202,597 @@ def auth_company(auth_request: AuthRequest, db: Session = Depends(get_db)):
     }
 
 
+def promo_values(company_id, promo: PromoCodeCreate) -> dict:
+    return {
+        "company_id": company_id,
+        "mode": promo.mode,
+        "promo_common": promo.promo_common,
+        "description": promo.description,
+        "image_url": promo.image_url,
+        "target": promo.target,
+        **target_columns(promo.target),
+        "max_count": promo.max_count,
+        "active_from": promo.active_from,
+        "active_until": promo.active_until,
+        "active": is_live(promo.active_from, promo.active_until, 0, promo.max_count, utcnow()),
+    }
+
+
 @app.post("/business/promo", response_model=dict, status_code=status.HTTP_201_CREATED)
-def create_promo_code(
+@query_budget(5)
+async def create_promo_code(
     promo: PromoCodeCreate,
-    db: Session = Depends(get_db),
-    token: dict = Depends(verify_token)
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    current_company: Company = Depends(get_current_company)
 ):
-    print("Полученный токен:", token)
-
-    current_company_email = token.get("sub")
-    print("Email компании из токена:", current_company_email)
-
-    current_company = db.query(Company).filter(Company.email == current_company_email).first()
-    if not current_company:
-        print("Компания не найдена")
-        raise HTTPException(status_code=401, detail=f"Компания с email '{current_company_email}' не найдена")
-
-    print("Компания найдена:", current_company)
-
-    new_promo = PromoCode(
-        company_id=current_company.id,
-        mode=promo.mode,
-        promo_common=promo.promo_common,
-        promo_unique=promo.promo_unique,
-        description=promo.description,
-        image_url=promo.image_url,
-        target=promo.target,
-        max_count=promo.max_count,
-        active_from=promo.active_from,
-        active_until=promo.active_until,
-    )
+    new_promo = PromoCode(**promo_values(current_company.id, promo))
     db.add(new_promo)
-    db.commit()
-    db.refresh(new_promo)
+    await db.flush()
+    if promo.mode == "UNIQUE":
+        await insert_unique_codes(db, new_promo.id, promo.promo_unique)
+    await touch_company(db, current_company.id)
+    await db.commit()
+    await issue_token(db, response)
+    scheduler.notify(promo.active_from, promo.active_until)
 
     return {"id": str(new_promo.id)}
 
 
-@app.get("/business/promo", response_model=list, status_code=status.HTTP_200_OK)
-def get_promo_codes(
-    db: Session = Depends(get_db),
-    token: dict = Depends(verify_token),
-    limit: int = Query(10, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+@app.post(
+    "/business/promo/batch",
+    response_model=PromoBatchResult,
+    status_code=status.HTTP_201_CREATED,
+    description=(
+        f"Создаёт до {PROMO_BATCH_LIMIT} промокодов (PROMO_BATCH_LIMIT) одной транзакцией, "
+        f"всего не больше {PROMO_BATCH_CODES_LIMIT} кодов promo_unique (PROMO_BATCH_CODES_LIMIT); "
+        "сверх любого из лимитов — 413. Каждый элемент валидируется как в POST /business/promo; ответ содержит id или ошибки "
+        "по индексу элемента. Если валидных элементов нет, ничего не создаётся и возвращается 400."
+    ),
+)
+@query_budget(5)
+async def create_promo_codes_batch(
+    response: Response,
+    items: list[Any] = Body(...),
+    db: AsyncSession = Depends(get_db),
+    current_company: Company = Depends(get_current_company)
 ):
-    current_company_email = token.get("sub")
-    if not current_company_email:
-        raise HTTPException(status_code=401, detail="Поле 'sub' отсутствует в токене")
-
-    current_company = db.query(Company).filter(Company.email == current_company_email).first()
-    if not current_company:
-        raise HTTPException(status_code=401, detail=f"Компания с email '{current_company_email}' не найдена")
+    if len(items) > PROMO_BATCH_LIMIT:
+        raise HTTPException(status_code=413, detail=f"Не больше {PROMO_BATCH_LIMIT} промокодов за запрос")
+    # Коды считаются до валидации: она сама проходит по каждому коду.
+    codes = sum(
+        len(item["promo_unique"]) for item in items
+        if isinstance(item, dict) and isinstance(item.get("promo_unique"), list)
+    )
+    if codes > PROMO_BATCH_CODES_LIMIT:
+        raise HTTPException(
+            status_code=413, detail=f"Не больше {PROMO_BATCH_CODES_LIMIT} уникальных кодов за запрос"
+        )
 
-    promo_codes = (
-        db.query(PromoCode)
-        .filter(PromoCode.company_id == current_company.id)
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({"index": index, "errors": [{"type": "dict_type", "loc": [], "msg": "Ожидается объект", "input": item, "ctx": {}}]})
+            continue
+        try:
+            promo = PromoCodeCreate(**item)
+        except ValidationError as e:
+            results.append({"index": index, "errors": format_validation_errors(e.errors())})
+            continue
+        results.append({"index": index})
+        valid.append((results[-1], promo))
+
+    if not valid:
+        return FastJSONResponse(status_code=400, content={"created": 0, "items": results})
+
+    # Один executemany INSERT ... RETURNING на всю пачку; порядок id совпадает с порядком параметров.
+    # Core-таблица, а не ORM-сущность: ORM-вставка выкидывает ключи со значением None и
+    # режет пачку на отдельные INSERT везде, где набор ключей меняется (COMMON/UNIQUE вперемешку).
+    # В БД и промокоды, и коды уходят страницами insertmanyvalues: query_budget(5) рассчитан на одну
+    # страницу каждого, остальные страницы добавляются к бюджету.
+    promo_table = PromoCode.__table__
+    rows = [promo_values(current_company.id, promo) for _, promo in valid]
+    pools = [promo.promo_unique for _, promo in valid if promo.mode == "UNIQUE"]
+    extend_budget(insert_pages(len(rows), len(rows[0])) - 1 + insert_pages(sum(map(len, pools)), 2) - 1)
+    ids = (await db.scalars(
+        insert(promo_table).returning(promo_table.c.id, sort_by_parameter_order=True), rows,
+    )).all()
+    await insert_code_pools(db, {
+        promo_id: promo.promo_unique for promo_id, (_, promo) in zip(ids, valid) if promo.mode == "UNIQUE"
+    })
+    await touch_company(db, current_company.id)
+    await db.commit()
+    await issue_token(db, response)
+    for _, promo in valid:
+        scheduler.notify(promo.active_from, promo.active_until)
+
+    for promo_id, (result, _) in zip(ids, valid):
+        result["id"] = promo_id
+    return {"created": len(ids), "items": results}
+
+
+# Все колонки строки, кроме поискового tsvector: для RETURNING в PATCH.
+PROMO_COLUMNS = [column for column in PromoCode.__table__.columns if column.key != "search_vector"]
+
+# Колонки строки списка: список собирается из кортежей, без ORM-объектов.
+PROMO_LIST_COLUMNS = (
+    PromoCode.id,
+    PromoCode.mode,
+    PromoCode.promo_common,
+    PromoCode.description,
+    PromoCode.image_url,
+    PromoCode.target,
+    PromoCode.max_count,
+    PromoCode.active_from,
+    PromoCode.active_until,
+    PromoCode.created_at,
+    PromoCode.active,
+)
+
+SORT_COLUMNS = {
+    "active_from": PromoCode.active_from,
+    "active_until": PromoCode.active_until,
+    "created_at": PromoCode.created_at,
+}
+
+
+@app.get("/business/promo", response_model=list[PromoListItem], status_code=status.HTTP_200_OK)
+@query_budget(6)
+async def get_promo_codes(
+    request: Request,
+    db: AsyncSession = Depends(get_read_db),
+    current_company: Company = Depends(get_current_company),
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    sort_by: Literal["active_from", "active_until", "created_at"] = Query("created_at"),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из X-Next-Cursor"),
+    search: Optional[str] = Query(
+        None, min_length=1, max_length=100,
+        description="Поиск по описанию и коду; результаты по убыванию релевантности, sort_by не применяется",
+    ),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Любая запись промокодов компании двигает promo_changes: если он тот же, страница тоже.
+    promo_changes = await db.scalar(select(Company.promo_changes).where(Company.id == current_company.id))
+    etag = list_etag(promo_changes, request.url.query)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    condition = PromoCode.company_id == current_company.id
+    columns = PROMO_LIST_COLUMNS
+    if search:
+        match, rank = search_filter(search)
+        condition = and_(condition, match)
+        columns = (*PROMO_LIST_COLUMNS, rank.label("rank"))
+        sort_key, sort_column = "rank", rank
+    else:
+        sort_key, sort_column = sort_by, SORT_COLUMNS[sort_by]
+    query = select(*columns).where(condition)
+
+    total = None
+    if cursor:
+        if offset:
+            raise HTTPException(status_code=400, detail="cursor и offset нельзя передавать вместе")
+        position = decode_cursor(cursor)
+        if position.get("s") != sort_key:
+            raise HTTPException(status_code=400, detail="Курсор получен для другой сортировки")
+        try:
+            if search:
+                # Ранг — real: сравниваем с real, иначе граница страницы съедет на округлении.
+                last_value = cast(literal(float(position["v"])), REAL)
+            else:
+                last_value = datetime.fromisoformat(position["v"])
+            last_id = UUID(position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Неверный курсор")
+        query = query.where(tuple_(sort_column, PromoCode.id) < tuple_(last_value, last_id))
+        total = position.get("t")
+    if search and total is None:
+        # Ранжирование и так читает все совпадения: общее число — оконной функцией в том же запросе.
+        query = query.add_columns(func.count().over().label("total"))
+
+    promo_codes = (await db.execute(
+        query
+        .order_by(sort_column.desc(), PromoCode.id.desc())
         .offset(offset)
         .limit(limit)
-        .all()
+    )).all()
+    unique_codes = await load_unique_codes(
+        db, [promo.id for promo in promo_codes if promo.mode == "UNIQUE"]
     )
 
-    return [
-        {
-            "id": str(promo.id),
-            "mode": promo.mode,
-            "promo_common": promo.promo_common,
-            "promo_unique": promo.promo_unique,
-            "description": promo.description,
-            "image_url": promo.image_url,
-            "target": promo.target,
-            "max_count": promo.max_count,
-            "active_from": promo.active_from,
-            "active_until": promo.active_until,
-            "created_at": promo.created_at,
-            "active": promo.active
-        }
-        for promo in promo_codes
-    ]
-
+    # COUNT(*) считаем только для первой страницы, дальше общее число едет в курсоре.
+    if total is None:
+        if search and promo_codes:
+            total = promo_codes[0].total
+        elif offset == 0 and len(promo_codes) < limit:
+            total = len(promo_codes)
+        else:
+            total = await db.scalar(select(func.count()).select_from(PromoCode).where(condition))
+    headers = {"X-Total-Count": str(total), "ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    if len(promo_codes) == limit:
+        last = promo_codes[-1]
+        headers["X-Next-Cursor"] = encode_cursor({
+            "s": sort_key,
+            "v": last.rank if search else getattr(last, sort_by).isoformat(),
+            "id": str(last.id),
+            "t": total,
+        })
 
-@app.get("/business/promo/{id}", response_model=dict, status_code=status.HTTP_200_OK)
-def get_promo_by_id(
-    id: str,
-    db: Session = Depends(get_db),
-    token: dict = Depends(verify_token)
+    # Строки уже совпадают с PromoListItem: отдаём их orjson напрямую, минуя повторную валидацию.
+    content = []
+    for promo in promo_codes:
+        item = promo._asdict()
+        item.pop("rank", None)
+        item.pop("total", None)
+        item["promo_unique"] = unique_codes.get(promo.id)
+        content.append(item)
+    return FastJSONResponse(content=content, headers=headers)
+
+
+@app.get(
+    "/business/promo/export",
+    response_class=StreamingResponse,
+    description="Все промокоды компании в формате PromoDetail: NDJSON (по объекту на строку) или CSV.",
+)
+async def export_promo_codes(
+    current_company: Company = Depends(get_current_company),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
 ):
-    current_company_email = token.get("sub")
-    if not current_company_email:
-        raise HTTPException(status_code=401, detail="Поле 'sub' отсутствует в токене")
+    chunks = export.csv_chunks if format == "csv" else export.ndjson_chunks
+    return StreamingResponse(
+        chunks(current_company.id, current_company.email),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="promo.{format}"'},
+    )
 
-    current_company = db.query(Company).filter(Company.email == current_company_email).first()
-    if not current_company:
-        raise HTTPException(status_code=401, detail=f"Компания с email '{current_company_email}' не найдена")
 
-    promo = db.query(PromoCode).filter(PromoCode.id == id).first()
-    if not promo:
+async def raise_promo_not_owned(db, id: UUID):
+    # Запросы кабинета ищут промокод с company_id и читают одну секцию promo_codes; только при
+    # промахе смотрим по одному id во всех секциях, чтобы отличить чужой промокод от несуществующего.
+    owner = await db.scalar(select(PromoCode.company_id).where(PromoCode.id == id))
+    if owner is None:
         raise HTTPException(status_code=404, detail="Промокод не найден")
+    raise HTTPException(status_code=403, detail="Промокод не принадлежит этой компании")
 
-    if promo.company_id != current_company.id:
-        raise HTTPException(status_code=403, detail="Промокод не принадлежит этой компании")
 
+async def promo_snapshot(db, id: UUID, company_id) -> Optional[dict]:
+    promo = (await db.execute(
+        select(*PROMO_COLUMNS).where(PromoCode.id == id, PromoCode.company_id == company_id)
+    )).first()
+    if promo is None:
+        return None
+    unique_codes = await load_unique_codes(db, [id] if promo.mode == "UNIQUE" else [])
+    return {**promo._asdict(), "promo_unique": unique_codes.get(id)}
+
+
+async def stat_snapshot(db, id: UUID, company_id) -> Optional[dict]:
+    promo = (await db.execute(
+        select(PromoCode.used_count).where(PromoCode.id == id, PromoCode.company_id == company_id)
+    )).first()
+    if promo is None:
+        return None
     return {
-        "promo_id": str(promo.id),
-        "company_id": str(promo.company_id),
-        "company_name": current_company.email,
-        "like_count": promo.like_count,
-        "used_count": promo.used_count,
-        "active": promo.active,
-        "mode": promo.mode,
-        "promo_common": promo.promo_common,
-        "promo_unique": promo.promo_unique,
-        "description": promo.description,
-        "image_url": promo.image_url,
-        "target": promo.target,
-        "max_count": promo.max_count,
-        "active_from": promo.active_from,
-        "active_until": promo.active_until,
+        "company_id": company_id,
+        "used_count": promo.used_count or 0,
+        "countries": await stats.country_activations(db, id),
     }
 
-@app.patch("/business/promo/{id}", response_model=dict, status_code=status.HTTP_200_OK)
-def update_promo_code(
-    id: str,
-    promo_data: dict = Body(...),
-    db: Session = Depends(get_db),
-    token: dict = Depends(verify_token)
+
+async def cached_read(kind: str, snapshot, db, id: UUID, company_id, consistency_token: Optional[str]):
+    """snapshot(db, id, company_id) через кэш (cache.py). Без кэша — в сессии запроса, как раньше;
+    промах кэша читается в primary своей сессией: реплика может ещё не проиграть запись,
+    о которой кэш уже получил NOTIFY."""
+    if not promo_cache.enabled:
+        return await snapshot(db, id, company_id)
+
+    async def load():
+        async with open_session() as primary:
+            position = await primary_position(primary)
+            value = await snapshot(primary, id, company_id)
+        return None if value is None else (value, position)
+
+    return await promo_cache.fetch(kind, id, load, token_position(consistency_token))
+
+
+async def with_pending(read):
+    """await read(), после которого counters.pending() без await между ними даёт тот же момент: если сброс
+    счётчиков закоммитился во время чтения, неизвестно, вошла ли его дельта в прочитанное, и чтение повторяется."""
+    while True:
+        flushes = counters.flushes
+        value = await read()
+        if counters.flushes == flushes:
+            return value
+
+
+@app.get("/business/promo/{id}", response_model=PromoDetail, status_code=status.HTTP_200_OK)
+@query_budget(4)
+async def get_promo_by_id(
+    id: UUID,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    x_consistency_token: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_read_db),
+    current_company: Company = Depends(get_current_company)
 ):
-    current_company_email = token.get("sub")
-    if not current_company_email:
-        raise HTTPException(status_code=401, detail="Поле 'sub' отсутствует в токене")
+    if if_none_match and not promo_cache.enabled:
+        # Условный запрос без кэша: сверяем только версию и счётчики, строку целиком не читаем.
+        current = (await with_pending(lambda: db.execute(
+            select(PromoCode.version, PromoCode.used_count, PromoCode.like_count)
+            .where(PromoCode.id == id, PromoCode.company_id == current_company.id)
+        ))).first()
+        if current is not None:
+            used_pending, likes_pending = counters.pending(id)
+            etag = promo_etag(
+                current.version, (current.used_count or 0) + used_pending, (current.like_count or 0) + likes_pending
+            )
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+
+    promo = await with_pending(
+        lambda: cached_read("promo", promo_snapshot, db, id, current_company.id, x_consistency_token)
+    )
+    # Запись кэша могла заполнить компания-владелец: чужому запросу — 403, как без кэша.
+    if promo is None or promo["company_id"] != current_company.id:
+        await raise_promo_not_owned(db, id)
 
-    current_company = db.query(Company).filter(Company.email == current_company_email).first()
-    if not current_company:
-        raise HTTPException(status_code=401, detail=f"Компания с email '{current_company_email}' не найдена")
+    used_pending, likes_pending = counters.pending(id)
+    etag = promo_etag(
+        promo["version"], (promo["used_count"] or 0) + used_pending, (promo["like_count"] or 0) + likes_pending
+    )
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return promo_detail(
+        SimpleNamespace(**promo), current_company.email, promo["promo_unique"], used_pending, likes_pending
+    )
 
-    promo = db.query(PromoCode).filter(PromoCode.id == id).first()
-    if not promo:
-        raise HTTPException(status_code=404, detail="Промокод не найден")
 
-    if promo.company_id != current_company.id:
-        raise HTTPException(status_code=403, detail="Промокод не принадлежит этой компании")
+@app.patch("/business/promo/{id}", response_model=PromoDetail, status_code=status.HTTP_200_OK)
+@query_budget(6)
+async def update_promo_code(
+    id: UUID,
+    promo_data: PromoPatch,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_company: Company = Depends(get_current_company)
+):
+    values = promo_data.model_dump(exclude_unset=True)
+    if "target" in values:
+        values.update(target_columns(values["target"]))
+    expected_version = parse_if_match(if_match)
+    now = utcnow()
+
+    def statement(used_pending: int):
+        # Владелец, версия и инвариант max_count проверяются в одном UPDATE, без чтения строки.
+        conditions = [PromoCode.id == id, PromoCode.company_id == current_company.id]
+        if expected_version is not None:
+            conditions.append(PromoCode.version == expected_version)
+        if "max_count" in values:
+            # Арендованная воркерами квота уже может быть выдана: лимит не ниже leased_count за вычетом
+            # аренды этого воркера, которую UPDATE возвращает.
+            conditions.append(func.coalesce(PromoCode.used_count, 0) + used_pending <= values["max_count"])
+            conditions.append(PromoCode.leased_count - returned <= values["max_count"])
+        # active пересчитывается по новым окну и лимиту тем же UPDATE.
+        active = live_expression(
+            now,
+            values.get("active_from", PromoCode.active_from),
+            values.get("active_until", PromoCode.active_until),
+            values.get("max_count", PromoCode.max_count),
+            used_pending,
+        )
+        return (
+            update(PromoCode)
+            .where(*conditions)
+            .values(
+                **values,
+                active=active,
+                version=PromoCode.version + 1,
+                leased_count=PromoCode.leased_count - returned,
+            )
+            .returning(*PROMO_COLUMNS)
+            .execution_options(synchronize_session=False)
+        )
 
+    lease = counters.drop_lease(id) if "max_count" in values else 0
+    returned = counters.returned_lease(lease)
+    committed = False
     try:
-        for key, value in promo_data.items():
-            if hasattr(promo, key):
-                setattr(promo, key, value)
+        # Сброс счётчиков, закоммиченный до UPDATE, но после чтения pending(), учёл бы дельту дважды.
+        # Пока UPDATE держит строку, сброс её не закоммитит, поэтому сверки до и после UPDATE достаточно.
+        while True:
+            flushes = counters.flushes
+            promo = (await db.execute(statement(counters.pending(id)[0]))).first()
+            if counters.flushes == flushes:
+                break
+            await db.rollback()
+        used_pending, likes_pending = counters.pending(id)
+        if promo is not None:
+            await counters.return_lease(db, id, lease)
+            await touch_company(db, current_company.id)
+            await promo_cache.publish(db, [id])
+            await db.commit()
+            committed = True
+    finally:
+        if not committed:
+            counters.restore_lease(id, current_company.id, lease)
+
+    if promo is None:
+        await db.rollback()
+        # Строка не обновилась: отдельным запросом выясняем почему.
+        current = (await db.execute(
+            select(PromoCode.company_id, PromoCode.version, PromoCode.used_count, PromoCode.like_count)
+            .where(PromoCode.id == id)
+        )).first()
+        if current is None:
+            raise HTTPException(status_code=404, detail="Промокод не найден")
+        if current.company_id != current_company.id:
+            raise HTTPException(status_code=403, detail="Промокод не принадлежит этой компании")
+        if expected_version is not None and current.version != expected_version:
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail="Промокод изменён другим запросом",
+                headers={"ETag": promo_etag(
+                    current.version, (current.used_count or 0) + used_pending, (current.like_count or 0) + likes_pending
+                )},
+            )
+        if "max_count" in values and (current.used_count or 0) + used_pending <= values["max_count"]:
+            # Активаций меньше лимита, но квоту держат аренды других воркеров: просим вернуть остаток сейчас,
+            # а не к их очередному сбросу счётчиков.
+            await counters.recall(db, id)
+            raise HTTPException(
+                status_code=409,
+                detail="Часть активаций зарезервирована, повторите запрос позже",
+                headers={"Retry-After": str(max(1, math.ceil(counters.COUNTER_FLUSH_INTERVAL)))},
+            )
+        raise HTTPException(status_code=400, detail="Текущее количество активаций превышает max_count")
+    await promo_cache.invalidate([id])
+    await issue_token(db, response)
+    scheduler.notify(promo.active_from, promo.active_until)
+
+    response.headers["ETag"] = promo_etag(
+        promo.version, (promo.used_count or 0) + used_pending, (promo.like_count or 0) + likes_pending
+    )
+    unique_codes = await load_unique_codes(db, [promo.id] if promo.mode == "UNIQUE" else [])
+    return promo_detail(promo, current_company.email, unique_codes.get(promo.id), used_pending, likes_pending)
 
-        if promo.used_count > promo.max_count:
-            raise HTTPException(status_code=400, detail="Текущее количество активаций превышает max_count")
 
-        db.commit()
-        db.refresh(promo)
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
+@app.get("/business/promo/{id}/stat", response_model=PromoStat, status_code=status.HTTP_200_OK)
+@query_budget(4)
+async def get_promo_stats(
+    id: UUID = Path(..., description="Уникальный идентификатор промокода"),
+    x_consistency_token: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_read_db),
+    current_company: Company = Depends(get_current_company)
+):
+    promo = await with_pending(
+        lambda: cached_read("stat", stat_snapshot, db, id, current_company.id, x_consistency_token)
+    )
+    if promo is None or promo["company_id"] != current_company.id:
+        await raise_promo_not_owned(db, id)
+
+    used_count = promo["used_count"] + counters.pending(id)[0]
+    # Копия: словарь из кэша общий для всех запросов.
+    per_country = dict(promo["countries"])
+    for country, count in counters.pending_countries(id).items():
+        if country:
+            per_country[country] = per_country.get(country, 0) + count
+    country_stats = [
+        {"country": country, "activations_count": per_country[country]} for country in sorted(per_country)
+    ]
 
     return {
-        "promo_id": str(promo.id),
-        "company_id": str(promo.company_id),
-        "company_name": current_company.email,
-        "like_count": promo.like_count,
-        "used_count": promo.used_count,
-        "active": promo.active,
-        "mode": promo.mode,
-        "promo_common": promo.promo_common,
-        "promo_unique": promo.promo_unique,
-        "description": promo.description,
-        "image_url": promo.image_url,
-        "target": promo.target,
-        "max_count": promo.max_count,
-        "active_from": promo.active_from,
-        "active_until": promo.active_until,
+        "activations_count": used_count,
+        "countries": country_stats
     }
 
-@app.get("/business/promo/{id}/stat", response_model=dict, status_code=status.HTTP_200_OK)
-def get_promo_stats(
-    id: str = Path(..., description="Уникальный идентификатор промокода"),
-    db: Session = Depends(get_db),
-    token: dict = Depends(verify_token)
-):
-    current_company_email = token.get("sub")
-    if not current_company_email:
-        raise HTTPException(status_code=401, detail="Поле 'sub' отсутствует в токене")
-
-    current_company = db.query(Company).filter(Company.email == current_company_email).first()
-    if not current_company:
-        raise HTTPException(status_code=401, detail=f"Компания с email '{current_company_email}' не найдена")
 
-    promo = db.query(PromoCode).filter(PromoCode.id == id).first()
+@app.post(
+    "/business/promo/{id}/activate",
+    response_model=dict,
+    status_code=status.HTTP_200_OK,
+    description=(
+        "Выдаёт код промокода компании её клиенту (касса, сайт компании). Только для своих промокодов: "
+        "чужие получают 403, а token bucket admission.py считает активации по компании, как и остальные запросы. "
+        "503 с Retry-After — остаток лимита ещё в арендах воркеров (counters.py), повтор его получит."
+    ),
+)
+@query_budget(6)
+async def activate_promo(
+    id: UUID,
+    db: AsyncSession = Depends(get_db),
+    current_company: Company = Depends(get_current_company),
+    country: Optional[str] = Query(None, min_length=2, max_length=2, description="Страна пользователя")
+):
+    promo = await db.scalar(
+        select(PromoCode).where(PromoCode.id == id, PromoCode.company_id == current_company.id)
+    )
     if not promo:
-        raise HTTPException(status_code=404, detail="Промокод не найден")
+        await raise_promo_not_owned(db, id)
 
-    if promo.company_id != current_company.id:
-        raise HTTPException(status_code=403, detail="Промокод не принадлежит этой компании")
+    now = utcnow()
+    if not promo.active or not promo.active_from <= now <= promo.active_until:
+        raise HTTPException(status_code=403, detail="Промокод неактивен")
 
-    stats = promo.target.get("countries", [])
-    country_stats = [
-        {"country": country, "activations_count": promo.used_count} for country in stats
-    ]
+    # Квота берётся из арендованного блока, used_count допишет фоновый сброс счётчиков.
+    if not await counters.reserve_activation(db, id, current_company.id):
+        raise HTTPException(status_code=403, detail="Лимит активаций исчерпан")
 
-    return {
-        "activations_count": promo.used_count,
-        "countries": country_stats
-    }
+    try:
+        if promo.mode == "UNIQUE":
+            code = await claim_unique_code(db, id)
+            if code is None:
+                raise HTTPException(status_code=403, detail="Свободные коды закончились")
+            await db.commit()
+        else:
+            code = promo.promo_common
+    except BaseException:
+        # И при отмене запроса клиентом: единица аренды возвращается воркеру, иначе она навсегда
+        # останется в leased_count — свои аренды _reclaim не возвращает.
+        counters.release_activation(id, current_company.id)
+        await db.rollback()
+        raise
+
+    counters.confirm_activation(id, current_company.id, country.lower() if country else "")
+    return {"promo": code}
+
+
+@app.get("/promo/feed", response_model=list[FeedItem], status_code=status.HTTP_200_OK)
+@query_budget(1)
+async def get_promo_feed(
+    db: AsyncSession = Depends(get_replica_db),
+    country: Optional[str] = Query(None, min_length=2, max_length=2),
+    age: Optional[int] = Query(None, ge=0, le=200),
+    category: Optional[str] = Query(None, max_length=50),
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из X-Next-Cursor")
+):
+    query = (
+        select(
+            PromoCode.id.label("promo_id"),
+            PromoCode.company_id,
+            Company.name.label("company_name"),
+            PromoCode.description,
+            PromoCode.image_url,
+            PromoCode.active_from,
+            PromoCode.active_until,
+        )
+        .join(Company, Company.id == PromoCode.company_id)
+        .where(feed_filter(utcnow(), country=country, age=age, category=category))
+    )
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            last_created_at = datetime.fromisoformat(position["v"])
+            last_id = UUID(position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Неверный курсор")
+        query = query.where(tuple_(PromoCode.created_at, PromoCode.id) < tuple_(last_created_at, last_id))
+
+    rows = (await db.execute(
+        query.add_columns(PromoCode.created_at)
+        .order_by(PromoCode.created_at.desc(), PromoCode.id.desc())
+        .limit(limit)
+    )).all()
+
+    headers = {}
+    if len(rows) == limit:
+        headers["X-Next-Cursor"] = encode_cursor({
+            "v": rows[-1].created_at.isoformat(),
+            "id": str(rows[-1].promo_id),
+        })
 
+    content = []
+    for row in rows:
+        item = row._asdict()
+        del item["created_at"]
+        content.append(item)
+    return FastJSONResponse(content=content, headers=headers)
 
 if __name__ == "__main__":
     server_address = os.getenv("SERVER_ADDRESS", "0.0.0.0:8080")
@@ -0,0 +1,120 @@
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from starlette.responses import Response
+import database
+
+# Под gunicorn каждый воркер пишет метрики в файлы этого каталога (см. gunicorn.conf.py).
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+REQUESTS = Counter("http_requests_total", "Запросы по маршрутам и статусам", ["method", "route", "status"])
+IN_FLIGHT = Gauge("http_requests_in_flight", "Запросы в обработке", multiprocess_mode="livesum")
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Ожидание свободного соединения в пуле",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Выдачи соединений из пула", ["pool"])
+POOL_SIZE = Gauge("db_pool_size", "Размер пула", ["pool"], multiprocess_mode="livesum")
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Выданные соединения", ["pool"], multiprocess_mode="livesum")
+POOL_OVERFLOW = Gauge("db_pool_overflow", "Соединения сверх pool_size", ["pool"], multiprocess_mode="livesum")
+POOL_IDLE = Gauge("db_pool_idle", "Свободные соединения в пуле", ["pool"], multiprocess_mode="livesum")
+DB_READ_SESSIONS = Counter(
+    "db_read_sessions_total", "Сессии GET-эндпоинтов по пулу и причине выбора", ["pool", "reason"]
+)
+ADMISSION_SHED = Counter("admission_shed_total", "Запросы, отклонённые контролем допуска", ["route", "reason"])
+ADMISSION_QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds",
+    "Ожидание слота контроля допуска",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+COMPRESSION_BYTES = Counter(
+    "http_compression_bytes_total", "Байты тел ответов до и после сжатия", ["encoding", "direction"]
+)
+COMPRESSION_SECONDS = Counter("http_compression_cpu_seconds_total", "Процессорное время сжатия ответов", ["encoding"])
+COMPRESSION_CACHE = Counter("http_compression_cache_total", "Обращения к кэшу сжатых тел", ["result"])
+# Доля попаданий: sum(rate(promo_cache_requests_total{result!="miss"}[5m])) / sum(rate(promo_cache_requests_total[5m])).
+PROMO_CACHE_REQUESTS = Counter(
+    "promo_cache_requests_total", "Чтения кэша промокодов по уровню, где нашлось значение", ["kind", "result"]
+)
+PROMO_CACHE_INVALIDATIONS = Counter(
+    "promo_cache_invalidations_total", "Сброшенные id промокодов: своей записью или по NOTIFY", ["source"]
+)
+STARTUP_SECONDS = Gauge("app_startup_seconds", "Время старта воркера по фазам", ["phase"], multiprocess_mode="liveall")
+
+
+# Гейджи пула обновляются событиями, а не при сборе: при нескольких воркерах gunicorn
+# /metrics отдаёт сумму по всем процессам (PROMETHEUS_MULTIPROC_DIR), а не пул одного воркера.
+def _observe_pool(name: str, pool, returning: int = 0):
+    POOL_SIZE.labels(name).set(pool.size())
+    POOL_CHECKED_OUT.labels(name).set(pool.checkedout() - returning)
+    POOL_OVERFLOW.labels(name).set(max(pool.overflow(), 0))
+    POOL_IDLE.labels(name).set(pool.checkedin() + returning)
+
+
+def _watch_pool(name: str, engine):
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.labels(name).inc()
+        wait = connection_record.info.pop("checkout_wait", None)
+        if wait is not None:
+            POOL_CHECKOUT_WAIT.labels(name).observe(wait)
+        _observe_pool(name, engine.pool)
+
+    def on_checkin(dbapi_connection, connection_record):
+        # Событие приходит до того, как пул учёл возврат соединения.
+        _observe_pool(name, engine.pool, returning=1)
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+
+
+for _name, _engine in database.engines.items():
+    _watch_pool(_name, _engine)
+
+
+class MetricsMiddleware:
+    """Чистый ASGI-middleware: не буферизует тело ответа, в отличие от BaseHTTPMiddleware."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec()
+            # Шаблон пути, а не сам путь: иначе каждый id промокода станет отдельной серией.
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "<unmatched>", str(status_code))
+            REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - started)
+            REQUESTS.labels(*labels).inc()
+
+
+def metrics_response() -> Response:
+    if not MULTIPROCESS:
+        return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,97 @@
+"""promo_codes hash-partitioned by company_id
+
+Revision ID: 0b2d4f6a8c1e
+Revises: d0f2b4c6e8a1
+Create Date: 2026-10-17 22:00:00.000000
+
+Таблица пересоздаётся целиком: переименование, новая таблица, копирование строк, индексы
+после копирования. Всё идёт одной транзакцией и держит ACCESS EXCLUSIVE на promo_codes
+до конца копирования. На больших базах миграцию стоит выкатывать в окно обслуживания.
+Число секций — PROMO_PARTITIONS на момент миграции.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from database import PROMO_PARTITIONS, is_partitioned, ensure_promo_partitions
+
+# revision identifiers, used by Alembic.
+revision: str = '0b2d4f6a8c1e'
+down_revision: Union[str, None] = 'd0f2b4c6e8a1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _create_indexes() -> None:
+    op.create_index('ix_promo_codes_company_created_at', 'promo_codes', ['company_id', 'created_at', 'id'])
+    op.create_index('ix_promo_codes_company_active_from', 'promo_codes', ['company_id', 'active_from', 'id'])
+    op.create_index('ix_promo_codes_company_active_until', 'promo_codes', ['company_id', 'active_until', 'id'])
+    op.create_index('ix_promo_codes_target_countries', 'promo_codes', ['target_countries'], postgresql_using='gin')
+    op.create_index('ix_promo_codes_target_categories', 'promo_codes', ['target_categories'], postgresql_using='gin')
+    op.create_index('ix_promo_codes_target_age', 'promo_codes', ['target_age_from', 'target_age_until'])
+    op.create_index('ix_promo_codes_live_created_at', 'promo_codes', ['created_at', 'id'],
+                    postgresql_where=sa.text('active'))
+    op.create_index('ix_promo_codes_live_active_until', 'promo_codes', ['active_until'],
+                    postgresql_where=sa.text('active'))
+    op.create_index('ix_promo_codes_idle_active_until', 'promo_codes', ['active_until'],
+                    postgresql_where=sa.text('NOT active'))
+    op.create_index('ix_promo_codes_search_vector', 'promo_codes', ['search_vector'], postgresql_using='gin')
+    op.create_index('ix_promo_codes_promo_common_trgm', 'promo_codes', ['promo_common'],
+                    postgresql_using='gin', postgresql_ops={'promo_common': 'gin_trgm_ops'})
+
+
+def _rebuild(partitioned: bool) -> None:
+    bind = op.get_bind()
+    op.execute("ALTER TABLE promo_codes RENAME TO promo_codes_old")
+    # Имена ограничений и индексов освобождаются под новую таблицу.
+    op.execute("ALTER TABLE promo_codes_old DROP CONSTRAINT promo_codes_pkey")
+    for name in bind.execute(sa.text("SELECT indexname FROM pg_indexes WHERE tablename = 'promo_codes_old'")).scalars().all():
+        op.execute(f'DROP INDEX "{name}"')
+
+    op.execute(
+        "CREATE TABLE promo_codes (LIKE promo_codes_old INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS)"
+        + (" PARTITION BY HASH (company_id)" if partitioned else "")
+    )
+    op.execute(
+        "ALTER TABLE promo_codes ADD CONSTRAINT promo_codes_pkey PRIMARY KEY "
+        + ("(id, company_id)" if partitioned else "(id)")
+    )
+    if partitioned:
+        ensure_promo_partitions(bind, PROMO_PARTITIONS)
+
+    # Генерируемый search_vector Postgres пересчитает сам.
+    columns = ", ".join(bind.execute(sa.text(
+        "SELECT quote_ident(column_name) FROM information_schema.columns "
+        "WHERE table_name = 'promo_codes_old' AND is_generated = 'NEVER' ORDER BY ordinal_position"
+    )).scalars().all())
+    op.execute(f"INSERT INTO promo_codes ({columns}) SELECT {columns} FROM promo_codes_old")
+    op.execute("DROP TABLE promo_codes_old")
+
+    op.execute(
+        "ALTER TABLE promo_codes ADD CONSTRAINT promo_codes_company_id_fkey "
+        "FOREIGN KEY (company_id) REFERENCES companies (id)"
+    )
+    _create_indexes()
+    op.execute("ANALYZE promo_codes")
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    # На новой базе init_db() уже создал секционированную таблицу через create_all.
+    if is_partitioned(bind, "promo_codes"):
+        ensure_promo_partitions(bind, PROMO_PARTITIONS)
+        return
+    # Уникального ключа по одному id у секционированной таблицы нет — внешний ключ пула кодов снимается.
+    op.execute("ALTER TABLE promo_unique_codes DROP CONSTRAINT IF EXISTS promo_unique_codes_promo_id_fkey")
+    _rebuild(partitioned=True)
+
+
+def downgrade() -> None:
+    if not is_partitioned(op.get_bind(), "promo_codes"):
+        return
+    _rebuild(partitioned=False)
+    op.execute(
+        "ALTER TABLE promo_unique_codes ADD CONSTRAINT promo_unique_codes_promo_id_fkey "
+        "FOREIGN KEY (promo_id) REFERENCES promo_codes (id)"
+    )
@@ -0,0 +1,37 @@
+"""Keyset pagination indexes on promo_codes
+
+Revision ID: 3c1f9a7d2e41
+Revises: 65b878b75e4b
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1f9a7d2e41'
+down_revision: Union[str, None] = '65b878b75e4b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+SORT_COLUMNS = ('created_at', 'active_from', 'active_until')
+
+
+def upgrade() -> None:
+    # init_db() мог уже создать индексы через create_all, поэтому IF NOT EXISTS.
+    for column in SORT_COLUMNS:
+        op.create_index(
+            f'ix_promo_codes_company_{column}',
+            'promo_codes',
+            ['company_id', column, 'id'],
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    for column in SORT_COLUMNS:
+        op.drop_index(f'ix_promo_codes_company_{column}', table_name='promo_codes', if_exists=True)
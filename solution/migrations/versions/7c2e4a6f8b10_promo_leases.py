@@ -0,0 +1,36 @@
+"""promo_leases: per-worker activation quota leases
+
+Revision ID: 7c2e4a6f8b10
+Revises: 0b2d4f6a8c1e
+Create Date: 2026-10-17 23:00:00.000000
+
+Аренды, выданные до миграции, в журнале не значатся и вернутся в leased_count только при
+сбросе счётчиков их воркером; воркеры лучше перезапустить вместе с миграцией.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e4a6f8b10'
+down_revision: Union[str, None] = '0b2d4f6a8c1e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS promo_leases (
+            promo_id UUID NOT NULL,
+            worker UUID NOT NULL,
+            held INTEGER NOT NULL,
+            expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (promo_id, worker)
+        )
+    """)
+    op.create_index('ix_promo_leases_expires_at', 'promo_leases', ['expires_at'], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_table('promo_leases')
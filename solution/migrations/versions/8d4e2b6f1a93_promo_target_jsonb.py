@@ -0,0 +1,99 @@
+"""promo_codes.target as JSONB with indexed targeting columns
+
+Revision ID: 8d4e2b6f1a93
+Revises: 3c1f9a7d2e41
+Create Date: 2026-10-17 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '8d4e2b6f1a93'
+down_revision: Union[str, None] = '3c1f9a7d2e41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Копия правил targeting.target_columns на момент этой ревизии: миграция не должна меняться
+# вместе с кодом приложения.
+ANY = "*"
+AGE_MIN = 0
+AGE_MAX = 1000
+
+
+def _values(value) -> list:
+    if isinstance(value, str):
+        return [value]
+    return value if isinstance(value, list) else []
+
+
+def _normalize(values) -> list:
+    return sorted({str(value).strip().lower() for value in values if value}) or [ANY]
+
+
+def _age(value, default: int) -> int:
+    try:
+        return min(AGE_MAX, max(AGE_MIN, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+def target_columns(target) -> dict:
+    target = target if isinstance(target, dict) else {}
+    countries = _values(target.get("countries")) + _values(target.get("country"))
+    return {
+        "target_countries": _normalize(countries),
+        "target_categories": _normalize(_values(target.get("categories"))),
+        "target_age_from": _age(target.get("age_from"), AGE_MIN),
+        "target_age_until": _age(target.get("age_until"), AGE_MAX),
+    }
+
+
+def upgrade() -> None:
+    op.alter_column('promo_codes', 'target',
+               existing_type=sa.String(),
+               type_=postgresql.JSONB(),
+               postgresql_using='target::jsonb',
+               existing_nullable=False)
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS target_countries VARCHAR[]")
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS target_categories VARCHAR[]")
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS target_age_from INTEGER")
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS target_age_until INTEGER")
+
+    # Бэкфилл по тем же правилам нормализации, что и у приложения на момент ревизии.
+    bind = op.get_bind()
+    rows = bind.execute(sa.text("SELECT id, target FROM promo_codes WHERE target_countries IS NULL")).all()
+    if rows:
+        bind.execute(
+            sa.text(
+                "UPDATE promo_codes SET target_countries = :target_countries, "
+                "target_categories = :target_categories, target_age_from = :target_age_from, "
+                "target_age_until = :target_age_until WHERE id = :id"
+            ),
+            [{"id": row.id, **target_columns(row.target)} for row in rows],
+        )
+
+    op.create_index('ix_promo_codes_target_countries', 'promo_codes', ['target_countries'],
+                    postgresql_using='gin', if_not_exists=True)
+    op.create_index('ix_promo_codes_target_categories', 'promo_codes', ['target_categories'],
+                    postgresql_using='gin', if_not_exists=True)
+    op.create_index('ix_promo_codes_target_age', 'promo_codes', ['target_age_from', 'target_age_until'],
+                    if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_promo_codes_target_age', table_name='promo_codes', if_exists=True)
+    op.drop_index('ix_promo_codes_target_categories', table_name='promo_codes', if_exists=True)
+    op.drop_index('ix_promo_codes_target_countries', table_name='promo_codes', if_exists=True)
+    op.drop_column('promo_codes', 'target_age_until')
+    op.drop_column('promo_codes', 'target_age_from')
+    op.drop_column('promo_codes', 'target_categories')
+    op.drop_column('promo_codes', 'target_countries')
+    op.alter_column('promo_codes', 'target',
+               existing_type=postgresql.JSONB(),
+               type_=sa.String(),
+               postgresql_using='target::text',
+               existing_nullable=False)
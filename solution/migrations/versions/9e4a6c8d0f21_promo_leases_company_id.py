@@ -0,0 +1,32 @@
+"""promo_leases.company_id: partition key of the leased promo
+
+Revision ID: 9e4a6c8d0f21
+Revises: 7c2e4a6f8b10
+Create Date: 2026-10-18 01:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4a6c8d0f21'
+down_revision: Union[str, None] = '7c2e4a6f8b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE promo_leases ADD COLUMN IF NOT EXISTS company_id UUID")
+    op.execute("""
+        UPDATE promo_leases SET company_id = promo_codes.company_id
+        FROM promo_codes
+        WHERE promo_codes.id = promo_leases.promo_id AND promo_leases.company_id IS NULL
+    """)
+    # Аренды удалённых промокодов вернуть некуда.
+    op.execute("DELETE FROM promo_leases WHERE company_id IS NULL")
+    op.execute("ALTER TABLE promo_leases ALTER COLUMN company_id SET NOT NULL")
+
+
+def downgrade() -> None:
+    op.drop_column('promo_leases', 'company_id')
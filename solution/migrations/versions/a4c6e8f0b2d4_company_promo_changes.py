@@ -0,0 +1,26 @@
+"""companies.promo_changes for list ETags
+
+Revision ID: a4c6e8f0b2d4
+Revises: f1b3d5a7c9e2
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c6e8f0b2d4'
+down_revision: Union[str, None] = 'f1b3d5a7c9e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE companies ADD COLUMN IF NOT EXISTS promo_changes BIGINT NOT NULL DEFAULT 0")
+
+
+def downgrade() -> None:
+    op.drop_column('companies', 'promo_changes')
@@ -0,0 +1,52 @@
+"""promo_unique_codes pool table
+
+Revision ID: b7a3c5e9d210
+Revises: 8d4e2b6f1a93
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7a3c5e9d210'
+down_revision: Union[str, None] = '8d4e2b6f1a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS promo_unique_codes (
+            id BIGSERIAL PRIMARY KEY,
+            promo_id UUID NOT NULL REFERENCES promo_codes (id),
+            code VARCHAR NOT NULL,
+            claimed_at TIMESTAMP WITHOUT TIME ZONE,
+            CONSTRAINT uq_promo_unique_codes_promo_code UNIQUE (promo_id, code)
+        )
+    """)
+    op.create_index('ix_promo_unique_codes_free', 'promo_unique_codes', ['promo_id', 'id'],
+                    postgresql_where=sa.text('claimed_at IS NULL'), if_not_exists=True)
+
+    # Старая колонка хранила один UUID на промокод — переносим его в пул как единственный код.
+    op.execute("""
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'promo_codes' AND column_name = 'promo_unique') THEN
+                INSERT INTO promo_unique_codes (promo_id, code)
+                SELECT id, promo_unique::text FROM promo_codes WHERE promo_unique IS NOT NULL
+                ON CONFLICT DO NOTHING;
+                ALTER TABLE promo_codes DROP COLUMN promo_unique;
+            END IF;
+        END $$;
+    """)
+
+
+def downgrade() -> None:
+    op.add_column('promo_codes', sa.Column('promo_unique', postgresql.UUID(), nullable=True))
+    op.drop_index('ix_promo_unique_codes_free', table_name='promo_unique_codes', if_exists=True)
+    op.drop_table('promo_unique_codes')
@@ -0,0 +1,51 @@
+"""recompute promo_codes.active, partial indexes on live promos
+
+Revision ID: c9e1a3b5d7f9
+Revises: a4c6e8f0b2d4
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c9e1a3b5d7f9'
+down_revision: Union[str, None] = 'a4c6e8f0b2d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+LIVE = (
+    "active_from <= (now() AT TIME ZONE 'utc') AND active_until >= (now() AT TIME ZONE 'utc') "
+    "AND COALESCE(used_count, 0) < max_count"
+)
+
+
+def upgrade() -> None:
+    # Раньше active оставался True навсегда; дальше его ведёт scheduler.py.
+    op.execute(
+        f"UPDATE promo_codes SET active = ({LIVE}), version = version + 1 "
+        f"WHERE active IS DISTINCT FROM ({LIVE})"
+    )
+    op.execute("UPDATE companies SET promo_changes = promo_changes + 1")
+    # init_db() мог уже создать индексы через create_all, поэтому IF NOT EXISTS.
+    op.create_index(
+        'ix_promo_codes_live_created_at', 'promo_codes', ['created_at', 'id'],
+        postgresql_where=sa.text('active'), if_not_exists=True,
+    )
+    op.create_index(
+        'ix_promo_codes_live_active_until', 'promo_codes', ['active_until'],
+        postgresql_where=sa.text('active'), if_not_exists=True,
+    )
+    op.create_index(
+        'ix_promo_codes_idle_active_until', 'promo_codes', ['active_until'],
+        postgresql_where=sa.text('NOT active'), if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    for name in ('ix_promo_codes_live_created_at', 'ix_promo_codes_live_active_until', 'ix_promo_codes_idle_active_until'):
+        op.drop_index(name, table_name='promo_codes', if_exists=True)
@@ -0,0 +1,41 @@
+"""promo_codes.search_vector, full-text and trigram search indexes
+
+Revision ID: d0f2b4c6e8a1
+Revises: c9e1a3b5d7f9
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd0f2b4c6e8a1'
+down_revision: Union[str, None] = 'c9e1a3b5d7f9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Хранимая генерируемая колонка: ADD COLUMN переписывает таблицу один раз.
+    op.execute(
+        "ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+        "(to_tsvector('simple'::regconfig, coalesce(description, '') || ' ' || coalesce(promo_common, ''))) STORED"
+    )
+    # init_db() мог уже создать индексы через create_all, поэтому IF NOT EXISTS.
+    op.create_index(
+        'ix_promo_codes_search_vector', 'promo_codes', ['search_vector'],
+        postgresql_using='gin', if_not_exists=True,
+    )
+    op.create_index(
+        'ix_promo_codes_promo_common_trgm', 'promo_codes', ['promo_common'],
+        postgresql_using='gin', postgresql_ops={'promo_common': 'gin_trgm_ops'}, if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_promo_codes_promo_common_trgm', table_name='promo_codes', if_exists=True)
+    op.drop_index('ix_promo_codes_search_vector', table_name='promo_codes', if_exists=True)
+    op.drop_column('promo_codes', 'search_vector')
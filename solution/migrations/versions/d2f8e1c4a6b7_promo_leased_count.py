@@ -0,0 +1,30 @@
+"""promo_codes.leased_count for write-behind counters
+
+Revision ID: d2f8e1c4a6b7
+Revises: b7a3c5e9d210
+Create Date: 2026-10-17 13:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2f8e1c4a6b7'
+down_revision: Union[str, None] = 'b7a3c5e9d210'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("UPDATE promo_codes SET used_count = 0 WHERE used_count IS NULL")
+    op.execute("UPDATE promo_codes SET like_count = 0 WHERE like_count IS NULL")
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS leased_count INTEGER NOT NULL DEFAULT 0")
+    # Всё уже учтённое в used_count считается выданным.
+    op.execute("UPDATE promo_codes SET leased_count = used_count WHERE leased_count < used_count")
+
+
+def downgrade() -> None:
+    op.drop_column('promo_codes', 'leased_count')
@@ -0,0 +1,49 @@
+"""promo_activations event log and hourly country rollups
+
+Revision ID: e5c7a9b1d3f2
+Revises: d2f8e1c4a6b7
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from stats import ensure_partitions
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5c7a9b1d3f2'
+down_revision: Union[str, None] = 'd2f8e1c4a6b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS promo_activations (
+            id BIGSERIAL NOT NULL,
+            activated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            promo_id UUID NOT NULL,
+            country VARCHAR NOT NULL,
+            PRIMARY KEY (id, activated_at)
+        ) PARTITION BY RANGE (activated_at)
+    """)
+    op.create_index('ix_promo_activations_promo_at', 'promo_activations', ['promo_id', 'activated_at'],
+                    if_not_exists=True)
+    ensure_partitions(op.get_bind())
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS promo_activation_rollups (
+            promo_id UUID NOT NULL,
+            country VARCHAR NOT NULL,
+            hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            activations BIGINT NOT NULL,
+            PRIMARY KEY (promo_id, country, hour)
+        )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('promo_activation_rollups')
+    op.drop_table('promo_activations')
@@ -0,0 +1,26 @@
+"""promo_codes.version for optimistic concurrency on PATCH
+
+Revision ID: f1b3d5a7c9e2
+Revises: e5c7a9b1d3f2
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1b3d5a7c9e2'
+down_revision: Union[str, None] = 'e5c7a9b1d3f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1")
+
+
+def downgrade() -> None:
+    op.drop_column('promo_codes', 'version')
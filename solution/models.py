@@ -1,7 +1,9 @@
 from cfg import pwd_context
 from typing import Any, Optional
 from datetime import datetime
+from uuid import UUID
 from pydantic import BaseModel, Field, validator
+from targeting import AGE_MIN, AGE_MAX
 
 class AuthRequest(BaseModel):
     email: str
@@ -29,6 +31,23 @@ class Token(BaseModel):
     token_type: str
 
 
+def validate_target(value):
+    """Ключи target, которые раскладываются по индексируемым колонкам (targeting.target_columns)."""
+    if value is None:
+        return value
+    for key in ("age_from", "age_until"):
+        age = value.get(key)
+        if age is not None and (type(age) is not int or not AGE_MIN <= age <= AGE_MAX):
+            raise ValueError(f"'{key}' должно быть целым числом от {AGE_MIN} до {AGE_MAX}")
+    if value.get("country") is not None and not isinstance(value["country"], str):
+        raise ValueError("'country' должно быть строкой")
+    for key in ("countries", "categories"):
+        items = value.get(key)
+        if items is not None and (not isinstance(items, list) or not all(isinstance(item, str) for item in items)):
+            raise ValueError(f"'{key}' должно быть списком строк")
+    return value
+
+
 class PromoCodeCreate(BaseModel):
     mode: str = Field(..., description="Режим промокода: COMMON или UNIQUE")
     promo_common: Optional[str] = Field(None, max_length=30, description="Общий промокод для режима COMMON")
@@ -49,6 +68,8 @@ class PromoCodeCreate(BaseModel):
         except ValueError:
             raise ValueError("Дата должна быть в формате YYYY-MM-DD")
 
+    _validate_target = validator("target", allow_reuse=True)(validate_target)
+
     @validator("mode")
     def validate_mode(cls, value):
         if value not in ["COMMON", "UNIQUE"]:
@@ -65,8 +86,126 @@ class PromoCodeCreate(BaseModel):
     def validate_promo_unique(cls, value, values):
         if values.get("mode") == "UNIQUE" and not value:
             raise ValueError("Поле 'promo_unique' обязательно для режима UNIQUE")
+        if value:
+            if len(value) > 5000:
+                raise ValueError("В 'promo_unique' не больше 5000 кодов")
+            if any(not 3 <= len(code) <= 30 for code in value):
+                raise ValueError("Длина кода в 'promo_unique' от 3 до 30 символов")
+            if len(set(value)) != len(value):
+                raise ValueError("Коды в 'promo_unique' не должны повторяться")
+        return value
+
+
+
+class PromoPatch(BaseModel):
+    description: Optional[str] = Field(None, min_length=10, max_length=300, description="Описание промокода")
+    image_url: Optional[str] = Field(None, max_length=350, description="Ссылка на изображение")
+    target: Optional[dict[str, Any]] = Field(None, description="Целевая аудитория")
+    max_count: Optional[int] = Field(None, description="Максимальное количество использования")
+    active_from: Optional[datetime] = Field(None, description="Дата начала действия")
+    active_until: Optional[datetime] = Field(None, description="Дата окончания действия")
+
+    @validator("active_from", "active_until", pre=True)
+    def parse_date(cls, value):
+        if value is None or isinstance(value, datetime):
+            return value
+        try:
+            return datetime.strptime(value, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            raise ValueError("Дата должна быть в формате YYYY-MM-DD")
+
+    @validator("description", "target", "max_count", "active_from", "active_until")
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("Поле не может быть null")
         return value
 
+    _validate_target = validator("target", allow_reuse=True)(validate_target)
+
+
+class PromoListItem(BaseModel):
+    id: UUID
+    mode: str
+    promo_common: Optional[str] = None
+    promo_unique: Optional[list[str]] = None
+    description: str
+    image_url: Optional[str] = None
+    target: dict[str, Any]
+    max_count: int
+    active_from: datetime
+    active_until: datetime
+    created_at: Optional[datetime] = None
+    active: bool
+
+
+class PromoDetail(BaseModel):
+    promo_id: UUID
+    company_id: UUID
+    company_name: str
+    like_count: int
+    used_count: int
+    active: bool
+    mode: str
+    promo_common: Optional[str] = None
+    promo_unique: Optional[list[str]] = None
+    description: str
+    image_url: Optional[str] = None
+    target: dict[str, Any]
+    max_count: int
+    active_from: datetime
+    active_until: datetime
+
+
+class CountryStat(BaseModel):
+    country: str
+    activations_count: int
+
+
+class PromoStat(BaseModel):
+    activations_count: int
+    countries: list[CountryStat]
+
+
+class FeedItem(BaseModel):
+    promo_id: UUID
+    company_id: UUID
+    company_name: str
+    description: str
+    image_url: Optional[str] = None
+    active_from: datetime
+    active_until: datetime
+
+
+class PromoBatchItem(BaseModel):
+    index: int
+    id: Optional[UUID] = None
+    errors: Optional[list[dict[str, Any]]] = None
+
+
+class PromoBatchResult(BaseModel):
+    created: int
+    items: list[PromoBatchItem]
+
+
+def promo_detail(promo, company_name: str, promo_unique: Optional[list[str]], used_delta: int = 0, like_delta: int = 0) -> dict:
+    """Единственное место, где строка PromoCode превращается в тело PromoDetail."""
+    return {
+        "promo_id": promo.id,
+        "company_id": promo.company_id,
+        "company_name": company_name,
+        "like_count": (promo.like_count or 0) + like_delta,
+        "used_count": (promo.used_count or 0) + used_delta,
+        "active": promo.active,
+        "mode": promo.mode,
+        "promo_common": promo.promo_common,
+        "promo_unique": promo_unique,
+        "description": promo.description,
+        "image_url": promo.image_url,
+        "target": promo.target,
+        "max_count": promo.max_count,
+        "active_from": promo.active_from,
+        "active_until": promo.active_until,
+    }
 
 
 
@@ -0,0 +1,20 @@
+import base64
+import json
+from fastapi import HTTPException
+
+
+# Курсор непрозрачен для клиента: base64url от компактного JSON без паддинга.
+def encode_cursor(payload: dict) -> str:
+    raw = json.dumps(payload, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+    return payload
@@ -0,0 +1,118 @@
+import logging
+import math
+import os
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+import database
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Включается в тестах и бенчмарке: превышение бюджета запросов роняет запрос исключением.
+QUERY_BUDGET_ENFORCE = os.getenv("QUERY_BUDGET_ENFORCE", "false").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger("querystats")
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds", "extra_budget")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # Запросы сверх query_budget, которые эндпоинт объявил сам (extend_budget).
+        self.extra_budget = 0
+
+
+# Один объект на запрос; threadpool sync-режима получает копию контекста с тем же объектом.
+_current: ContextVar = ContextVar("query_stats", default=None)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+def query_budget(limit: int):
+    """Сколько SQL-запросов эндпоинт может выполнить за один вызов."""
+    def mark(endpoint):
+        endpoint.query_budget = limit
+        return endpoint
+    return mark
+
+
+def current() -> QueryStats:
+    return _current.get()
+
+
+def insert_pages(rows: int, columns: int) -> int:
+    """Сколько запросов уйдёт в БД на executemany-INSERT: SQLAlchemy режет его на страницы
+    insertmanyvalues (не больше insertmanyvalues_page_size строк и insertmanyvalues_max_parameters
+    параметров). Оценка сверху: asyncpg без RETURNING отправляет всё одним executemany."""
+    dialect = database.engine.dialect
+    per_page = max(1, min(dialect.insertmanyvalues_page_size, dialect.insertmanyvalues_max_parameters // max(1, columns)))
+    return max(1, math.ceil(rows / per_page))
+
+
+def extend_budget(queries: int):
+    """Добавляет к бюджету запроса запросы, число которых заранее неизвестно: страницы INSERT, повторы аренды квоты."""
+    stats = _current.get()
+    if stats is not None:
+        stats.extra_budget += max(0, queries)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning("Медленный запрос %.1f мс: %s", elapsed * 1000, " ".join(statement.split())[:1000])
+
+
+for _engine in database.engines.values():
+    event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class QueryStatsMiddleware:
+    """Считает запросы и время БД на HTTP-запрос и отдаёт их в Server-Timing."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                timing = (
+                    f'db;dur={stats.seconds * 1000:.3f};desc="{stats.count} queries", '
+                    f"app;dur={(time.perf_counter() - started) * 1000:.3f}"
+                )
+                message["headers"] = [*message.get("headers", ()), (b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+
+        limit = getattr(scope.get("endpoint"), "query_budget", None)
+        if limit is not None:
+            limit += stats.extra_budget
+        if limit is not None and stats.count > limit:
+            route = scope.get("route")
+            message = f"{scope['method']} {route.path if route else scope['path']}: {stats.count} запросов при бюджете {limit}"
+            if QUERY_BUDGET_ENFORCE:
+                raise QueryBudgetExceeded(message)
+            logger.warning("Превышен бюджет запросов: %s", message)
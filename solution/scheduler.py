@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from sqlalchemy import DateTime, and_, func, literal, select, true, union, update
+from database import PromoCode, open_session
+from etags import touch_companies
+from cache import promo_cache
+from utility import utcnow
+
+# PromoCode.active — «промокод живой прямо сейчас»: окно active_from..active_until
+# содержит текущий момент и лимит max_count не выбран. Флаг пересчитывается:
+# - при создании и PATCH (is_live / live_expression);
+# - сбросом счётчиков, когда used_count дошёл до max_count (close_exhausted);
+# - этим планировщиком, когда открывается или закрывается окно.
+# Каждый воркер держит кучу ближайших моментов переходов на SCHEDULER_HORIZON секунд вперёд и
+# просыпается к ближайшему; сами переходы — два массовых UPDATE по частичным индексам.
+# Одновременно их выполняет один воркер (pg_try_advisory_xact_lock), остальные повторяют позже.
+
+SCHEDULER_HORIZON = float(os.getenv("SCHEDULER_HORIZON", "10"))
+SCHEDULER_LOCK_ID = 7241700120
+SCHEDULER_RETRY = 0.05
+SCHEDULER_ERROR_DELAY = 1.0
+# active_until включительно: окно закрывается сразу после него.
+_SLACK = timedelta(milliseconds=1)
+
+logger = logging.getLogger("scheduler")
+
+
+def is_live(active_from, active_until, used: int, max_count: int, now: datetime) -> bool:
+    return (
+        (active_from is None or active_from <= now)
+        and (active_until is None or active_until >= now)
+        and used < max_count
+    )
+
+
+def _sql(value):
+    return literal(value, DateTime) if isinstance(value, datetime) else value
+
+
+def live_expression(
+    now: datetime,
+    active_from=PromoCode.active_from,
+    active_until=PromoCode.active_until,
+    max_count=PromoCode.max_count,
+    used_pending: int = 0,
+):
+    """is_live для UPDATE: аргументы — новые значения из PATCH или сами колонки."""
+    return and_(
+        _sql(active_from) <= now,
+        _sql(active_until) >= now,
+        func.coalesce(PromoCode.used_count, 0) + used_pending < max_count,
+    )
+
+
+def _flip(condition, active: bool):
+    # Версия растёт вместе с флагом: active входит в тело ответа, ETag должен смениться.
+    return (
+        update(PromoCode)
+        .where(condition)
+        .values(active=active, version=PromoCode.version + 1)
+        .returning(PromoCode.id, PromoCode.company_id, PromoCode.active_until)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def close_exhausted(db, promos):
+    """В транзакции сброса счётчиков: закрывает промокоды, у которых used_count дошёл до max_count.
+
+    promos — пары (id, company_id): по company_id план читает только секции этих компаний.
+    """
+    if not promos:
+        return
+    closed = (await db.execute(_flip(
+        and_(
+            PromoCode.company_id.in_({company_id for _, company_id in promos}),
+            PromoCode.id.in_([promo_id for promo_id, _ in promos]),
+            PromoCode.active,
+            func.coalesce(PromoCode.used_count, 0) >= PromoCode.max_count,
+        ),
+        False,
+    ))).all()
+    await touch_companies(db, {row.company_id for row in closed})
+
+
+class Scheduler:
+    """Куча моментов ближайших переходов и их применение.
+
+    clock подменяется в бенчмарке и проверках: run_due(now) применяет всё, что наступило к now,
+    без ожидания реального времени. scope ограничивает промокоды, которые планировщик видит и
+    переключает: с подменёнными часами без него переключились бы все промокоды в базе.
+    """
+
+    def __init__(self, clock: Callable[[], datetime] = utcnow, horizon: float = SCHEDULER_HORIZON, scope=None):
+        self.clock = clock
+        self.horizon = timedelta(seconds=horizon)
+        self.scope = true() if scope is None else scope
+        self.upcoming: list[datetime] = []
+        self.loaded_until: Optional[datetime] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task = None
+
+    def notify(self, *moments):
+        """Окна, созданные или изменённые этим воркером; остальные подхватит обновление кучи."""
+        now = self.clock()
+        for moment in moments:
+            if moment is None:
+                continue
+            moment += _SLACK
+            if moment > now and (self.loaded_until is None or moment <= self.loaded_until):
+                heapq.heappush(self.upcoming, moment)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _refresh(self, db, now: datetime):
+        until = now + self.horizon
+        opening = select(PromoCode.active_from.label("moment")).where(
+            self.scope,
+            ~PromoCode.active,
+            PromoCode.active_until >= now,
+            PromoCode.active_from > now,
+            PromoCode.active_from <= until,
+        )
+        closing = select(PromoCode.active_until.label("moment")).where(
+            self.scope,
+            PromoCode.active,
+            PromoCode.active_until >= now,
+            PromoCode.active_until < until,
+        )
+        moments = (await db.scalars(union(opening, closing))).all()
+        self.upcoming = [moment + _SLACK for moment in moments]
+        heapq.heapify(self.upcoming)
+        self.loaded_until = until
+
+    async def run_due(self, now: datetime = None) -> Optional[int]:
+        """Сколько промокодов сменили состояние; None, если переходы сейчас применяет другой воркер."""
+        now = now or self.clock()
+        async with open_session() as db:
+            if not await db.scalar(select(func.pg_try_advisory_xact_lock(SCHEDULER_LOCK_ID))):
+                return None
+            opened = (await db.execute(_flip(
+                and_(self.scope, ~PromoCode.active, PromoCode.active_until >= now, live_expression(now)), True
+            ))).all()
+            closed = (await db.execute(_flip(
+                and_(self.scope, PromoCode.active, PromoCode.active_until < now), False
+            ))).all()
+            await touch_companies(db, {row.company_id for row in opened} | {row.company_id for row in closed})
+            await promo_cache.publish(db, [row.id for row in opened + closed])
+            if self.loaded_until is None or now + self.horizon / 2 >= self.loaded_until:
+                await self._refresh(db, now)
+            await db.commit()
+        await promo_cache.invalidate([row.id for row in opened + closed])
+        while self.upcoming and self.upcoming[0] <= now:
+            heapq.heappop(self.upcoming)
+        # Только что открытые промокоды закроются в пределах горизонта без обновления кучи.
+        self.notify(*(row.active_until for row in opened))
+        if opened or closed:
+            logger.info("Переходы промокодов: открыто %s, закрыто %s", len(opened), len(closed))
+        return len(opened) + len(closed)
+
+    def _next_delay(self) -> float:
+        now = self.clock()
+        wake = self.loaded_until - self.horizon / 2
+        if self.upcoming:
+            wake = min(wake, self.upcoming[0])
+        return max(0.0, (wake - now).total_seconds())
+
+    async def _run_forever(self):
+        while True:
+            try:
+                done = await self.run_due()
+                delay = SCHEDULER_RETRY if done is None else self._next_delay()
+            except Exception:
+                logger.exception("Не удалось применить переходы промокодов")
+                delay = SCHEDULER_ERROR_DELAY
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+scheduler = Scheduler()
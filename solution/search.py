@@ -0,0 +1,39 @@
+import re
+from sqlalchemy import REAL, cast, func, or_
+from database import PromoCode
+
+# Поиск по description и promo_common для GET /business/promo?search=:
+# - слова запроса ищутся как префиксы в хранимом tsvector (GIN ix_promo_codes_search_vector);
+# - подстрока кода — ILIKE '%q%' по триграммному GIN-индексу (ix_promo_codes_promo_common_trgm).
+# Ранг — ts_rank плюс триграммное сходство кода с запросом; страницы листаются по (ранг, id).
+
+SEARCH_CONFIG = "simple"
+_WORD = re.compile(r"\w+")
+
+
+def _contains_pattern(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def prefix_tsquery(text: str):
+    # Только \w-токены: в to_tsquery не попадают операторы из пользовательского ввода.
+    words = _WORD.findall(text.lower())
+    if not words:
+        return None
+    return func.to_tsquery(SEARCH_CONFIG, " & ".join(f"{word}:*" for word in words))
+
+
+def search_filter(text: str):
+    """(условие WHERE, выражение ранга) для строки поиска."""
+    text = text.strip()
+    code_match = PromoCode.promo_common.ilike(_contains_pattern(text), escape="\\")
+    similarity = func.coalesce(func.similarity(PromoCode.promo_common, text), 0)
+    query = prefix_tsquery(text)
+    if query is None:
+        return code_match, cast(similarity, REAL)
+    return (
+        or_(PromoCode.search_vector.op("@@")(query), code_match),
+        cast(func.ts_rank(PromoCode.search_vector, query) + similarity, REAL),
+    )
+
@@ -0,0 +1,116 @@
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import create_engine, delete, func, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.pool import NullPool
+from database import DATABASE_URL, PromoActivation, PromoActivationRollup, open_session
+from utility import utcnow
+
+ACTIVATION_PARTITIONS_AHEAD = 2
+
+logger = logging.getLogger("stats")
+
+
+def _month_start(moment: datetime, shift: int = 0) -> datetime:
+    month = moment.year * 12 + moment.month - 1 + shift
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def ensure_partitions(connection, now: datetime = None, ahead: int = ACTIVATION_PARTITIONS_AHEAD):
+    """Создаёт месячные секции promo_activations на текущий месяц и `ahead` вперёд плюс DEFAULT."""
+    now = now or utcnow()
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS promo_activations_default PARTITION OF promo_activations DEFAULT"
+    ))
+    for shift in range(ahead + 1):
+        start, end = _month_start(now, shift), _month_start(now, shift + 1)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS promo_activations_y{start:%Y}m{start:%m} "
+            f"PARTITION OF promo_activations FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        ))
+
+
+async def prepare():
+    async with open_session() as db:
+        await db.run_sync(lambda session: ensure_partitions(session.connection()))
+        await db.commit()
+
+
+async def write_events(db, events: list[tuple]):
+    """Пишет буфер активаций (promo_id, country, activated_at) и докладывает его в часовые роллапы."""
+    if not events:
+        return
+    await db.execute(
+        insert(PromoActivation),
+        [{"promo_id": promo_id, "country": country, "activated_at": at} for promo_id, country, at in events],
+    )
+
+    hourly = Counter(
+        (promo_id, country, at.replace(minute=0, second=0, microsecond=0)) for promo_id, country, at in events
+    )
+    upsert = pg_insert(PromoActivationRollup)
+    await db.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[PromoActivationRollup.promo_id, PromoActivationRollup.country, PromoActivationRollup.hour],
+            set_={"activations": PromoActivationRollup.activations + upsert.excluded.activations},
+        ),
+        [
+            {"promo_id": promo_id, "country": country, "hour": hour, "activations": count}
+            for (promo_id, country, hour), count in sorted(hourly.items(), key=lambda item: str(item[0]))
+        ],
+    )
+
+
+async def country_activations(db, promo_id) -> dict[str, int]:
+    rows = await db.execute(
+        select(PromoActivationRollup.country, func.sum(PromoActivationRollup.activations))
+        .where(PromoActivationRollup.promo_id == promo_id, PromoActivationRollup.country != "")
+        .group_by(PromoActivationRollup.country)
+    )
+    return {country: int(count) for country, count in rows}
+
+
+def rebuild_rollups(connection, promo_id=None):
+    """Пересчитывает роллапы из сырого журнала (бэкфилл или восстановление после сбоя)."""
+    clear = delete(PromoActivationRollup)
+    hour = func.date_trunc("hour", PromoActivation.activated_at)
+    source = select(
+        PromoActivation.promo_id,
+        PromoActivation.country,
+        hour.label("hour"),
+        func.count().label("activations"),
+    )
+    if promo_id is not None:
+        clear = clear.where(PromoActivationRollup.promo_id == promo_id)
+        source = source.where(PromoActivation.promo_id == promo_id)
+    source = source.group_by(PromoActivation.promo_id, PromoActivation.country, hour)
+
+    connection.execute(clear)
+    result = connection.execute(
+        insert(PromoActivationRollup).from_select(["promo_id", "country", "hour", "activations"], source)
+    )
+    return result.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание журнала активаций")
+    parser.add_argument("command", choices=["rebuild", "partitions"])
+    parser.add_argument("--promo", help="Пересчитать только один промокод")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    with engine.begin() as connection:
+        if args.command == "partitions":
+            ensure_partitions(connection)
+        else:
+            # Запрещаем параллельную запись роллапов сбросом счётчиков на время пересчёта.
+            connection.execute(text("LOCK TABLE promo_activation_rollups IN EXCLUSIVE MODE"))
+            rows = rebuild_rollups(connection, args.promo)
+            print(f"Роллапов записано: {rows}")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from typing import Optional
+from sqlalchemy import and_
+from database import PromoCode
+
+# "Любое значение": промо без ограничения по стране/категории хранит ["*"],
+# тогда фильтр пользователя — один оператор && по GIN-индексу, без OR ... IS NULL.
+ANY = "*"
+AGE_MIN = 0
+AGE_MAX = 1000
+
+
+def _values(value) -> list:
+    if isinstance(value, str):
+        return [value]
+    return value if isinstance(value, list) else []
+
+
+def _normalize(values) -> list[str]:
+    return sorted({str(value).strip().lower() for value in values if value}) or [ANY]
+
+
+def _age(value, default: int) -> int:
+    try:
+        return min(AGE_MAX, max(AGE_MIN, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+def target_columns(target: Optional[dict]) -> dict:
+    """Раскладывает JSON target по индексируемым колонкам PromoCode.
+
+    Запросы API проверяются заранее (models.validate_target); здесь же терпимо разбираются строки,
+    сохранённые до проверки: значение неверного типа не сужает аудиторию. У бэкфилла 8d4e2b6f1a93
+    своя замороженная копия этих правил.
+    """
+    target = target if isinstance(target, dict) else {}
+    countries = _values(target.get("countries")) + _values(target.get("country"))
+    return {
+        "target_countries": _normalize(countries),
+        "target_categories": _normalize(_values(target.get("categories"))),
+        "target_age_from": _age(target.get("age_from"), AGE_MIN),
+        "target_age_until": _age(target.get("age_until"), AGE_MAX),
+    }
+
+
+def feed_filter(now, country: Optional[str] = None, age: Optional[int] = None, category: Optional[str] = None):
+    conditions = [
+        # Без IS TRUE: иначе планировщик не сопоставит условие с частичным индексом WHERE active.
+        PromoCode.active,
+        PromoCode.active_from <= now,
+        PromoCode.active_until >= now,
+    ]
+    if country:
+        conditions.append(PromoCode.target_countries.overlap([country.strip().lower(), ANY]))
+    if category:
+        conditions.append(PromoCode.target_categories.overlap([category.strip().lower(), ANY]))
+    if age is not None:
+        conditions.append(PromoCode.target_age_from <= age)
+        conditions.append(PromoCode.target_age_until >= age)
+    return and_(*conditions)
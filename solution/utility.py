@@ -1,14 +1,28 @@
 from datetime import datetime, timedelta, timezone
-from fastapi import Depends, HTTPException
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse
+from fastapi.security import HTTPBearer
 from jose import jwt, JWTError
-from cfg import pwd_context, secret_key, alg
+from cfg import secret_key, alg
+import hashing
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def utcnow() -> datetime:
+    # Колонки DateTime в схеме без таймзоны: храним наивное UTC (asyncpg не принимает aware-значения).
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+async def hash_password(password: str) -> str:
+    return await hashing.run(hashing._hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await hashing.run(hashing._verify, plain_password, hashed_password)
+
+class FastJSONResponse(ORJSONResponse):
+    # asyncpg отдаёт собственный тип UUID, который orjson не знает; всё незнакомое — через str().
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -23,13 +37,8 @@ def create_access_token(data: dict):
 security = HTTPBearer()
 
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+def decode_token(token: str) -> dict:
     try:
-        payload = jwt.decode(token, secret_key, algorithms=[alg])
-        print("Decoded payload:", payload)
-        return payload
-    except JWTError as e:
-        print("Token decoding error:", e)
+        return jwt.decode(token, secret_key, algorithms=[alg])
+    except JWTError:
         raise HTTPException(status_code=401, detail="Неверный токен")
-